@@ -0,0 +1,263 @@
+"""
+离线端到端基准测试
+
+在本地启动 DMI 模拟站点 (benchmarks/mock_site.py)，用 ThermoMastoCrawler.run()
+完整爬取一遍，报告 页面/s、文件/s、MB/s、请求延迟 p50/p99 与峰值内存 (RSS)。
+不访问 visual.ic.uff.br，也不需要浏览器: 基准爬虫通过 POST 登录模拟站点，
+并固定使用 "requests" 页面获取模式。默认去掉爬虫内置的随机休眠以测量其本身的吞吐，
+--keep-delays 可保留 (或通过 --run-kwargs 设置 rate_limit)。
+
+每个配置在独立的子进程中运行，峰值内存只统计爬虫本身；模拟站点运行在主进程中。
+
+用法:
+    python benchmarks/bench_crawl.py --max-workers 4 8 16 --latency 0.02
+    python benchmarks/bench_crawl.py --engine async --run-kwargs '{"adaptive_concurrency": true}'
+    python benchmarks/bench_crawl.py --json results.json   # 供 CI 保存与比较
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from urllib.parse import urljoin, urlparse
+
+os.environ.setdefault("TQDM_DISABLE", "1")  # 子进程继承，需在导入 tqdm 之前设置
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from main import ThermoMastoCrawler  # noqa: E402
+from mock_site import SESSION_COOKIE_NAME, MockDMISite  # noqa: E402
+
+
+class BenchmarkCrawler(ThermoMastoCrawler):
+    """不启动浏览器、直接通过 Requests 登录模拟站点的爬虫，并记录每个页面请求的延迟"""
+
+    def __init__(self, base_url, keep_delays=False):
+        super().__init__("benchmark", "benchmark")
+        self.base_url = base_url
+        self.keep_delays = keep_delays
+        if not keep_delays:
+            self.delay_range = (0, 0)
+            self.http_delay_range = (0, 0)
+        self.page_latencies = []
+        self.session.hooks["response"].append(self._record_latency)
+
+    def _record_latency(self, response, *args, **kwargs):
+        if urlparse(response.url).path.endswith(".php"):
+            self.page_latencies.append(response.elapsed.total_seconds())
+
+    def _log(self, level, message):
+        if level == "ERROR":
+            super()._log(level, message)
+
+    def _legacy_sleep(self, delay_range):
+        if self.keep_delays:
+            super()._legacy_sleep(delay_range)
+
+    def _throttle(self, url, legacy_range=None):
+        super()._throttle(url, legacy_range if self.keep_delays else None)
+
+    async def _throttle_async(self, url, legacy_range=None):
+        await super()._throttle_async(url, legacy_range if self.keep_delays else None)
+
+    def setup_driver(self):
+        self.driver = None
+        return True
+
+    def login(self):
+        self.session.post(
+            urljoin(self.base_url, "index.php"),
+            data={"usuario": self.username, "password": self.password},
+            timeout=self.timeout,
+        )
+        return SESSION_COOKIE_NAME in self.session.cookies
+
+    def _relogin(self):
+        return self.login()
+
+
+def percentile(values, pct):
+    """最近秩法百分位数，values 为空时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def _run_crawl(base_url, run_kwargs, keep_delays, results):
+    """[子进程] 在临时目录中完整运行一次爬虫并汇总指标"""
+    work_dir = tempfile.mkdtemp(prefix="dmi-bench-")
+    os.chdir(work_dir)
+    try:
+        crawler = BenchmarkCrawler(base_url, keep_delays)
+        kwargs = {
+            "gallery_save_dir": "gallery",
+            "patient_save_dir": "patients",
+            **run_kwargs,
+            "page_fetch_mode": ThermoMastoCrawler.FETCH_REQUESTS,
+        }
+        start = time.perf_counter()
+        metrics = crawler.run(**kwargs)
+        wall = time.perf_counter() - start
+
+        with open(crawler.log_file, encoding="utf-8-sig") as f:
+            rows = list(csv.DictReader(f))
+        downloaded = [r for r in rows if r["status"] == "success"]
+        file_latencies = [float(r["elapsed_s"]) for r in downloaded]
+        megabytes = sum(float(r["size_kb"]) for r in downloaded) / 1024
+        pages = len(crawler.page_latencies)
+
+        def ms(value):
+            return None if value is None else round(value * 1000, 2)
+
+        results.put(
+            {
+                "wall_s": round(wall, 3),
+                "pages": pages,
+                "files": len(downloaded),
+                "failed": sum(1 for r in rows if r["status"] == "failed"),
+                "megabytes": round(megabytes, 2),
+                "pages_per_s": round(pages / wall, 2),
+                "files_per_s": round(len(downloaded) / wall, 2),
+                "mb_per_s": round(megabytes / wall, 2),
+                "page_p50_ms": ms(percentile(crawler.page_latencies, 50)),
+                "page_p99_ms": ms(percentile(crawler.page_latencies, 99)),
+                "file_p50_ms": ms(percentile(file_latencies, 50)),
+                "file_p99_ms": ms(percentile(file_latencies, 99)),
+                # Linux 上 ru_maxrss 单位为 KB
+                "peak_rss_mb": round(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+                ),
+                # run() 返回的各阶段耗时，仅写入 JSON 结果
+                "stages": metrics.snapshot()["stages"] if metrics else {},
+            }
+        )
+    finally:
+        os.chdir(BENCH_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_benchmark(site, base_url, run_kwargs, keep_delays=False):
+    """在独立子进程中运行一次爬取，返回指标字典 (含模拟站点侧统计)"""
+    site.request_count = site.error_count = site.login_count = 0
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(
+        target=_run_crawl, args=(base_url, run_kwargs, keep_delays, results)
+    )
+    process.start()
+    metrics = results.get()
+    process.join()
+    metrics["server_requests"] = site.request_count
+    metrics["server_errors"] = site.error_count
+    metrics["server_logins"] = site.login_count
+    return metrics
+
+
+COLUMNS = [
+    ("max_workers", "workers"),
+    ("wall_s", "耗时s"),
+    ("pages_per_s", "页面/s"),
+    ("files_per_s", "文件/s"),
+    ("mb_per_s", "MB/s"),
+    ("page_p50_ms", "页p50ms"),
+    ("page_p99_ms", "页p99ms"),
+    ("file_p50_ms", "文件p50ms"),
+    ("file_p99_ms", "文件p99ms"),
+    ("peak_rss_mb", "RSS MB"),
+    ("failed", "失败"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="基于本地模拟站点的端到端爬虫基准测试")
+    site_group = parser.add_argument_group("模拟站点")
+    site_group.add_argument("--gallery-pages", type=int, default=5)
+    site_group.add_argument("--images-per-page", type=int, default=20)
+    site_group.add_argument("--patients", type=int, default=50)
+    site_group.add_argument("--patients-per-page", type=int, default=20)
+    site_group.add_argument("--files-per-patient", type=int, default=4)
+    site_group.add_argument("--file-size", type=int, default=256 * 1024, help="字节")
+    site_group.add_argument("--latency", type=float, default=0.01, help="每个请求的延迟 (秒)")
+    site_group.add_argument("--error-rate", type=float, default=0.0)
+    site_group.add_argument("--error-status", type=int, default=503)
+    site_group.add_argument("--retry-after", type=int, default=None, help="秒")
+    site_group.add_argument(
+        "--session-lifetime", type=float, default=None, help="会话有效期 (秒)"
+    )
+
+    crawl_group = parser.add_argument_group("爬虫")
+    crawl_group.add_argument(
+        "--max-workers", type=int, nargs="+", default=[10], help="可给出多个值依次测试"
+    )
+    crawl_group.add_argument("--engine", choices=["thread", "async"], default="thread")
+    crawl_group.add_argument("--detail-workers", type=int, default=4)
+    crawl_group.add_argument("--gallery-page-workers", type=int, default=4)
+    crawl_group.add_argument("--parser", default="bs4", help="HTML 解析后端")
+    crawl_group.add_argument(
+        "--run-kwargs", default="{}", help="传给 run() 的其他参数 (JSON 对象)"
+    )
+    crawl_group.add_argument(
+        "--keep-delays", action="store_true", help="保留爬虫内置的随机休眠"
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="每个配置重复运行的次数")
+    parser.add_argument("--json", dest="json_path", help="将结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    site = MockDMISite(
+        gallery_pages=args.gallery_pages,
+        images_per_page=args.images_per_page,
+        patients=args.patients,
+        patients_per_page=args.patients_per_page,
+        files_per_patient=args.files_per_patient,
+        file_size=args.file_size,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        session_lifetime=args.session_lifetime,
+    )
+    base_url = site.start()
+    print(
+        f"模拟站点: {base_url} | {site.total_files} 个文件 × "
+        f"{args.file_size / 1024:.0f} KB | 延迟 {args.latency * 1000:.0f} ms"
+    )
+
+    results = []
+    try:
+        for max_workers in args.max_workers:
+            run_kwargs = {
+                "max_workers": max_workers,
+                "download_engine": args.engine,
+                "detail_workers": args.detail_workers,
+                "gallery_page_workers": args.gallery_page_workers,
+                "parser_backend": args.parser,
+                **json.loads(args.run_kwargs),
+            }
+            for _ in range(args.repeat):
+                metrics = run_benchmark(site, base_url, run_kwargs, args.keep_delays)
+                results.append({"max_workers": max_workers, "config": run_kwargs, **metrics})
+    finally:
+        site.stop()
+
+    print("".join(f"{title:>11}" for _, title in COLUMNS))
+    for result in results:
+        print("".join(f"{str(result[key]):>11}" for key, _ in COLUMNS))
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入: {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+患者详情字段提取基准测试
+
+在 benchmarks/fixtures/patient_details.html 与模拟站点生成的详情页上，
+对比逐字段 re.search (旧实现) 与预编译规则表 extract_detail_fields() 的提取耗时，
+并报告 "解析 + 提取" 的整页耗时，同时校验两种提取方式的结果完全一致。
+
+用法:
+    python benchmarks/bench_extract.py [--pages 200] [--repeat 20] [--backends bs4 lxml]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from main import PAGE_PARSERS, create_page_parser, extract_detail_fields  # noqa: E402
+from mock_site import MockDMISite  # noqa: E402
+
+
+def legacy_extract(parsed):
+    """规则表之前的实现: 每个字段单独调用 re.search (依赖 re 模块的内部缓存)"""
+    fields = dict.fromkeys(
+        ("id", "age", "register_date", "marital_status", "race", "temperature")
+    )
+    text = parsed["info_text"]
+    if text is not None:
+        m = re.search(r"ID:\s*(\d+)", text)
+        if m:
+            fields["id"] = m.group(1)
+        m = re.search(r"(\d+)\s*years", text)
+        if m:
+            fields["age"] = int(m.group(1))
+        m = re.search(r"Registered at\s*([\d-]+)", text)
+        if m:
+            fields["register_date"] = m.group(1)
+        m = re.search(r"Marital status:\s*([\w\s]+)", text)
+        if m:
+            fields["marital_status"] = m.group(1).strip(". ")
+        m = re.search(r"Race:\s*([\w\s]+)", text)
+        if m:
+            fields["race"] = m.group(1).strip(". ")
+    if parsed["protocol"] is not None:
+        m = re.search(r"Body temperature:\s*([\d.]+)", parsed["protocol"])
+        if m:
+            fields["temperature"] = float(m.group(1))
+    return fields
+
+
+def load_pages(count):
+    """真实页面样本 + count 个模拟站点详情页"""
+    with open(os.path.join(BENCH_DIR, "fixtures", "patient_details.html"), encoding="utf-8") as f:
+        pages = [f.read()]
+    site = MockDMISite(patients=count)
+    pages.extend(site.details_html(pid) for pid in range(1, count + 1))
+    return pages
+
+
+def best_of(func, items, repeat):
+    """返回每项的平均耗时 (微秒)，取 3 轮中的最小值以减少抖动"""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for item in items:
+                func(item)
+        best = min(best, (time.perf_counter() - start) / (repeat * len(items)))
+    return best * 1e6
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="对比患者详情字段的提取方式")
+    arg_parser.add_argument("--pages", type=int, default=200, help="模拟详情页数量")
+    arg_parser.add_argument("--repeat", type=int, default=20, help="每轮重复次数")
+    arg_parser.add_argument(
+        "--backends", nargs="+", default=list(PAGE_PARSERS), help="要测试的解析后端"
+    )
+    args = arg_parser.parse_args()
+
+    pages = load_pages(args.pages)
+    print(f"{'后端':<12}{'旧提取us':>10}{'规则表us':>10}{'加速比':>8}{'整页us':>10}{'结果一致':>10}")
+    for backend in args.backends:
+        try:
+            parser = create_page_parser(backend)
+        except ImportError as e:
+            print(f"跳过 {backend}: {e}")
+            continue
+        parsed_pages = [parser.patient_details(html) for html in pages]
+        same = all(legacy_extract(p) == extract_detail_fields(p) for p in parsed_pages)
+        legacy = best_of(legacy_extract, parsed_pages, args.repeat)
+        rules = best_of(extract_detail_fields, parsed_pages, args.repeat)
+        whole = best_of(
+            lambda html: extract_detail_fields(parser.patient_details(html)),
+            pages,
+            max(1, args.repeat // 10),
+        )
+        print(
+            f"{backend:<12}{legacy:>10.2f}{rules:>10.2f}{legacy / rules:>7.2f}x"
+            f"{whole:>10.1f}{'是' if same else '否':>9}"
+        )
+        if not same:
+            print(f"  警告: {backend} 上规则表的提取结果与旧实现不一致")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+HTML 解析后端基准测试
+
+在 benchmarks/fixtures/ 下保存的页面样本上，对比各解析后端
+(bs4 / lxml / selectolax) 的解析耗时，并校验它们的提取结果完全一致。
+
+用法:
+    python benchmarks/bench_parsers.py [--repeat 200] [--backends bs4 lxml selectolax]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import PAGE_PARSERS, create_page_parser  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# 样本文件 -> 对应的解析方法
+FIXTURES = {
+    "gallery_page.html": "gallery",
+    "patient_list.html": "patient_list",
+    "patient_details.html": "patient_details",
+}
+
+
+def load_fixtures():
+    pages = {}
+    for file_name, method in FIXTURES.items():
+        with open(os.path.join(FIXTURES_DIR, file_name), encoding="utf-8") as f:
+            pages[file_name] = (method, f.read())
+    return pages
+
+
+def time_parser(parser, method, html, repeat):
+    """返回单次解析的平均耗时 (毫秒)，取 3 轮中的最小值以减少抖动"""
+    parse = getattr(parser, method)
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            parse(html)
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best * 1000
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="对比 HTML 解析后端的速度")
+    arg_parser.add_argument("--repeat", type=int, default=200, help="每轮解析次数")
+    arg_parser.add_argument(
+        "--backends", nargs="+", default=list(PAGE_PARSERS), help="要测试的后端"
+    )
+    args = arg_parser.parse_args()
+
+    parsers = {}
+    for backend in args.backends:
+        try:
+            parsers[backend] = create_page_parser(backend)
+        except ImportError as e:
+            print(f"跳过 {backend}: {e}")
+    if "bs4" not in parsers:
+        parsers = {"bs4": create_page_parser("bs4"), **parsers}
+
+    pages = load_fixtures()
+    print(f"{'样本':<24}{'后端':<12}{'ms/页':>10}{'加速比':>10}{'结果一致':>10}")
+    for file_name, (method, html) in pages.items():
+        reference = getattr(parsers["bs4"], method)(html)
+        baseline = None
+        for backend, parser in parsers.items():
+            elapsed = time_parser(parser, method, html, args.repeat)
+            baseline = baseline or elapsed
+            same = getattr(parser, method)(html) == reference
+            print(
+                f"{file_name:<24}{backend:<12}{elapsed:>10.3f}"
+                f"{baseline / elapsed:>9.1f}x{'是' if same else '否':>9}"
+            )
+            if not same:
+                print(f"  警告: {backend} 在 {file_name} 上的提取结果与 bs4 不一致")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""
+DMI 网站的本地模拟服务器 (仅用于离线基准测试)
+
+提供与 visual.ic.uff.br/dmi/prontuario/ 结构相同的合成页面:
+index.php (登录)、images.php (图片库)、patients.php (患者列表)、details.php (患者详情)
+以及图片 / 热矩阵文件。页数、患者数、文件数量与大小、响应延迟和错误率均可配置。
+文件支持 ETag / If-None-Match 与 Range 请求，便于测试增量爬取和断点续传；
+可设置会话有效期，过期后请求被重定向到登录页，便于测试重新登录。
+
+单独运行:
+    python benchmarks/mock_site.py --port 8000 --patients 100 --latency 0.02
+"""
+
+import argparse
+import hashlib
+import io
+import random
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PREFIX = "/dmi/prontuario/"
+SESSION_COOKIE_NAME = "PHPSESSID"
+
+
+def _jpeg_header(name):
+    """按文件名生成一张小的有效 JPEG，未安装 Pillow 时返回空字节 (文件内容为随机数据)"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return b""
+    seed = hashlib.sha256(name.encode()).digest()
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 48), tuple(seed[:3])).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+class MockDMISite:
+    """
+    可配置的 DMI 模拟站点。
+
+    Args:
+        gallery_pages (int): 图片库页数
+        images_per_page (int): 图片库每页图片数
+        patients (int): 患者总数
+        patients_per_page (int): 患者列表每页行数
+        files_per_patient (int): 每位患者的文件数 (图片与 .txt 热矩阵交替)
+        file_size (int): 每个文件的字节数 (.txt 热矩阵取整到完整的行)
+        latency (float): 每个请求的固定延迟 (秒)
+        error_rate (float): 登录后的请求随机返回错误的概率
+        error_status (int): 随机错误使用的状态码 (503 或 429)
+        retry_after (int, optional): 错误响应携带的 Retry-After 秒数
+        session_lifetime (float, optional): 登录会话的有效期 (秒)，过期后请求被重定向到
+                                            index.php。None 表示永不过期
+        seed (int): 随机数种子，保证结果可复现
+    """
+
+    def __init__(
+        self,
+        gallery_pages=5,
+        images_per_page=20,
+        patients=50,
+        patients_per_page=20,
+        files_per_patient=4,
+        file_size=256 * 1024,
+        latency=0.0,
+        error_rate=0.0,
+        error_status=503,
+        retry_after=None,
+        session_lifetime=None,
+        seed=0,
+    ):
+        self.gallery_pages = gallery_pages
+        self.images_per_page = images_per_page
+        self.patients = patients
+        self.patients_per_page = patients_per_page
+        self.files_per_patient = files_per_patient
+        self.file_size = file_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.session_lifetime = session_lifetime
+        self._sessions = {}  # 会话 ID -> 登录时间
+        self.login_count = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._payloads = {}
+        self.request_count = 0
+        self.error_count = 0
+        self.bytes_sent = 0
+        self.server = None
+
+    @property
+    def total_files(self):
+        """完整爬取一次应下载的文件数"""
+        return (
+            self.gallery_pages * self.images_per_page
+            + self.patients * self.files_per_patient
+        )
+
+    # --- 页面 ---
+
+    def gallery_html(self, page):
+        items = "".join(
+            f'<li><a href="images.php?p=1&amp;pagina={i}">{i}</a></li>'
+            for i in range(1, self.gallery_pages + 1)
+        )
+        if page < self.gallery_pages:
+            items += f'<li><a href="images.php?p=1&amp;pagina={page + 1}">Next</a></li>'
+        images = "".join(
+            f'<div class="imagem"><a href="images/gallery/G{page:04d}_{i:03d}.jpg">'
+            f'<img src="images/gallery/thumbs/G{page:04d}_{i:03d}.png"></a></div>'
+            for i in range(self.images_per_page)
+        )
+        return (
+            "<html><body><h2>Database of mastologic images</h2>"
+            f'<div class="pagination"><ul>{items}</ul></div>{images}</body></html>'
+        )
+
+    def patient_list_html(self, page):
+        first = (page - 1) * self.patients_per_page + 1
+        last = min(self.patients, first + self.patients_per_page - 1)
+        rows = "".join(
+            f'<tr><td>{pid}</td><td><a href="details.php?id={pid}">PAC_{pid:04d}</a></td>'
+            f"<td>{2012 + pid % 8}</td></tr>"
+            for pid in range(first, last + 1)
+        )
+        next_link = (
+            f'<a href="patients.php?page={page + 1}">Next &raquo;</a>'
+            if last < self.patients
+            else ""
+        )
+        return (
+            '<html><body><table id="mytable"><tr><th>ID</th><th>Records</th>'
+            f"<th>Year</th></tr>{rows}</table>{next_link}</body></html>"
+        )
+
+    def details_html(self, pid):
+        files = "".join(
+            f'<a href="files/P{pid:04d}_{i:02d}.{"txt" if i % 2 else "jpg"}" '
+            f'title="view {i}"><img src="x.png"></a>'
+            for i in range(self.files_per_patient)
+        )
+        return (
+            '<html><body><div class="descripcion1">'
+            f"<p>ID: {pid}</p><p>PAC_{pid:04d}</p>"
+            f"<p>{30 + pid % 40} years. Registered at 2019-03-{1 + pid % 27:02d}</p>"
+            "<p>Marital status: Married. Race: White.</p></div>"
+            '<p class="view-diagnostico">Diagnosis: <span>Healthy</span></p>'
+            '<div class="descripcion2">Personal history: none</div>'
+            f'<div class="descripcion3">Body temperature: 36.{pid % 10}</div>'
+            f'<div class="imagenspaciente">{files}</div></body></html>'
+        )
+
+    def payload(self, name):
+        """文件内容由文件名决定 (多次请求结果相同，便于续传与哈希校验)"""
+        with self._lock:
+            data = self._payloads.get(name)
+        if data is not None:
+            return data
+        if name.endswith(".txt"):
+            row = (" ".join(f"{34 + (i % 7) * 0.13:.2f}" for i in range(640)) + "\n").encode()
+            # 只包含完整的行，否则热矩阵转换会因最后一行列数不足而失败
+            data = row * max(1, round(self.file_size / len(row)))
+        else:
+            # 有效的 JPEG (需 Pillow) + 填充字节；解码器会忽略 EOI 之后的数据
+            block = hashlib.sha256(name.encode()).digest() * 128
+            data = _jpeg_header(name) + block * (self.file_size // len(block) + 1)
+            data = data[: max(self.file_size, len(_jpeg_header(name)))]
+        with self._lock:
+            self._payloads[name] = data
+        return data
+
+    def login(self):
+        """创建新会话，返回会话 ID"""
+        with self._lock:
+            self.login_count += 1
+            session_id = f"mock-{secrets.token_hex(8)}"
+            self._sessions[session_id] = time.monotonic()
+        return session_id
+
+    def session_valid(self, cookie_header):
+        match = re.search(rf"{SESSION_COOKIE_NAME}=([\w-]+)", cookie_header or "")
+        with self._lock:
+            created = self._sessions.get(match.group(1)) if match else None
+        if created is None:
+            return False
+        return (
+            self.session_lifetime is None
+            or time.monotonic() - created < self.session_lifetime
+        )
+
+    # --- HTTP 服务 ---
+
+    def _make_handler(site):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b"", content_type="text/html; charset=utf-8", headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if self.command != "HEAD" and body:
+                    self.wfile.write(body)
+                    with site._lock:
+                        site.bytes_sent += len(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._send(
+                    302,
+                    headers={
+                        "Location": PREFIX + "home.php",
+                        "Set-Cookie": f"{SESSION_COOKIE_NAME}={site.login()}; Path=/",
+                    },
+                )
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                with site._lock:
+                    site.request_count += 1
+                    fail = site.error_rate and site._rng.random() < site.error_rate
+                if site.latency:
+                    time.sleep(site.latency)
+
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                path = url.path[len(PREFIX):] if url.path.startswith(PREFIX) else url.path
+                if path in ("", "index.php"):
+                    return self._send(200, b"<html><form method='post'>login</form></html>")
+                if not site.session_valid(self.headers.get("Cookie")):
+                    return self._send(302, headers={"Location": PREFIX + "index.php"})
+                if fail:
+                    with site._lock:
+                        site.error_count += 1
+                    headers = {}
+                    if site.retry_after is not None:
+                        headers["Retry-After"] = str(site.retry_after)
+                    return self._send(site.error_status, b"busy", headers=headers)
+
+                if path == "images.php":
+                    page = int(query.get("pagina", ["1"])[0])
+                    return self._send(200, site.gallery_html(page).encode())
+                if path == "patients.php":
+                    page = int(query.get("page", ["1"])[0])
+                    return self._send(200, site.patient_list_html(page).encode())
+                if path == "details.php":
+                    return self._send(200, site.details_html(int(query["id"][0])).encode())
+
+                match = re.match(r"(images/gallery|files)/([^/]+)$", path)
+                if not match:
+                    return self._send(404, b"not found")
+                name = match.group(2)
+                body = site.payload(name)
+                content_type = "text/plain" if name.endswith(".txt") else "image/jpeg"
+                etag = f'"{hashlib.md5(name.encode()).hexdigest()}-{len(body)}"'
+                if self.headers.get("If-None-Match") == etag:
+                    return self._send(304, headers={"ETag": etag})
+                range_header = self.headers.get("Range")
+                if range_header:
+                    start = int(range_header.split("=")[1].split("-")[0])
+                    if start >= len(body):
+                        return self._send(416, headers={"Content-Range": f"bytes */{len(body)}"})
+                    return self._send(
+                        206,
+                        body[start:],
+                        content_type,
+                        {
+                            "ETag": etag,
+                            "Content-Range": f"bytes {start}-{len(body) - 1}/{len(body)}",
+                        },
+                    )
+                return self._send(200, body, content_type, {"ETag": etag})
+
+        return Handler
+
+    def start(self, host="127.0.0.1", port=0):
+        """在后台线程中启动服务器，返回可直接用作 crawler.base_url 的地址"""
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_address[1]}{PREFIX}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动本地 DMI 模拟站点")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--gallery-pages", type=int, default=5)
+    parser.add_argument("--images-per-page", type=int, default=20)
+    parser.add_argument("--patients", type=int, default=50)
+    parser.add_argument("--patients-per-page", type=int, default=20)
+    parser.add_argument("--files-per-patient", type=int, default=4)
+    parser.add_argument("--file-size", type=int, default=256 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=int, default=None)
+    parser.add_argument("--session-lifetime", type=float, default=None)
+    args = parser.parse_args()
+
+    site = MockDMISite(
+        gallery_pages=args.gallery_pages,
+        images_per_page=args.images_per_page,
+        patients=args.patients,
+        patients_per_page=args.patients_per_page,
+        files_per_patient=args.files_per_patient,
+        file_size=args.file_size,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        session_lifetime=args.session_lifetime,
+    )
+    print(f"模拟站点已启动: {site.start(args.host, args.port)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        site.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,32 @@
 import os
 import re
 import time
+import asyncio
 import csv
 import json
+import multiprocessing
 import random
+import hashlib
+import heapq
+import io
+import mmap
+import shutil
+import sqlite3
+import sys
+import tarfile
+from email.utils import parsedate_to_datetime
+import queue
 import threading
 import concurrent.futures
+import contextlib
 import traceback
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urljoin, urlparse
 
 from dotenv import load_dotenv
 import requests
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 from tqdm import tqdm
@@ -22,10 +38,2598 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 import urllib3
 
+try:
+    import aiohttp  # 可选依赖，仅异步下载引擎需要
+except ImportError:
+    aiohttp = None
+
+try:
+    from lxml import etree as lxml_etree  # 可选依赖，仅 "lxml" 解析后端需要
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_etree = lxml_html = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser  # 可选依赖，仅 "selectolax" 解析后端需要
+except ImportError:
+    LexborHTMLParser = None
+
 # 禁用 SSL 警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
+PART_SUFFIX = ".part"  # 未完成下载的临时文件后缀
+INVALID_SUFFIX = ".invalid"  # 图片校验失败的文件后缀 (保留以便排查)
+# 分片元数据中记录患者在完整列表中位置的字段，merge_shard_outputs() 合并时移除
+SHARD_POSITION_FIELD = "_list_position"
+
+
+def _is_finished_file(name):
+    """下载目录中的文件是否为可用的成品 (排除未完成的 .part 与校验失败的 .invalid)"""
+    return not name.endswith((PART_SUFFIX, INVALID_SUFFIX))
+
+
+def _resume_part_file(part_path):
+    """
+    读取已存在的 .part 文件，返回 (已下载字节数, 已包含这些字节的 SHA-256 对象)，
+    以便续传时哈希仍覆盖完整文件。
+    """
+    hasher = hashlib.sha256()
+    offset = 0
+    try:
+        with open(part_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(block)
+                offset += len(block)
+    except FileNotFoundError:
+        pass
+    return offset, hasher
+
+
+def _range_request_headers(offset, validator=None):
+    """构造续传请求头; validator (ETag 或 Last-Modified) 用于 If-Range，防止拼接不同版本"""
+    if not offset:
+        return {}
+    headers = {"Range": f"bytes={offset}-"}
+    if validator:
+        headers["If-Range"] = validator
+    return headers
+
+
+def _resume_write_mode(status, content_range, offset):
+    """
+    根据响应决定 .part 文件的写入方式:
+    服务器返回 206 且起始位置与本地一致时追加 ("ab")，否则从头写入 ("wb")。
+    """
+    if offset and status == 206:
+        m = re.match(r"bytes (\d+)-", content_range or "")
+        if m and int(m.group(1)) == offset:
+            return "ab"
+    return "wb"
+
+
+def _open_part_file(part_path, mode, offset):
+    """
+    按 _resume_write_mode 的结果打开 .part 文件并定位到写入起点。
+    续传时以 "r+b" 打开而不是追加模式，这样预分配的空间不会被追加写跳过。
+    """
+    if mode == "ab":
+        f = open(part_path, "r+b")
+        f.seek(offset)
+        return f
+    return open(part_path, "wb")
+
+
+def _preallocate(f, offset, length):
+    """
+    按 Content-Length 预分配磁盘空间 (减少碎片与元数据更新)，返回是否已预分配。
+    预分配会把文件扩展到最终大小，调用方需在结束或出错时 truncate() 到实际写入位置；
+    进程崩溃留下的 .part 与完整文件等长，续传请求会收到 416 并整体重新下载。
+    """
+    if not hasattr(os, "posix_fallocate") or not length or length <= 0:
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), offset, length)
+        return True
+    except OSError:
+        return False  # 文件系统不支持
+
+
+def _file_size(path):
+    """一次 stat 同时判断文件是否存在并取得大小，不存在时返回 None"""
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)  # 视为服务器拥塞、可重试的状态码
+
+
+def _parse_retry_after(value):
+    """解析 Retry-After 响应头 (秒数或 HTTP 日期)，返回等待秒数，无法解析时返回 None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class SessionExpiredError(requests.RequestException):
+    """服务器返回了登录页而不是请求的内容 (PHP 会话已过期)"""
+
+
+def _is_login_page(final_url, content_type, expect_file=False, status=200):
+    """
+    判断响应是否为会话过期后被重定向到的登录页:
+    最终地址为 index.php (不论状态码)，或请求的是文件却收到了 2xx 的 HTML。
+    429/5xx 等错误页同样是 HTML，交给正常的 HTTP 错误与重试流程处理，不算会话过期。
+    """
+    if urlparse(str(final_url)).path.endswith("index.php"):
+        return True
+    return (
+        expect_file
+        and 200 <= status < 300
+        and "text/html" in (content_type or "").lower()
+    )
+
+
+def _wake_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class AdaptiveConcurrencyController:
+    """
+    AIMD (加性增、乘性减) 自适应并发控制器。
+
+    - 每个下载开始前 acquire() 占用一个并发槽，结束后 release()
+    - 成功且延迟未明显高于基线时，并发上限加性增长 (每完成约 limit 个请求 +1)
+    - 遇到 429/5xx/超时时，并发上限乘性减小 (每个 cooldown 周期最多减一次)
+    - 响应带 Retry-After 时，在指定时间内暂停发起新的下载
+    线程与协程均可使用 (协程使用 acquire_async)。
+    """
+
+    def __init__(
+        self,
+        min_limit=1,
+        max_limit=8,
+        initial_limit=None,
+        decrease_factor=0.5,
+        latency_tolerance=2.0,
+        cooldown=1.0,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial_limit or max(min_limit, max_limit // 2))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.successes = 0
+        self.congestion_events = 0
+        self._baseline_latency = None
+        self._pause_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = []  # 等待并发槽的协程: (事件循环, Future)
+
+    @property
+    def current_limit(self):
+        return int(self.limit)
+
+    def _can_start(self, now):
+        return self.in_flight < int(self.limit) and now >= self._pause_until
+
+    def acquire(self):
+        """[线程] 阻塞直到有空闲并发槽且不在 Retry-After 暂停期内"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._can_start(now):
+                    self.in_flight += 1
+                    return
+                timeout = self._pause_until - now if now < self._pause_until else None
+                self._cond.wait(timeout)
+
+    def try_acquire(self):
+        """非阻塞地尝试占用一个并发槽"""
+        with self._cond:
+            if self._can_start(time.monotonic()):
+                self.in_flight += 1
+                return True
+            return False
+
+    async def acquire_async(self):
+        """[协程] acquire 的异步版本，等待期间不阻塞事件循环，由 release/record_* 唤醒"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                if self._can_start(now):
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+                timeout = self._pause_until - now if now < self._pause_until else None
+            try:
+                await asyncio.wait([waiter], timeout=timeout)
+            finally:
+                with self._cond:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+
+    def _notify_waiters(self):
+        """[需持有 _cond] 唤醒所有等待中的线程与协程，由它们重新检查能否开始"""
+        self._cond.notify_all()
+        for loop, waiter in self._async_waiters:
+            with contextlib.suppress(RuntimeError):  # 事件循环已关闭
+                loop.call_soon_threadsafe(_wake_waiter, waiter)
+        self._async_waiters.clear()
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._notify_waiters()
+
+    def record_success(self, latency):
+        """记录一次成功请求；延迟处于基线容忍范围内时加性增加并发上限"""
+        with self._cond:
+            self.successes += 1
+            if self._baseline_latency is None:
+                self._baseline_latency = latency
+            else:
+                self._baseline_latency = 0.9 * self._baseline_latency + 0.1 * latency
+            if latency <= self._baseline_latency * self.latency_tolerance:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._notify_waiters()
+
+    def record_congestion(self, retry_after=None):
+        """记录一次拥塞信号 (429/5xx/超时)；乘性减小并发上限并遵守 Retry-After"""
+        with self._cond:
+            self.congestion_events += 1
+            now = time.monotonic()
+            if retry_after:
+                self._pause_until = max(self._pause_until, now + retry_after)
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                self._last_decrease = now
+            # 等待者需按新的 Retry-After 暂停时间重新计算等待时长
+            self._notify_waiters()
+
+
+class AsyncDownloadEngine:
+    """
+    基于 asyncio + aiohttp 的下载引擎。
+
+    在后台线程中运行单个事件循环，所有下载共享同一个连接池，
+    通过 max_connections / limit_per_host 限制总连接数与单主机连接数。
+    submit() 返回 concurrent.futures.Future，可与线程池的 Future 一样被监控。
+    设置 controller (AdaptiveConcurrencyController) 后，每次请求都经其控制并发，
+    并将 429/5xx/超时反馈给控制器、遵守 Retry-After。
+    """
+
+    RETRY_STATUSES = RETRYABLE_STATUSES
+
+    def __init__(
+        self,
+        max_connections=100,
+        limit_per_host=16,
+        timeout=30,
+        retries=3,
+        backoff_factor=0.5,
+        chunk_size=256 * 1024,
+    ):
+        self.max_connections = max_connections
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.chunk_size = chunk_size
+        self.controller = None
+        self.throttle = None  # 协程函数 throttle(url)，每次发起请求前调用 (限速)
+        self.metrics = None  # CrawlMetrics，设置后记录首字节时间、写盘耗时与下载字节数
+        self.preallocate = False  # 按 Content-Length 预分配 .part 文件
+        self.loop = None
+        self.session = None
+        self._thread = None
+
+    def start(self, headers=None, cookies=None):
+        """启动事件循环线程并创建共享的 aiohttp 会话"""
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="async-download-loop", daemon=True
+        )
+        self._thread.start()
+        self.run(self._open_session(headers or {}, cookies or {})).result()
+
+    async def _open_session(self, headers, cookies):
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections,
+            limit_per_host=self.limit_per_host,
+            ssl=False,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=self.timeout, sock_read=self.timeout
+        )
+        # unsafe=True 允许 Cookie 作用于 IP 地址形式的主机
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers=headers,
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+        )
+        self.session.cookie_jar.update_cookies(cookies)
+
+    def run(self, coro):
+        """[线程安全] 将协程提交到事件循环，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def fetch_to_file(self, url, save_path, validator=None):
+        """
+        下载 url 到 save_path，对连接错误和 5xx 响应按指数退避重试。
+        数据先写入 .part 文件，完成后原子重命名；已有的 .part 文件通过 Range 请求续传。
+        收到登录页时抛出 SessionExpiredError (不写入 .part)，由调用方重新登录后重试。
+        返回 {'etag', 'last_modified', 'sha256', 'size'}。
+        """
+        part_path = save_path + PART_SUFFIX
+        for attempt in range(self.retries + 1):
+            # 每次尝试都从 .part 的当前长度续传，重试不会丢弃已下载的数据
+            offset, hasher = _resume_part_file(part_path)
+            headers = _range_request_headers(offset, validator)
+            retry_after = None
+            if self.controller is not None:
+                await self.controller.acquire_async()
+            try:
+                # 每次请求 (含重试与重新登录后的重试) 都获取令牌
+                if self.throttle is not None:
+                    await self.throttle(url)
+                started = time.monotonic()
+                async with self.session.get(url, headers=headers) as response:
+                    if self.metrics is not None:
+                        self.metrics.observe("download_ttfb", time.monotonic() - started)
+                    if _is_login_page(
+                        response.url,
+                        response.headers.get("Content-Type"),
+                        True,
+                        response.status,
+                    ):
+                        raise SessionExpiredError(f"会话已过期，服务器返回登录页: {url}")
+                    if response.status == 416 and offset:
+                        os.remove(part_path)  # 续传位置无效，从头下载
+                        continue
+                    response.raise_for_status()
+                    mode = _resume_write_mode(
+                        response.status, response.headers.get("Content-Range"), offset
+                    )
+                    if mode == "wb":
+                        hasher = hashlib.sha256()
+                    received = write_time = 0
+                    with _open_part_file(part_path, mode, offset) as f:
+                        preallocated = self.preallocate and _preallocate(
+                            f, f.tell(), response.content_length
+                        )
+                        try:
+                            async for chunk in response.content.iter_chunked(
+                                self.chunk_size
+                            ):
+                                write_started = time.perf_counter()
+                                f.write(chunk)
+                                write_time += time.perf_counter() - write_started
+                                hasher.update(chunk)
+                                received += len(chunk)
+                        finally:
+                            if preallocated:
+                                f.truncate()
+                        size = f.tell()
+                    if self.metrics is not None:
+                        self.metrics.observe("disk_write", write_time)
+                        self.metrics.inc("download_bytes", received)
+                    os.replace(part_path, save_path)
+                    if self.controller is not None:
+                        self.controller.record_success(time.monotonic() - started)
+                    return {
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                        "sha256": hasher.hexdigest(),
+                        "size": size,
+                    }
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if self.controller is not None:
+                    self.controller.record_congestion()
+                if attempt >= self.retries:
+                    raise
+            except aiohttp.ClientResponseError as e:
+                if e.status not in self.RETRY_STATUSES:
+                    raise
+                retry_after = _parse_retry_after((e.headers or {}).get("Retry-After"))
+                if self.controller is not None:
+                    self.controller.record_congestion(retry_after)
+                if attempt >= self.retries:
+                    raise
+            finally:
+                if self.controller is not None:
+                    self.controller.release()
+            await asyncio.sleep(retry_after or self.backoff_factor * (2**attempt))
+        raise RuntimeError(f"续传失败，已达最大重试次数: {url}")
+
+    def update_cookies(self, cookies):
+        """[线程安全] 用新的 Cookie 替换会话中的 Cookie (重新登录后调用)"""
+
+        async def _update():
+            self.session.cookie_jar.clear()
+            self.session.cookie_jar.update_cookies(cookies)
+
+        self.run(_update()).result()
+
+    async def head(self, url, headers=None):
+        """发送 HEAD 请求，返回 (状态码, 响应头)"""
+        async with self.session.head(
+            url, headers=headers or {}, allow_redirects=True
+        ) as response:
+            return response.status, response.headers
+
+    def close(self):
+        """关闭会话并停止事件循环"""
+        if self.loop is None:
+            return
+        if self.session is not None:
+            self.run(self.session.close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self.loop = None
+
+
+class RateLimiter:
+    """
+    线程安全、兼容 asyncio 的按主机令牌桶限速器。
+
+    每个主机一个令牌桶，以 rate 个/秒的速度补充令牌，最多积累 burst 个。
+    获取令牌时先在锁内“预约”(令牌数可以为负，表示排队)，再在锁外等待，
+    因此多个线程/协程同时请求时总速率被严格限制在 rate 以内。
+    host_limits 可为个别主机单独指定 {host: (rate, burst)}。
+    """
+
+    def __init__(self, rate, burst=1, host_limits=None):
+        self.rate = rate
+        self.burst = burst
+        self.host_limits = host_limits or {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _reserve(self, url):
+        """预约一个令牌，返回需要等待的秒数"""
+        host = urlparse(url).netloc or url
+        rate, burst = self.host_limits.get(host, (self.rate, self.burst))
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self._buckets.get(host, (float(burst), now))
+            tokens = min(float(burst), tokens + (now - last) * rate) - 1
+            self._buckets[host] = (tokens, now)
+        return 0.0 if tokens >= 0 else -tokens / rate
+
+    def acquire(self, url):
+        """[线程] 阻塞直到可以向 url 所在主机发起请求"""
+        wait = self._reserve(url)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, url):
+        """[协程] acquire 的异步版本，等待期间不阻塞事件循环"""
+        wait = self._reserve(url)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class ThrottledRetry(Retry):
+    """
+    urllib3 在内部重试时不会经过调用方的限速。设置 throttle(url) 后 (通常为
+    ThermoMastoCrawler._throttle)，每次重试的请求发出前都会调用它，重试同样消耗令牌。
+    """
+
+    DEFAULT_PORTS = {"http": 80, "https": 443}
+
+    def __init__(self, *args, throttle=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.throttle = throttle
+        self._retry_url = None
+
+    def new(self, **kw):
+        kw.setdefault("throttle", self.throttle)
+        return super().new(**kw)
+
+    def increment(
+        self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None
+    ):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        if _pool is not None:
+            # 与请求 URL 的 netloc 保持一致，限速器按主机取同一个令牌桶
+            netloc = _pool.host
+            if _pool.port and _pool.port != self.DEFAULT_PORTS.get(_pool.scheme):
+                netloc = f"{netloc}:{_pool.port}"
+            retry._retry_url = f"{_pool.scheme}://{netloc}{url or ''}"
+        return retry
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.throttle is not None and self._retry_url is not None:
+            self.throttle(self._retry_url)
+
+
+# 下载任务类别的默认优先级 (数值越小越先下载)
+DEFAULT_DOWNLOAD_PRIORITIES = {
+    "thermal_matrix": 0,
+    "patient_image": 1,
+    "gallery": 2,
+}
+
+
+class PriorityDownloadScheduler:
+    """
+    按优先级向下载线程池 (或异步引擎) 派发任务的调度器。
+
+    线程池与异步引擎内部都是先进先出，直接提交时先发现的图片库图片会排在
+    后发现的患者热矩阵之前。调度器自行维护 (优先级, 提交序号) 优先队列，
+    同时在途的任务不超过 window 个，任务结束后再派发当前优先级最高的任务，
+    因此下游队列始终为空、优先级总能生效；同一优先级内保持提交顺序。
+
+    launch(fn, *args) 负责真正启动任务并返回 concurrent.futures.Future。
+    max_pending > 0 时限制尚未派发的任务数: 积压已满时 submit() 阻塞提交方，
+    但积压中有优先级更低的任务时不阻塞，高优先级任务不会被低优先级的积压拖住。
+    """
+
+    def __init__(self, launch, window, max_pending=0, metrics=None):
+        self.launch = launch
+        self.window = max(1, window)
+        self.max_pending = max_pending
+        self.metrics = metrics
+        self._heap = []
+        self._seq = 0
+        self._active = 0
+        self._pending_counts = {}  # 优先级 -> 尚未派发的任务数
+        self._cond = threading.Condition()
+        self.cancelled = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # 正常结束时队列已空；异常退出时取消未派发的任务，不再启动新的下载
+        self.cancel_pending()
+
+    def _has_lower_pending(self, priority):
+        return any(p > priority and n for p, n in self._pending_counts.items())
+
+    def submit(self, priority, fn, *args):
+        """[线程安全] 按优先级排队，返回任务的 Future"""
+        future = concurrent.futures.Future()
+        with self._cond:
+            if self.max_pending > 0 and len(self._heap) >= self.max_pending:
+                start = time.perf_counter()
+                while len(self._heap) >= self.max_pending and not self._has_lower_pending(
+                    priority
+                ):
+                    self._cond.wait()
+                if self.metrics is not None:
+                    self.metrics.observe("download_slot_wait", time.perf_counter() - start)
+            heapq.heappush(self._heap, (priority, self._seq, future, fn, args))
+            self._seq += 1
+            self._pending_counts[priority] = self._pending_counts.get(priority, 0) + 1
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        """在窗口允许的范围内派发优先级最高的任务"""
+        while True:
+            with self._cond:
+                if self._active >= self.window or not self._heap:
+                    return
+                priority, _, future, fn, args = heapq.heappop(self._heap)
+                self._pending_counts[priority] -= 1
+                self._active += 1
+                self._cond.notify_all()
+            if not future.set_running_or_notify_cancel():
+                self._release()
+                continue
+            try:
+                inner = self.launch(fn, *args)
+            except Exception as e:
+                future.set_exception(e)
+                self._release()
+                continue
+            inner.add_done_callback(lambda f, outer=future: self._finish(outer, f))
+
+    def _release(self):
+        with self._cond:
+            self._active -= 1
+
+    def _finish(self, outer, inner):
+        """[回调] 转交任务结果并派发下一个任务"""
+        self._release()
+        try:
+            outer.set_result(inner.result())
+        except concurrent.futures.CancelledError:
+            outer.cancel()
+        except Exception as e:
+            outer.set_exception(e)
+        self._dispatch()
+
+    def cancel_pending(self):
+        """取消所有尚未派发的任务 (运行中断时调用)，返回取消的数量"""
+        with self._cond:
+            pending, self._heap = self._heap, []
+            self._pending_counts.clear()
+            self._cond.notify_all()
+        for item in pending:
+            item[2].cancel()
+        self.cancelled += len(pending)
+        return len(pending)
+
+
+class CrawlMetrics:
+    """
+    线程安全的运行指标 (run() 的返回值)。
+
+    - 阶段耗时: observe(stage, seconds) 或 with timer(stage)，每个阶段记录次数、总耗时、
+      最大值、Prometheus 直方图分桶，以及用于估算 p50/p99 的固定大小蓄水池样本
+    - 计数器: inc(name, value)，如下载字节数、各状态的文件数
+    - snapshot() 返回可 JSON 序列化的字典；to_prometheus() / write_prometheus()
+      输出 Prometheus 文本格式；serve() 在本地开启 /metrics HTTP 端点
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    RESERVOIR_SIZE = 2048
+    PREFIX = "thermomasto"
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+        self._http_server = None
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            data = self._stages.get(stage)
+            if data is None:
+                data = self._stages[stage] = {
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "buckets": [0] * len(self.BUCKETS),
+                    "samples": [],
+                }
+            data["count"] += 1
+            data["total"] += seconds
+            data["max"] = max(data["max"], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    data["buckets"][i] += 1
+                    break
+            # 蓄水池抽样: 样本数固定，内存不随请求数增长
+            samples = data["samples"]
+            if len(samples) < self.RESERVOIR_SIZE:
+                samples.append(seconds)
+            else:
+                j = self._rng.randrange(data["count"])
+                if j < self.RESERVOIR_SIZE:
+                    samples[j] = seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """记录 with 块的耗时 (块内抛出异常时同样记录)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    @staticmethod
+    def _quantile(samples, q):
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stage(self, name):
+        """返回某个阶段的统计 (未记录时返回 None)"""
+        with self._lock:
+            data = self._stages.get(name)
+            if data is None:
+                return None
+            samples = list(data["samples"])
+            count, total, maximum = data["count"], data["total"], data["max"]
+        return {
+            "count": count,
+            "total_s": round(total, 6),
+            "mean_s": round(total / count, 6),
+            "max_s": round(maximum, 6),
+            "p50_s": round(self._quantile(samples, 0.5), 6),
+            "p99_s": round(self._quantile(samples, 0.99), 6),
+        }
+
+    def snapshot(self):
+        """返回全部指标的字典，便于记录或 JSON 序列化"""
+        with self._lock:
+            stage_names = sorted(self._stages)
+            counters = dict(sorted(self._counters.items()))
+        elapsed = self.elapsed
+        download = self.stage("download")
+        downloaded_mb = counters.get("download_bytes", 0) / 1024 / 1024
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "counters": counters,
+            "stages": {name: self.stage(name) for name in stage_names},
+            # 总体吞吐 (按运行时长) 与单个下载流的平均吞吐 (按下载耗时之和)
+            "download_mb_per_s": round(downloaded_mb / elapsed, 3) if elapsed else None,
+            "per_download_mb_per_s": (
+                round(downloaded_mb / download["total_s"], 3)
+                if download and download["total_s"]
+                else None
+            ),
+        }
+
+    def summary_lines(self):
+        """逐阶段的简要统计，用于运行结束时输出日志"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, data in snapshot["stages"].items():
+            lines.append(
+                f"{name}: {data['count']} 次, 合计 {data['total_s']:.2f}s, "
+                f"p50 {data['p50_s'] * 1000:.1f}ms, p99 {data['p99_s'] * 1000:.1f}ms, "
+                f"最大 {data['max_s'] * 1000:.1f}ms"
+            )
+        if snapshot["counters"]:
+            lines.append(
+                ", ".join(f"{k}={v}" for k, v in snapshot["counters"].items())
+            )
+        if snapshot["download_mb_per_s"] is not None:
+            lines.append(
+                f"下载吞吐: {snapshot['download_mb_per_s']:.2f} MB/s (总体)"
+                + (
+                    f", {snapshot['per_download_mb_per_s']:.2f} MB/s (单个下载平均)"
+                    if snapshot["per_download_mb_per_s"] is not None
+                    else ""
+                )
+            )
+        return lines
+
+    def to_prometheus(self):
+        """输出 Prometheus 文本格式 (text/plain; version=0.0.4)"""
+        prefix = self.PREFIX
+        with self._lock:
+            stages = {
+                name: (data["count"], data["total"], list(data["buckets"]))
+                for name, data in sorted(self._stages.items())
+            }
+            counters = dict(sorted(self._counters.items()))
+        lines = [
+            f"# HELP {prefix}_run_elapsed_seconds 本次运行已耗时",
+            f"# TYPE {prefix}_run_elapsed_seconds gauge",
+            f"{prefix}_run_elapsed_seconds {self.elapsed:.3f}",
+        ]
+        if stages:
+            name = f"{prefix}_stage_seconds"
+            lines += [f"# HELP {name} 各阶段耗时", f"# TYPE {name} histogram"]
+            for stage, (count, total, buckets) in stages.items():
+                cumulative = 0
+                for bound, n in zip(self.BUCKETS, buckets):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {total:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+        for counter, value in counters.items():
+            name = f"{prefix}_{counter}_total"
+            lines += [f"# TYPE {name} counter", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """原子写入 Prometheus 文本文件 (可供 node_exporter 的 textfile collector 读取)"""
+        tmp_path = path + PART_SUFFIX
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """在后台线程中开启 http://host:port/metrics 端点"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._http_server = ThreadingHTTPServer((host, port), Handler)
+        self._http_server.daemon_threads = True
+        threading.Thread(
+            target=self._http_server.serve_forever, name="metrics-http", daemon=True
+        ).start()
+        return self._http_server.server_address[1]
+
+    def stop_serving(self):
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+
+
+def parse_thermal_matrix(path, dtype=np.float32):
+    """
+    将 .txt 热矩阵 (每行一行温度值，空格或分号分隔) 解析为二维 NumPy 数组。
+    各行长度不一致或矩阵为空时抛出 ValueError。
+    """
+    with open(path, encoding="ascii") as f:
+        text = f.read().replace(";", " ")
+    if not text.strip():
+        raise ValueError(f"热矩阵为空: {path}")
+    return np.loadtxt(io.StringIO(text), dtype=dtype, ndmin=2)
+
+
+def load_thermal_matrix(path, mmap=True):
+    """加载 .npy 热矩阵；mmap=True (默认) 时以只读内存映射方式打开，不会整体读入内存"""
+    return np.load(path, mmap_mode="r" if mmap else None)
+
+
+def open_thermal_store(path):
+    """
+    以只读方式打开 HDF5 (.h5/.hdf5) 或 Zarr 热矩阵库。
+    store[患者ID][文件名] 返回按块惰性读取的数组，切片时才读取对应数据。
+    """
+    if path.endswith((".h5", ".hdf5")):
+        import h5py
+
+        return h5py.File(path, "r")
+    import zarr
+
+    return zarr.open_group(path, mode="r")
+
+
+class ThermalMatrixConverter:
+    """
+    下载后的热矩阵转换阶段: 在后台线程中将 .txt 热矩阵解析为 float32 数组并保存为
+    - "npy":  output_path/<患者ID>/<文件名>.npy (可内存映射)
+    - "hdf5": output_path 单个 HDF5 文件，数据集 /<患者ID>/<文件名> (按块存储)
+    - "zarr": output_path Zarr 目录，数组 <患者ID>/<文件名> (按块存储)
+    下载线程只需 submit() 入队；HDF5/Zarr 只由转换线程写入，无需额外加锁。
+    已转换且源文件 (大小与修改时间) 未变化的矩阵会被跳过，重复运行不会重复转换。
+    """
+
+    FORMATS = ("npy", "hdf5", "zarr")
+    _STOP = object()
+
+    def __init__(self, fmt, output_path, metrics=None):
+        if fmt not in self.FORMATS:
+            raise ValueError(f"未知的热矩阵格式: {fmt}")
+        self.fmt = fmt
+        self.output_path = output_path
+        self.metrics = metrics
+        self.converted = 0
+        self.skipped = 0
+        self.errors = []
+        self._store = None
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self.fmt == "npy":
+            os.makedirs(self.output_path, exist_ok=True)
+        elif self.fmt == "hdf5":
+            import h5py
+
+            self._store = h5py.File(self.output_path, "a")
+        else:
+            import zarr
+
+            self._store = zarr.open_group(self.output_path, mode="a")
+        self._thread = threading.Thread(
+            target=self._run, name="thermal-converter", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, txt_path, patient_id):
+        self._queue.put((txt_path, str(patient_id)))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            txt_path, patient_id = item
+            try:
+                started = time.perf_counter()
+                if self._convert(txt_path, patient_id):
+                    self.converted += 1
+                    if self.metrics is not None:
+                        self.metrics.observe(
+                            "thermal_convert", time.perf_counter() - started
+                        )
+                else:
+                    self.skipped += 1
+            except Exception as e:
+                self.errors.append(f"热矩阵转换失败: {txt_path} | {e}")
+
+    def _convert(self, txt_path, patient_id):
+        """转换单个文件；输出已是最新时返回 False"""
+        name = os.path.splitext(os.path.basename(txt_path))[0]
+        source = os.stat(txt_path)
+
+        if self.fmt == "npy":
+            out_dir = os.path.join(self.output_path, patient_id)
+            out_path = os.path.join(out_dir, name + ".npy")
+            if (
+                os.path.exists(out_path)
+                and os.path.getmtime(out_path) >= os.path.getmtime(txt_path)
+            ):
+                return False
+            matrix = parse_thermal_matrix(txt_path)
+            os.makedirs(out_dir, exist_ok=True)
+            tmp_path = out_path + PART_SUFFIX
+            with open(tmp_path, "wb") as f:
+                np.save(f, matrix)
+            os.replace(tmp_path, out_path)
+            return True
+
+        # 与 npy 一样比较修改时间: 重新下载的源文件大小可能不变
+        group = self._store.require_group(patient_id)
+        if name in group:
+            attrs = group[name].attrs
+            if (
+                attrs.get("source_size") == source.st_size
+                and attrs.get("source_mtime_ns") == source.st_mtime_ns
+            ):
+                return False
+        matrix = parse_thermal_matrix(txt_path)
+        if name in group:
+            del group[name]
+        if self.fmt == "hdf5":
+            dataset = group.create_dataset(name, data=matrix, chunks=True)
+        else:
+            # zarr 3 使用 create_array，zarr 2 使用 create_dataset
+            create = getattr(group, "create_array", None) or group.create_dataset
+            dataset = create(
+                name, shape=matrix.shape, dtype=matrix.dtype, chunks=(120, 160)
+            )
+            dataset[...] = matrix
+        dataset.attrs["source_file"] = os.path.basename(txt_path)
+        dataset.attrs["source_size"] = source.st_size
+        dataset.attrs["source_mtime_ns"] = source.st_mtime_ns
+        return True
+
+    def close(self):
+        """处理完队列中剩余的文件后关闭"""
+        if self._thread is not None:
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+        if self.fmt == "hdf5" and self._store is not None:
+            self._store.close()
+        self._store = None
+
+
+THUMBNAIL_DIR = "thumbnails"  # 缩略图保存在图片所在目录下的该子目录中
+
+
+def process_image(path, thumbnail_path=None, thumbnail_size=256):
+    """
+    [进程池工作函数] 完整解码图片以校验其有效性，返回
+    {'valid', 'format', 'width', 'height', 'mode', 'thumbnail', 'error', 'elapsed_s'}。
+    thumbnail_path 不为 None 时生成长边不超过 thumbnail_size 的 JPEG 缩略图；
+    缩略图已存在且不早于原图时只读取图片头部，不再重复解码。
+    """
+    from PIL import Image
+
+    started = time.perf_counter()
+    result = {
+        "valid": False,
+        "format": None,
+        "width": None,
+        "height": None,
+        "mode": None,
+        "thumbnail": None,
+        "error": None,
+    }
+    try:
+        up_to_date = (
+            thumbnail_path is not None
+            and os.path.exists(thumbnail_path)
+            and os.path.getmtime(thumbnail_path) >= os.path.getmtime(path)
+        )
+        with Image.open(path) as img:
+            result.update(
+                format=img.format, width=img.width, height=img.height, mode=img.mode
+            )
+            if not up_to_date:
+                img.load()  # 截断或损坏的文件在完整解码时才会报错
+                if thumbnail_path is not None:
+                    thumb = img.copy() if img.mode in ("RGB", "L") else img.convert("RGB")
+                    thumb.thumbnail((thumbnail_size, thumbnail_size))
+                    os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+                    tmp_path = thumbnail_path + PART_SUFFIX
+                    thumb.save(tmp_path, "JPEG", quality=85)
+                    os.replace(tmp_path, thumbnail_path)
+        result["valid"] = True
+        result["thumbnail"] = thumbnail_path
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["elapsed_s"] = round(time.perf_counter() - started, 4)
+    return result
+
+
+class ImagePostProcessor:
+    """
+    下载后的图片处理阶段: 在进程池中解码校验图片、提取格式与尺寸并生成缩略图，
+    与下载并行进行。解码是 CPU 密集型任务，放在独立进程中不会与下载线程争抢 GIL。
+    每张图片的结果逐行写入 index_path (JSON Lines)；无法解码的文件
+    (损坏或服务器返回的 HTML 错误页) 交给 on_invalid(task_type, identifier, url, path, error) 处理。
+    """
+
+    def __init__(
+        self, workers, index_path, thumbnail_size=256, metrics=None, on_invalid=None
+    ):
+        self.workers = workers
+        self.index_path = index_path
+        self.thumbnail_size = thumbnail_size
+        self.metrics = metrics
+        self.on_invalid = on_invalid
+        self.valid = 0
+        self.invalid = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        self._executor = None
+        self._index = None
+
+    def start(self):
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        self._index = open(self.index_path, "w", encoding="utf-8")
+        # 爬虫运行时已有多个线程，使用 spawn 避免 fork 复制持有中的锁
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        # 立即启动全部工作进程 (否则在首次提交时才启动)，使其导入开销与爬取重叠
+        for _ in range(self.workers):
+            self._executor.submit(os.getpid)
+
+    def submit(self, task_type, identifier, url, path):
+        thumbnail_path = None
+        if self.thumbnail_size:
+            name = os.path.splitext(os.path.basename(path))[0] + ".jpg"
+            thumbnail_path = os.path.join(os.path.dirname(path), THUMBNAIL_DIR, name)
+        future = self._executor.submit(
+            process_image, path, thumbnail_path, self.thumbnail_size
+        )
+        future.add_done_callback(
+            lambda f: self._done(task_type, identifier, url, path, f)
+        )
+
+    def _done(self, task_type, identifier, url, path, future):
+        """[回调，在进程池的管理线程中执行] 记录结果"""
+        try:
+            result = future.result()
+        except Exception as e:
+            # 工作进程异常退出等，不代表图片本身无效
+            with self._lock:
+                self.errors.append(f"图片处理失败: {path} | {e}")
+            return
+        record = {
+            "task_type": task_type,
+            "identifier": identifier,
+            "file_name": os.path.basename(path),
+            "path": path,
+            "url": url,
+            **result,
+        }
+        with self._lock:
+            self._index.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if result["valid"]:
+                self.valid += 1
+            else:
+                self.invalid += 1
+        if self.metrics is not None:
+            self.metrics.observe("image_process", result["elapsed_s"])
+            self.metrics.inc("images_valid" if result["valid"] else "images_invalid")
+        if not result["valid"] and self.on_invalid is not None:
+            self.on_invalid(task_type, identifier, url, path, result["error"])
+
+    def close(self):
+        """等待已提交的图片处理完成后关闭进程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+
+EXPORT_INDEX = "index.jsonl"
+
+
+def _export_field(file_name):
+    """
+    将文件名转换为分片成员的字段名。WebDataset 以成员名中第一个 "." 之前的部分
+    作为样本键，因此文件名主干中的 "." 等字符统一替换为 "_"，只保留扩展名
+    """
+    stem, ext = os.path.splitext(file_name)
+    return re.sub(r"[^\w-]", "_", stem) + ext.lower()
+
+
+class _ShardWriter:
+    """按大小/样本数轮换的 tar 分片写入器，记录每个成员数据在分片中的偏移量"""
+
+    def __init__(self, output_dir, prefix, max_bytes, max_samples, index_file):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_samples = max_samples
+        self.index_file = index_file
+        self.shards = []
+        self.samples = 0
+        self._tar = None
+        self._shard_name = None
+        self._shard_samples = 0
+
+    def _open(self):
+        self._shard_name = f"{self.prefix}-{len(self.shards):06d}.tar"
+        self._part_path = os.path.join(self.output_dir, self._shard_name + PART_SUFFIX)
+        self._tar = tarfile.open(self._part_path, "w", format=tarfile.PAX_FORMAT)
+        self._shard_samples = 0
+
+    def write_sample(self, key, members):
+        """members: [(字段名, 文件路径或 bytes)]，同一样本的成员总在同一分片中"""
+        if self._tar is not None and (
+            self._tar.offset >= self.max_bytes
+            or (self.max_samples and self._shard_samples >= self.max_samples)
+        ):
+            self._finish_shard()
+        if self._tar is None:
+            self._open()
+        for field, source in members:
+            info = tarfile.TarInfo(f"{key}.{field}")
+            info.mtime = int(time.time())
+            if isinstance(source, bytes):
+                info.size = len(source)
+                self._tar.addfile(info, io.BytesIO(source))
+            else:
+                info.size = os.path.getsize(source)
+                info.mtime = int(os.path.getmtime(source))
+                with open(source, "rb") as f:
+                    self._tar.addfile(info, f)
+        self._shard_samples += 1
+        self.samples += 1
+
+    def _finish_shard(self):
+        self._tar.close()
+        self._tar = None
+        shard_path = os.path.join(self.output_dir, self._shard_name)
+        os.replace(self._part_path, shard_path)
+        # 重新读取分片头部获得各成员数据的精确偏移量 (tarfile 会跳过数据区，只读头部)
+        with tarfile.open(shard_path, "r") as tar:
+            for info in tar:
+                key, field = info.name.split(".", 1)
+                self.index_file.write(
+                    json.dumps(
+                        {
+                            "key": key,
+                            "field": field,
+                            "shard": self._shard_name,
+                            "offset": info.offset_data,
+                            "size": info.size,
+                        },
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                )
+        self.shards.append(self._shard_name)
+
+    def close(self):
+        if self._tar is not None:
+            self._finish_shard()
+
+
+def export_dataset(
+    patient_dir,
+    output_dir,
+    gallery_dir=None,
+    shard_max_bytes=1 << 30,
+    shard_max_samples=None,
+    include_text_matrices=True,
+):
+    """
+    将爬取结果打包为按分片存储、带偏移索引的数据集 (WebDataset 风格的 tar 分片):
+
+    - patients-XXXXXX.tar: 每位患者一个样本，键为 patient_<ID>，包含
+      <键>.json (患者元数据，即详情页提取结果与列表信息) 以及该患者的图片、
+      .txt 热矩阵和 (若已转换) thermal_npy/ 下的 .npy 矩阵
+    - gallery-XXXXXX.tar: 图片库中每张图片一个样本 (仅设置 gallery_dir 时；
+      跳过未完成的 .part 与校验失败的 .invalid 文件)
+    - index.jsonl: 每个成员一行 {key, field, shard, offset, size}，
+      可不解包直接按偏移读取或内存映射 (见 ExportedDataset)
+    - manifest.json: 分片列表与样本数
+
+    患者元数据从 patient_dir/all_patients_metadata.jsonl 逐行读取，不会整体载入内存。
+    返回 manifest 字典。
+    """
+    jsonl_path = os.path.join(patient_dir, "all_patients_metadata.jsonl")
+    folders = {
+        "image": os.path.join(patient_dir, "images"),
+        "thermal_matrix": os.path.join(patient_dir, "thermal_matrix"),
+    }
+    npy_dir = os.path.join(patient_dir, "thermal_npy")
+    os.makedirs(output_dir, exist_ok=True)
+
+    index_path = os.path.join(output_dir, EXPORT_INDEX)
+    missing = 0
+    with open(index_path + PART_SUFFIX, "w", encoding="utf-8") as index_file:
+        writer = _ShardWriter(
+            output_dir, "patients", shard_max_bytes, shard_max_samples, index_file
+        )
+        with open(jsonl_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                patient = json.loads(line)
+                patient_id = str(patient.get("id") or patient.get("ID"))
+                members = [
+                    (
+                        "json",
+                        json.dumps(patient, ensure_ascii=False, default=str).encode(
+                            "utf-8"
+                        ),
+                    )
+                ]
+                for file_info in patient.get("files", []):
+                    if file_info["type"] not in folders:
+                        continue
+                    if file_info["type"] == "thermal_matrix" and not include_text_matrices:
+                        continue
+                    path = os.path.join(
+                        folders[file_info["type"]], file_info["file_name"]
+                    )
+                    if not os.path.exists(path):
+                        missing += 1
+                        continue
+                    members.append((_export_field(file_info["file_name"]), path))
+                    if file_info["type"] == "thermal_matrix":
+                        stem = os.path.splitext(file_info["file_name"])[0]
+                        npy_path = os.path.join(npy_dir, patient_id, stem + ".npy")
+                        if os.path.exists(npy_path):
+                            members.append((_export_field(stem + ".npy"), npy_path))
+                writer.write_sample(f"patient_{patient_id}", members)
+        writer.close()
+        shards = {"patients": writer.shards}
+        samples = {"patients": writer.samples}
+
+        if gallery_dir:
+            writer = _ShardWriter(
+                output_dir, "gallery", shard_max_bytes, shard_max_samples, index_file
+            )
+            for entry in sorted(os.scandir(gallery_dir), key=lambda e: e.name):
+                if not entry.is_file() or not _is_finished_file(entry.name):
+                    continue
+                field = _export_field(entry.name)
+                key, ext = field.rsplit(".", 1) if "." in field else (field, "bin")
+                writer.write_sample(f"gallery_{key}", [(ext, entry.path)])
+            writer.close()
+            shards["gallery"] = writer.shards
+            samples["gallery"] = writer.samples
+    os.replace(index_path + PART_SUFFIX, index_path)
+
+    manifest = {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "index": EXPORT_INDEX,
+        "shards": shards,
+        "samples": samples,
+        "missing_files": missing,
+    }
+    with open(os.path.join(output_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+class ExportedDataset:
+    """
+    读取 export_dataset() 的输出。按索引中的偏移量直接从 tar 分片读取成员，
+    分片以 mmap 打开，读取时只触及所需的页；.npy 成员可直接返回内存映射数组。
+
+    用法:
+        ds = ExportedDataset("export")
+        meta = json.loads(ds.read("patient_231", "json"))
+        matrix = ds.load_array("patient_231", "T0231_1_1_1_frontal.npy")
+    """
+
+    def __init__(self, export_dir):
+        self.export_dir = export_dir
+        self._index = {}
+        with open(os.path.join(export_dir, EXPORT_INDEX), encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                self._index.setdefault(entry["key"], {})[entry["field"]] = entry
+        self._maps = {}
+
+    def keys(self):
+        return list(self._index)
+
+    def fields(self, key):
+        return list(self._index[key])
+
+    def _mmap(self, shard):
+        mapped = self._maps.get(shard)
+        if mapped is None:
+            with open(os.path.join(self.export_dir, shard), "rb") as f:
+                mapped = self._maps[shard] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        return mapped
+
+    def read(self, key, field):
+        """返回成员内容的只读 memoryview (不复制数据)"""
+        entry = self._index[key][field]
+        start = entry["offset"]
+        return memoryview(self._mmap(entry["shard"]))[start:start + entry["size"]]
+
+    def load_array(self, key, field):
+        """以内存映射方式加载 .npy 成员"""
+        entry = self._index[key][field]
+        path = os.path.join(self.export_dir, entry["shard"])
+        with open(path, "rb") as f:
+            f.seek(entry["offset"])
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            data_offset = f.tell()
+        return np.memmap(
+            path,
+            dtype=dtype,
+            mode="r",
+            offset=data_offset,
+            shape=shape,
+            order="F" if fortran_order else "C",
+        )
+
+    def close(self):
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps = {}
+
+
+# 下载日志的列 (CSV 表头，以及 JSONL/Parquet 的字段)
+LOG_COLUMNS = [
+    "timestamp",
+    "task_type",
+    "identifier",
+    "file_name",
+    "status",
+    "size_kb",
+    "url",
+    "elapsed_s",
+    "error",
+]
+# 数值列，其余列均为字符串
+LOG_FLOAT_COLUMNS = ("size_kb", "elapsed_s")
+
+
+class DownloadLogWriter:
+    """
+    后台下载日志写入器。
+
+    下载线程只需将日志行放入队列，由单独的写入线程按批次 (batch_size 行)
+    或按时间间隔 (flush_interval 秒) 写盘，避免每行都加锁并打开/关闭文件。
+    CSV 始终写入；extra_sink 可额外输出 "jsonl" 或 "parquet" (需要 pyarrow) 便于分析。
+    """
+
+    _STOP = object()
+
+    def __init__(self, csv_path, batch_size=200, flush_interval=1.0, extra_sink=None):
+        self.csv_path = csv_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.extra_sink = extra_sink
+        self.errors = []  # 写入失败信息，由调用方决定如何输出
+        self._queue = queue.Queue()
+        self._thread = None
+        self._csv_file = None
+        self._jsonl_file = None
+        self._parquet_writer = None
+        self._parquet_path = None
+
+    def start(self):
+        self._csv_file = open(self.csv_path, "a", newline="", encoding="utf-8")
+        self._csv_writer = csv.writer(self._csv_file)
+        base = os.path.splitext(self.csv_path)[0]
+        if self.extra_sink == "jsonl":
+            self._jsonl_file = open(f"{base}.jsonl", "a", encoding="utf-8")
+        elif self.extra_sink == "parquet":
+            # Parquet 文件无法追加，每次运行写入一个带时间戳的新文件
+            self._parquet_path = f"{base}_{time.strftime('%Y%m%d_%H%M%S')}.parquet"
+        self._thread = threading.Thread(
+            target=self._run, name="download-log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, row):
+        """[线程安全] 提交一行日志 (dict，键为 LOG_COLUMNS)"""
+        self._queue.put(row)
+
+    def _run(self):
+        pending = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            timeout = (
+                max(0.0, deadline - time.monotonic())
+                if pending
+                else self.flush_interval
+            )
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is self._STOP:
+                break
+            if item is not None:
+                if not pending:
+                    deadline = time.monotonic() + self.flush_interval
+                pending.append(item)
+            if pending and (
+                len(pending) >= self.batch_size or time.monotonic() >= deadline
+            ):
+                self._flush(pending)
+                pending = []
+        self._flush(pending)
+
+    def _flush(self, rows):
+        if not rows:
+            return
+        try:
+            self._csv_writer.writerows(
+                [
+                    row["timestamp"],
+                    row["task_type"],
+                    row["identifier"],
+                    row["file_name"],
+                    row["status"],
+                    f"{row['size_kb']:.2f}",
+                    row["url"],
+                    f"{row['elapsed_s']:.3f}",
+                    row["error"],
+                ]
+                for row in rows
+            )
+            self._csv_file.flush()
+            if self._jsonl_file is not None:
+                self._jsonl_file.writelines(
+                    json.dumps(row, ensure_ascii=False) + "\n" for row in rows
+                )
+                self._jsonl_file.flush()
+            if self._parquet_path is not None:
+                self._write_parquet(rows)
+        except Exception as e:
+            self.errors.append(f"写入下载日志失败: {e}")
+
+    def _write_parquet(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # 显式指定 schema: 按首批数据推断时，全为 "exists" 的批次会把数值列推断为 int64，
+        # 之后的批次因 schema 不一致而写入失败
+        if self._parquet_writer is None:
+            schema = pa.schema(
+                [
+                    (name, pa.float64() if name in LOG_FLOAT_COLUMNS else pa.string())
+                    for name in LOG_COLUMNS
+                ]
+            )
+            self._parquet_writer = pq.ParquetWriter(self._parquet_path, schema)
+        rows = [
+            {
+                name: (
+                    value
+                    if value is None or name in LOG_FLOAT_COLUMNS
+                    else str(value)
+                )
+                for name, value in row.items()
+            }
+            for row in rows
+        ]
+        table = pa.Table.from_pylist(rows, schema=self._parquet_writer.schema)
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+        """写入剩余日志并关闭所有文件"""
+        if self._thread is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._thread = None
+        self._csv_file.close()
+        if self._jsonl_file is not None:
+            self._jsonl_file.close()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+class PatientMetadataStream:
+    """
+    以 JSON Lines 格式逐条写出患者元数据 (每行一个患者，写入后立即 flush)。
+
+    流水线中各详情线程完成的顺序不固定，write() 按患者在列表中的序号 (从 1 开始)
+    缓存乱序到达的记录，只按序写出，因此文件内容与串行爬取时的顺序一致；
+    未能提取的患者以 write(index, None) 占位。缓存的记录数只与并发的详情线程数相关。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._next_index = 1
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, index, patient_data):
+        with self._lock:
+            self._pending[index] = patient_data
+            while self._next_index in self._pending:
+                data = self._pending.pop(self._next_index)
+                self._next_index += 1
+                if data is None:
+                    continue
+                self._file.write(
+                    json.dumps(data, ensure_ascii=False, default=str) + "\n"
+                )
+                self.count += 1
+            self._file.flush()
+
+    def close(self):
+        """写出剩余的缓存记录 (跳过缺失的序号) 并关闭文件"""
+        with self._lock:
+            for index in sorted(self._pending):
+                data = self._pending[index]
+                if data is not None:
+                    self._file.write(
+                        json.dumps(data, ensure_ascii=False, default=str) + "\n"
+                    )
+                    self.count += 1
+            self._pending.clear()
+            self._file.close()
+
+
+class PatientCompletionTracker:
+    """
+    跟踪每位患者的文件下载进度。某位患者的全部文件 (含已存在的文件) 都结束后，
+    立即向 path 追加一行 JSON {id, files, failed, completed_at} 并调用 on_complete(record)，
+    无需等到整个爬取结束即可使用已完整的患者记录。
+    文件可能在提交过程中就已下载完成，因此提交完该患者的全部文件后需调用 seal()。
+    """
+
+    def __init__(self, path, on_complete=None):
+        self.path = path
+        self.on_complete = on_complete
+        self.completed = 0
+        self._patients = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    def start(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "w", encoding="utf-8")
+
+    def track(self, patient_id, future):
+        """[线程安全] 登记患者的一个文件；future 为 None 表示文件已存在"""
+        with self._lock:
+            entry = self._patients.setdefault(
+                patient_id, {"files": 0, "failed": 0, "pending": 0, "sealed": False}
+            )
+            entry["files"] += 1
+            if future is None:
+                return
+            entry["pending"] += 1
+        future.add_done_callback(lambda f: self._done(patient_id, f))
+
+    def seal(self, patient_id):
+        """[线程安全] 该患者的文件已全部登记"""
+        with self._lock:
+            entry = self._patients.setdefault(
+                patient_id, {"files": 0, "failed": 0, "pending": 0, "sealed": False}
+            )
+            entry["sealed"] = True
+            record = self._complete_locked(patient_id)
+        self._notify(record)
+
+    def _done(self, patient_id, future):
+        failed = future.cancelled() or future.exception() is not None or not future.result()
+        with self._lock:
+            entry = self._patients[patient_id]
+            entry["pending"] -= 1
+            entry["failed"] += int(failed)
+            record = self._complete_locked(patient_id)
+        self._notify(record)
+
+    def _complete_locked(self, patient_id):
+        entry = self._patients[patient_id]
+        if not entry["sealed"] or entry["pending"]:
+            return None
+        del self._patients[patient_id]
+        record = {
+            "id": patient_id,
+            "files": entry["files"],
+            "failed": entry["failed"],
+            "completed_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if self._file is not None:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+        self.completed += 1
+        return record
+
+    def _notify(self, record):
+        if record is not None and self.on_complete is not None:
+            self.on_complete(record)
+
+    @property
+    def incomplete(self):
+        """仍有文件未结束 (或尚未登记完) 的患者数"""
+        with self._lock:
+            return len(self._patients)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def compact_metadata_jsonl(jsonl_path, json_path):
+    """
+    将 JSON Lines 元数据压缩为 JSON 数组文件 (与 json.dump(..., indent=2) 的格式相同)。
+    逐行读取、逐条写出，不会把全部患者载入内存；先写临时文件再原子替换。
+    返回写出的记录数。
+    """
+    tmp_path = json_path + PART_SUFFIX
+    count = 0
+    with open(jsonl_path, encoding="utf-8") as src, open(
+        tmp_path, "w", encoding="utf-8"
+    ) as dst:
+        for line in src:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.dumps(json.loads(line), ensure_ascii=False, indent=2)
+            dst.write(",\n" if count else "[\n")
+            dst.write("\n".join("  " + part for part in item.split("\n")))
+            count += 1
+        dst.write("\n]" if count else "[]")
+    os.replace(tmp_path, json_path)
+    return count
+
+
+def parse_shard(text):
+    """解析 "i/N" 形式的分片编号 (i 从 0 开始)，返回 (i, N)；格式错误时抛出 ValueError"""
+    index, sep, count = str(text).partition("/")
+    if not sep or not index.strip().isdigit() or not count.strip().isdigit():
+        raise ValueError(f"分片格式应为 i/N (例如 0/4): {text}")
+    index, count = int(index), int(count)
+    if count < 1 or index >= count:
+        raise ValueError(f"分片编号超出范围 (0 <= i < N): {text}")
+    return index, count
+
+
+def shard_key(value):
+    """分片使用的整数键: 纯数字 (页码、患者 ID) 直接取值，其他字符串取 CRC32 (跨进程稳定)"""
+    text = str(value).strip()
+    return int(text) if text.isdigit() else zlib.crc32(text.encode("utf-8"))
+
+
+def shard_output_path(path, shard):
+    """
+    分片各自写入的输出文件路径: data.csv -> data.shard-1-of-4.csv。
+    shard 为 None 时原样返回。下载的图片与热矩阵互不重叠，直接写入共享目录。
+    """
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+
+def merge_shard_outputs(
+    shard_count,
+    patient_dir,
+    log_file="download_log_unified.csv",
+    image_index_file="image_metadata.jsonl",
+    compact=True,
+    allow_missing=False,
+):
+    """
+    合并 shard_count 个分片的输出，重新生成不带分片后缀的汇总文件 (先写临时文件再原子替换):
+
+    - 下载日志 CSV: 按分片顺序拼接 (各分片日志均为追加写入，包含历次运行的记录)
+    - patient_dir/all_patients_metadata.jsonl: 按患者在完整列表中的位置归并各分片的记录
+      (与不分片时的顺序一致)，compact 为 True 时再生成 all_patients_metadata.json
+    - 图片校验索引与 patient_dir/patients_complete.jsonl (JSON Lines): 按分片顺序拼接
+
+    每个分片都必须有下载日志；其余文件只要有一个分片写出，就要求所有分片都有。
+    写入任何文件之前先检查，缺少分片文件时抛出 FileNotFoundError，已有的汇总文件保持不变；
+    allow_missing 为 True 时跳过缺失的分片文件 (没有任何分片文件的汇总文件不会被覆盖)。
+    返回 {文件路径: 记录数, "missing": [缺失的分片文件]}。
+    """
+    shards = [(i, shard_count) for i in range(shard_count)]
+    jsonl_path = os.path.join(patient_dir, "all_patients_metadata.jsonl")
+    complete_path = os.path.join(patient_dir, "patients_complete.jsonl")
+
+    inputs = {}
+    missing = []
+    for target in (log_file, jsonl_path, image_index_file, complete_path):
+        paths = [shard_output_path(target, shard) for shard in shards]
+        present = [path for path in paths if os.path.exists(path)]
+        if target == log_file or present:
+            missing.extend(path for path in paths if path not in present)
+        inputs[target] = present
+    if missing and not allow_missing:
+        raise FileNotFoundError(
+            "缺少分片输出，未写入任何汇总文件: " + ", ".join(missing)
+        )
+    summary = {"missing": missing}
+
+    # 下载日志
+    if inputs[log_file]:
+        count = 0
+        tmp_path = log_file + PART_SUFFIX
+        with open(tmp_path, "w", newline="", encoding="utf-8") as dst:
+            writer = csv.writer(dst)
+            writer.writerow(LOG_COLUMNS)
+            for path in inputs[log_file]:
+                with open(path, newline="", encoding="utf-8") as src:
+                    reader = csv.reader(src)
+                    next(reader, None)  # 表头
+                    for row in reader:
+                        writer.writerow(row)
+                        count += 1
+        os.replace(tmp_path, log_file)
+        summary[log_file] = count
+
+    # 患者元数据: 各分片文件已按列表顺序写出，归并时不必整体载入内存。
+    # 位置字段缺失 (旧版本写出的分片) 时退回到患者 ID，此时各分片文件需自行有序
+    def records(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    data = json.loads(line)
+                    position = data.pop(SHARD_POSITION_FIELD, None)
+                    if position is None:
+                        position = shard_key(data.get("ID", ""))
+                    line = json.dumps(data, ensure_ascii=False, default=str) + "\n"
+                    yield (data.get("page") or 0, position), line
+
+    if inputs[jsonl_path]:
+        count = 0
+        tmp_path = jsonl_path + PART_SUFFIX
+        with open(tmp_path, "w", encoding="utf-8") as dst:
+            merged = heapq.merge(
+                *(records(path) for path in inputs[jsonl_path]), key=lambda r: r[0]
+            )
+            for _, line in merged:
+                dst.write(line)
+                count += 1
+        os.replace(tmp_path, jsonl_path)
+        summary[jsonl_path] = count
+        if compact:
+            json_path = os.path.join(patient_dir, "all_patients_metadata.json")
+            summary[json_path] = compact_metadata_jsonl(jsonl_path, json_path)
+
+    # 图片校验索引 (仅在分片启用了图片校验时存在) 与患者完成记录
+    for target in (image_index_file, complete_path):
+        if not inputs[target]:
+            continue
+        count = 0
+        tmp_path = target + PART_SUFFIX
+        with open(tmp_path, "w", encoding="utf-8") as dst:
+            for path in inputs[target]:
+                with open(path, encoding="utf-8") as src:
+                    for line in src:
+                        if line.strip():
+                            dst.write(line if line.endswith("\n") else line + "\n")
+                            count += 1
+        os.replace(tmp_path, target)
+        summary[target] = count
+    return summary
+
+
+class ExistingFileIndex:
+    """
+    启动时一次性扫描下载目录得到的 {目录: {文件名: 大小}} 索引。
+    续传时已存在的文件在提交下载前即被过滤，不必逐个文件 exists/getsize；
+    在网络文件系统上，一次 scandir 读取整个目录远快于逐个 stat。
+    未扫描过的目录 size() 返回 NOT_INDEXED，由调用方自行 stat。
+    """
+
+    NOT_INDEXED = object()
+
+    def __init__(self):
+        self._dirs = {}
+
+    def scan(self, directory):
+        """扫描目录 (不递归，忽略 .part 临时文件与 .invalid 文件)，返回其中的文件数"""
+        files = {}
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not _is_finished_file(entry.name):
+                        continue
+                    try:
+                        if entry.is_file():
+                            files[entry.name] = entry.stat().st_size
+                    except OSError:
+                        continue  # 扫描期间被删除
+        except FileNotFoundError:
+            pass
+        self._dirs[os.path.normpath(directory)] = files
+        return len(files)
+
+    def size(self, path):
+        """返回索引中的文件大小；文件不存在时返回 None"""
+        files = self._dirs.get(os.path.normpath(os.path.dirname(path)))
+        if files is None:
+            return self.NOT_INDEXED
+        return files.get(os.path.basename(path))
+
+    def discard(self, path):
+        files = self._dirs.get(os.path.normpath(os.path.dirname(path)))
+        if files is not None:
+            files.pop(os.path.basename(path), None)
+
+
+class CrawlStateStore:
+    """
+    基于 SQLite 的持久化爬取状态库，用于增量重爬。
+
+    记录内容:
+    - patients: 患者列表行的哈希与已提取的详情，列表行未变化的患者无需再次访问详情页
+    - gallery_pages: 每个图片库页面包含的图片 URL
+    - files: 每个文件 URL 的保存路径、大小、ETag/Last-Modified 与 SHA-256
+    所有方法均线程安全，可在下载线程与异步事件循环中直接调用。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS patients (
+                    patient_key TEXT PRIMARY KEY,
+                    detail_url TEXT,
+                    row_hash TEXT,
+                    details_json TEXT,
+                    first_seen TEXT,
+                    last_scraped TEXT
+                );
+                CREATE TABLE IF NOT EXISTS gallery_pages (
+                    page_num INTEGER PRIMARY KEY,
+                    page_url TEXT,
+                    image_urls_json TEXT,
+                    content_hash TEXT,
+                    last_fetched TEXT
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    url TEXT PRIMARY KEY,
+                    save_path TEXT,
+                    size INTEGER,
+                    etag TEXT,
+                    last_modified TEXT,
+                    sha256 TEXT,
+                    status TEXT,
+                    updated_at TEXT
+                );
+                """
+            )
+
+    @staticmethod
+    def _now():
+        return time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, str(value)),
+            )
+
+    def get_patient(self, patient_key):
+        """返回 {'row_hash', 'details'}，未记录时返回 None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT row_hash, details_json FROM patients WHERE patient_key = ?",
+                (str(patient_key),),
+            ).fetchone()
+        if not row:
+            return None
+        return {
+            "row_hash": row[0],
+            "details": json.loads(row[1]) if row[1] else None,
+        }
+
+    def record_patient(self, patient_key, detail_url, row_hash, details):
+        now = self._now()
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO patients
+                    (patient_key, detail_url, row_hash, details_json, first_seen, last_scraped)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(patient_key) DO UPDATE SET
+                    detail_url = excluded.detail_url,
+                    row_hash = excluded.row_hash,
+                    details_json = excluded.details_json,
+                    last_scraped = excluded.last_scraped
+                """,
+                (
+                    str(patient_key),
+                    detail_url,
+                    row_hash,
+                    json.dumps(details, ensure_ascii=False),
+                    now,
+                    now,
+                ),
+            )
+
+    def get_gallery_page(self, page_num):
+        """返回该页记录的图片 URL 列表，未记录时返回 None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT image_urls_json FROM gallery_pages WHERE page_num = ?",
+                (page_num,),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def record_gallery_page(self, page_num, page_url, image_urls):
+        content_hash = hashlib.sha256("\n".join(image_urls).encode("utf-8")).hexdigest()
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO gallery_pages
+                    (page_num, page_url, image_urls_json, content_hash, last_fetched)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (page_num, page_url, json.dumps(image_urls), content_hash, self._now()),
+            )
+
+    def get_file(self, url):
+        """返回文件记录 dict，未记录时返回 None"""
+        with self.lock:
+            row = self.conn.execute(
+                """
+                SELECT save_path, size, etag, last_modified, sha256, status
+                FROM files WHERE url = ?
+                """,
+                (url,),
+            ).fetchone()
+        if not row:
+            return None
+        keys = ("save_path", "size", "etag", "last_modified", "sha256", "status")
+        return dict(zip(keys, row))
+
+    def record_file(
+        self,
+        url,
+        save_path,
+        size,
+        status,
+        etag=None,
+        last_modified=None,
+        sha256=None,
+    ):
+        """记录文件状态；未提供的 ETag/Last-Modified/哈希沿用已有记录"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO files
+                    (url, save_path, size, etag, last_modified, sha256, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    save_path = excluded.save_path,
+                    size = excluded.size,
+                    etag = COALESCE(excluded.etag, files.etag),
+                    last_modified = COALESCE(excluded.last_modified, files.last_modified),
+                    sha256 = COALESCE(excluded.sha256, files.sha256),
+                    status = excluded.status,
+                    updated_at = excluded.updated_at
+                """,
+                (
+                    url,
+                    save_path,
+                    size,
+                    etag,
+                    last_modified,
+                    sha256,
+                    status,
+                    self._now(),
+                ),
+            )
+
+    def iter_files(self):
+        """返回所有已完成文件的 (url, save_path, size, sha256)"""
+        with self.lock:
+            return self.conn.execute(
+                """
+                SELECT url, save_path, size, sha256 FROM files
+                WHERE status IN ('success', 'exists', 'linked')
+                """
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ContentDeduplicator:
+    """
+    基于内容哈希的文件去重。图片库任务与患者任务常以不同路径引用同一文件:
+
+    - 同一 URL 已有完整的本地副本时，新路径直接链接到该副本，不再下载
+    - 新下载的文件 (下载时已边写边计算 SHA-256) 与已有文件内容相同时，
+      替换为指向已有文件的硬链接，节省磁盘空间
+    文件系统不支持硬链接 (或跨设备) 时退化为复制，此时只节省带宽。
+    启用状态库时从中载入以往运行记录的 URL 与哈希，跨运行生效。线程安全。
+    """
+
+    def __init__(self, state=None):
+        self.lock = threading.Lock()
+        self.by_url = {}  # url -> (路径, 大小)
+        self.by_hash = {}  # sha256 -> (路径, 大小)
+        self.skipped_downloads = 0  # 因 URL 已有副本而未下载的文件数
+        self.skipped_bytes = 0
+        self.linked = 0  # 以硬链接代替独立副本的文件数
+        self.linked_bytes = 0
+        if state is not None:
+            for url, save_path, size, sha256 in state.iter_files():
+                self.by_url[url] = (save_path, size)
+                if sha256:
+                    self.by_hash.setdefault(sha256, (save_path, size))
+
+    @staticmethod
+    def _is_valid(entry):
+        try:
+            return os.path.getsize(entry[0]) == entry[1]
+        except OSError:
+            return False
+
+    def _materialize(self, source, save_path, allow_copy=True):
+        """
+        在 save_path 处创建 source 的硬链接 (不支持时按 allow_copy 复制)，
+        先写临时文件再原子替换。返回 "linked"、"copied"，未做任何事时返回 None
+        """
+        tmp_path = save_path + ".link" + PART_SUFFIX
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(source, tmp_path)
+            kind = "linked"
+        except OSError:
+            if not allow_copy:
+                return None
+            shutil.copyfile(source, tmp_path)
+            kind = "copied"
+        os.replace(tmp_path, save_path)
+        return kind
+
+    def link_known_url(self, url, save_path):
+        """
+        若该 URL 在其他路径已有完整副本，将其链接到 save_path 并返回副本大小，
+        否则返回 None
+        """
+        with self.lock:
+            entry = self.by_url.get(url)
+        if entry is None or entry[0] == save_path or not self._is_valid(entry):
+            return None
+        os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+        kind = self._materialize(entry[0], save_path)
+        with self.lock:
+            self.skipped_downloads += 1
+            self.skipped_bytes += entry[1]
+            if kind == "linked":
+                self.linked += 1
+                self.linked_bytes += entry[1]
+        return entry[1]
+
+    def add(self, url, save_path, size, sha256=None):
+        """
+        登记一个已就绪的文件。若已有内容相同的其他文件，将 save_path 替换为其硬链接，
+        返回因此节省的字节数 (未去重时为 0)
+        """
+        with self.lock:
+            self.by_url[url] = (save_path, size)
+            if not sha256:
+                return 0
+            existing = self.by_hash.get(sha256)
+            if (
+                existing is None
+                or existing[0] == save_path
+                or not self._is_valid(existing)
+            ):
+                self.by_hash[sha256] = (save_path, size)
+                return 0
+        try:
+            if os.path.samefile(existing[0], save_path):
+                return 0
+            # 复制不节省空间，无法硬链接时保留新下载的文件
+            if self._materialize(existing[0], save_path, allow_copy=False) is None:
+                return 0
+        except OSError:
+            return 0
+        with self.lock:
+            self.linked += 1
+            self.linked_bytes += size
+        return size
+
+
+IMAGE_HREF_RE = re.compile(r"\.(jpg|jpeg|png|bmp|gif|tif|tiff)$", re.IGNORECASE)
+DETAILS_HREF_RE = re.compile(r"details\.php\?id=")
+PAGINA_RE = re.compile(r"pagina=(\d+)")
+# BeautifulSoup 的 get_text() 不包含这些标签内的文本，其他后端需保持一致
+_NON_TEXT_TAGS = frozenset(("script", "style", "template", "rt", "rp"))
+
+
+def _join_text(parts, separator="", strip=True):
+    """与 BeautifulSoup 的 get_text(separator, strip) 相同: strip 时去掉空白片段后拼接"""
+    if not strip:
+        return separator.join(parts)
+    return separator.join(p.strip() for p in parts if p.strip())
+
+
+class Bs4PageParser:
+    """
+    基于 BeautifulSoup (html.parser) 的页面解析后端 (默认)。
+
+    各后端只负责从 HTML 中抽取原始文本与链接，返回结构相同的结果:
+    - gallery(html) -> {"pagination": [(链接文本, href)], "images": [href]}
+    - patient_list(html) -> None (无 id='mytable' 表格) 或
+      {"headers": [...], "rows": [([单元格文本], 详情 href 或 None)], "links": [(链接文本, href)]}
+    - patient_details(html) -> {"info_text", "info_paragraphs", "diagnosis",
+      "history", "protocol", "files": [(href, title)]}
+    URL 拼接与正则提取等业务逻辑由爬虫统一处理，因此各后端产出的结果完全一致。
+    """
+
+    name = "bs4"
+
+    def gallery(self, html):
+        soup = BeautifulSoup(html, "html.parser")
+        pagination = []
+        div = soup.find("div", class_="pagination")
+        if div:
+            for li in div.find_all("li"):
+                a = li.find("a")
+                if a:
+                    pagination.append((a.get_text(strip=True), a.get("href", "")))
+        images = []
+        for div in soup.find_all("div", class_="imagem"):
+            a = div.find("a", href=IMAGE_HREF_RE)
+            if a:
+                images.append(a["href"])
+        return {"pagination": pagination, "images": images}
+
+    def patient_list(self, html):
+        soup = BeautifulSoup(html, "html.parser")
+        table = soup.find("table", id="mytable")
+        if table is None:
+            return None
+        rows = []
+        for tr in table.find_all("tr")[1:]:  # 跳过表头
+            cells = [td.get_text(strip=True) for td in tr.find_all("td")]
+            if not cells:
+                continue
+            link = tr.find("a", href=DETAILS_HREF_RE)
+            rows.append((cells, link["href"] if link else None))
+        return {
+            "headers": [th.get_text(strip=True) for th in table.find_all("th")],
+            "rows": rows,
+            "links": [(a.get_text(), a["href"]) for a in soup.find_all("a", href=True)],
+        }
+
+    def patient_details(self, html):
+        soup = BeautifulSoup(html, "html.parser")
+        result = _empty_patient_details()
+        info_div = soup.find("div", class_="descripcion1")
+        if info_div:
+            result["info_text"] = info_div.get_text(" ", strip=True)
+            result["info_paragraphs"] = [
+                p.get_text(strip=True) for p in info_div.find_all("p")
+            ]
+        diag_p = soup.find("p", class_="view-diagnostico")
+        span = diag_p.find("span") if diag_p else None
+        if span:
+            result["diagnosis"] = span.get_text(strip=True)
+        for key, cls in (("history", "descripcion2"), ("protocol", "descripcion3")):
+            div = soup.find("div", class_=cls)
+            if div:
+                result[key] = div.get_text(" ", strip=True)
+        for file_div in soup.find_all("div", class_="imagenspaciente"):
+            for a in file_div.find_all("a", href=True):
+                result["files"].append((a["href"], a.get("title", "")))
+        return result
+
+
+def _empty_patient_details():
+    return {
+        "info_text": None,
+        "info_paragraphs": [],
+        "diagnosis": None,
+        "history": None,
+        "protocol": None,
+        "files": [],
+    }
+
+
+def _xpath_class(tag, cls):
+    """XPath 版本的 CSS 选择器 tag.cls"""
+    return f"{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')]"
+
+
+class LxmlPageParser:
+    """基于 lxml 的解析后端，使用预编译的 XPath 只定位需要的节点"""
+
+    name = "lxml"
+
+    def __init__(self):
+        xpath = lxml_etree.XPath
+        self._pagination_items = xpath(f"(//{_xpath_class('div', 'pagination')})[1]//li")
+        self._imagem_divs = xpath(f"//{_xpath_class('div', 'imagem')}")
+        self._patient_table = xpath("(//table[@id='mytable'])[1]")
+        self._all_links = xpath("//a[@href]")
+        self._info_div = xpath(f"(//{_xpath_class('div', 'descripcion1')})[1]")
+        self._diagnosis_p = xpath(f"(//{_xpath_class('p', 'view-diagnostico')})[1]")
+        self._history_div = xpath(f"(//{_xpath_class('div', 'descripcion2')})[1]")
+        self._protocol_div = xpath(f"(//{_xpath_class('div', 'descripcion3')})[1]")
+        self._file_links = xpath(
+            f"//{_xpath_class('div', 'imagenspaciente')}//a[@href]"
+        )
+
+    @staticmethod
+    def _parse(html):
+        return lxml_html.document_fromstring(html or "<html></html>")
+
+    @classmethod
+    def _text_parts(cls, node):
+        if node.text and node.tag not in _NON_TEXT_TAGS:
+            yield node.text
+        for child in node:
+            # 注释与处理指令的 tag 不是字符串，它们的内容不算文本
+            if isinstance(child.tag, str) and child.tag not in _NON_TEXT_TAGS:
+                yield from cls._text_parts(child)
+            if child.tail:
+                yield child.tail
+
+    @classmethod
+    def _text(cls, node, separator="", strip=True):
+        return _join_text(cls._text_parts(node), separator, strip)
+
+    def gallery(self, html):
+        root = self._parse(html)
+        pagination = []
+        for li in self._pagination_items(root):
+            a = next(li.iter("a"), None)
+            if a is not None:
+                pagination.append((self._text(a), a.get("href", "")))
+        images = []
+        for div in self._imagem_divs(root):
+            for a in div.iter("a"):
+                href = a.get("href")
+                if href is not None and IMAGE_HREF_RE.search(href):
+                    images.append(href)
+                    break
+        return {"pagination": pagination, "images": images}
+
+    def patient_list(self, html):
+        root = self._parse(html)
+        tables = self._patient_table(root)
+        if not tables:
+            return None
+        table = tables[0]
+        rows = []
+        for tr in list(table.iter("tr"))[1:]:  # 跳过表头
+            cells = [self._text(td) for td in tr.iter("td")]
+            if not cells:
+                continue
+            hrefs = (a.get("href") for a in tr.iter("a") if a.get("href") is not None)
+            link = next((h for h in hrefs if DETAILS_HREF_RE.search(h)), None)
+            rows.append((cells, link))
+        return {
+            "headers": [self._text(th) for th in table.iter("th")],
+            "rows": rows,
+            "links": [
+                (self._text(a, strip=False), a.get("href"))
+                for a in self._all_links(root)
+            ],
+        }
+
+    def patient_details(self, html):
+        root = self._parse(html)
+        result = _empty_patient_details()
+        for info_div in self._info_div(root):
+            result["info_text"] = self._text(info_div, " ")
+            result["info_paragraphs"] = [self._text(p) for p in info_div.iter("p")]
+        for diag_p in self._diagnosis_p(root):
+            span = next(diag_p.iter("span"), None)
+            if span is not None:
+                result["diagnosis"] = self._text(span)
+        for key, query in (
+            ("history", self._history_div),
+            ("protocol", self._protocol_div),
+        ):
+            for div in query(root):
+                result[key] = self._text(div, " ")
+        result["files"] = [
+            (a.get("href"), a.get("title", "")) for a in self._file_links(root)
+        ]
+        return result
+
+
+class SelectolaxPageParser:
+    """基于 selectolax (lexbor) 的解析后端，使用 CSS 选择器只定位需要的节点"""
+
+    name = "selectolax"
+
+    @classmethod
+    def _text_parts(cls, node):
+        for child in node.iter(include_text=True):
+            if child.tag == "-text":
+                yield child.text_content
+            elif child.tag not in _NON_TEXT_TAGS and not child.tag.startswith("-"):
+                yield from cls._text_parts(child)
+
+    @classmethod
+    def _text(cls, node, separator="", strip=True):
+        return _join_text(cls._text_parts(node), separator, strip)
+
+    def gallery(self, html):
+        tree = LexborHTMLParser(html)
+        pagination = []
+        div = tree.css_first("div.pagination")
+        if div is not None:
+            for li in div.css("li"):
+                a = li.css_first("a")
+                if a is not None:
+                    pagination.append((self._text(a), a.attributes.get("href") or ""))
+        images = []
+        for div in tree.css("div.imagem"):
+            for a in div.css("a[href]"):
+                href = a.attributes.get("href") or ""
+                if IMAGE_HREF_RE.search(href):
+                    images.append(href)
+                    break
+        return {"pagination": pagination, "images": images}
+
+    def patient_list(self, html):
+        tree = LexborHTMLParser(html)
+        table = tree.css_first("table#mytable")
+        if table is None:
+            return None
+        rows = []
+        for tr in table.css("tr")[1:]:  # 跳过表头
+            cells = [self._text(td) for td in tr.css("td")]
+            if not cells:
+                continue
+            hrefs = (a.attributes.get("href") or "" for a in tr.css("a[href]"))
+            link = next((h for h in hrefs if DETAILS_HREF_RE.search(h)), None)
+            rows.append((cells, link))
+        return {
+            "headers": [self._text(th) for th in table.css("th")],
+            "rows": rows,
+            "links": [
+                (self._text(a, strip=False), a.attributes.get("href") or "")
+                for a in tree.css("a[href]")
+            ],
+        }
+
+    def patient_details(self, html):
+        tree = LexborHTMLParser(html)
+        result = _empty_patient_details()
+        info_div = tree.css_first("div.descripcion1")
+        if info_div is not None:
+            result["info_text"] = self._text(info_div, " ")
+            result["info_paragraphs"] = [self._text(p) for p in info_div.css("p")]
+        diag_p = tree.css_first("p.view-diagnostico")
+        span = diag_p.css_first("span") if diag_p is not None else None
+        if span is not None:
+            result["diagnosis"] = self._text(span)
+        for key, selector in (
+            ("history", "div.descripcion2"),
+            ("protocol", "div.descripcion3"),
+        ):
+            div = tree.css_first(selector)
+            if div is not None:
+                result[key] = self._text(div, " ")
+        result["files"] = [
+            (a.attributes.get("href") or "", a.attributes.get("title") or "")
+            for a in tree.css("div.imagenspaciente a[href]")
+        ]
+        return result
+
+
+PAGE_PARSERS = {
+    Bs4PageParser.name: Bs4PageParser,
+    LxmlPageParser.name: LxmlPageParser,
+    SelectolaxPageParser.name: SelectolaxPageParser,
+}
+
+
+def create_page_parser(backend="bs4"):
+    """按名称创建页面解析后端；后端未知时抛出 ValueError，缺少可选依赖时抛出 ImportError"""
+    if backend not in PAGE_PARSERS:
+        raise ValueError(f"未知的解析后端: {backend}")
+    available = {"lxml": lxml_html is not None, "selectolax": LexborHTMLParser is not None}
+    if not available.get(backend, True):
+        raise ImportError(f"解析后端 {backend} 需要 {backend}，请先执行 pip install {backend}")
+    return PAGE_PARSERS[backend]()
+
+
+def _strip_phrase(value):
+    return value.strip(". ")
+
+
+# 患者详情字段的提取规则: (字段名, 解析结果中的来源文本, 预编译正则, 类型转换)。
+# 各解析后端产出的文本相同，浏览器与 HTTP 两种页面获取方式共用同一张规则表；
+# 新增字段只需在此追加一行，由 extract_detail_fields() 一次性应用。
+PATIENT_DETAIL_FIELDS = (
+    ("id", "info_text", re.compile(r"ID:\s*(\d+)"), str),
+    ("age", "info_text", re.compile(r"(\d+)\s*years"), int),
+    ("register_date", "info_text", re.compile(r"Registered at\s*([\d-]+)"), str),
+    ("marital_status", "info_text", re.compile(r"Marital status:\s*([\w\s]+)"), _strip_phrase),
+    ("race", "info_text", re.compile(r"Race:\s*([\w\s]+)"), _strip_phrase),
+    ("temperature", "protocol", re.compile(r"Body temperature:\s*([\d.]+)"), float),
+)
+
+
+def extract_detail_fields(parsed, rules=PATIENT_DETAIL_FIELDS):
+    """按规则表从 patient_details() 的解析结果中提取字段，来源为空或未匹配的字段为 None"""
+    fields = {}
+    for name, source, pattern, convert in rules:
+        text = parsed[source]
+        match = pattern.search(text) if text is not None else None
+        fields[name] = convert(match.group(1)) if match else None
+    return fields
+
+
+class BrowserPool:
+    """
+    Selenium 浏览器池。每个详情线程独占一个浏览器，浏览器崩溃时可替换为新实例。
+
+    Args:
+        factory: 无参可调用对象，返回新的 WebDriver
+        size (int): 浏览器数量
+        prepare: 可选，factory 创建浏览器后调用 prepare(driver) 完成初始化 (如注入登录 Cookie)
+        max_restarts (int): 整个池允许的最大重启次数，超过后 replace() 抛出 RuntimeError
+    """
+
+    def __init__(self, factory, size, prepare=None, max_restarts=3):
+        self.factory = factory
+        self.size = size
+        self.prepare = prepare
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.lock = threading.Lock()
+        self._idle = queue.Queue()
+        self._drivers = []
+
+    def _spawn(self):
+        driver = self.factory()
+        try:
+            if self.prepare is not None:
+                self.prepare(driver)
+        except Exception:
+            driver.quit()
+            raise
+        with self.lock:
+            self._drivers.append(driver)
+        return driver
+
+    def start(self):
+        """启动全部浏览器，返回成功启动的数量 (部分失败时以较少的浏览器继续)"""
+        errors = []
+        for _ in range(self.size):
+            try:
+                self._idle.put(self._spawn())
+            except Exception as e:
+                errors.append(e)
+        started = self.size - len(errors)
+        if not started and errors:
+            raise errors[0]
+        self.size = started
+        return started
+
+    def acquire(self):
+        """取出一个空闲浏览器 (全部占用时阻塞)"""
+        return self._idle.get()
+
+    def release(self, driver):
+        if driver is not None:
+            self._idle.put(driver)
+
+    @staticmethod
+    def is_alive(driver):
+        """浏览器进程或会话已失效时访问 current_url 会抛出异常"""
+        try:
+            driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def replace(self, driver):
+        """关闭已失效的浏览器并创建新实例 (调用方需持有该浏览器)"""
+        with self.lock:
+            if self.restarts >= self.max_restarts:
+                raise RuntimeError(f"浏览器重启次数已达上限 ({self.max_restarts})")
+            self.restarts += 1
+            if driver in self._drivers:
+                self._drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        return self._spawn()
+
+    def close(self):
+        with self.lock:
+            drivers, self._drivers = self._drivers, []
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+
 class ThermoMastoCrawler:
     """
     一个风格统一、多线程、健壮的热成像乳腺数据爬虫。
@@ -39,15 +2643,33 @@ class ThermoMastoCrawler:
     TASK_GALLERY = "gallery"
     TASK_PATIENT = "patient"
 
+    # --- 页面获取模式 ---
+    FETCH_SELENIUM = "selenium"  # 所有页面都经由浏览器加载
+    FETCH_REQUESTS = "requests"  # 仅登录使用浏览器，其余页面经由 Requests 会话获取
+
+    # --- 下载引擎 ---
+    ENGINE_THREAD = "thread"  # 线程池，每个下载占用一个线程
+    ENGINE_ASYNC = "async"  # asyncio + aiohttp，单事件循环驱动大量并发下载
+
+    METRICS_EXPORT_INTERVAL = 5.0  # 运行期间更新指标文件的最短间隔 (秒)
+
     def __init__(self, username, password, driver_path="/usr/local/bin/chromedriver"):
         self.username = username
         self.password = password
         self.base_url = "https://visual.ic.uff.br/dmi/prontuario/"
         self.driver_path = driver_path
         self.driver = None
+        self.page_fetch_mode = self.FETCH_SELENIUM
+        self._browser_pool = None  # 并行访问详情页的浏览器池 (仅 browser_workers > 1 时创建)
+        self._local = threading.local()  # 详情线程当前使用的浏览器
+        self._auth_lock = threading.Lock()  # 保证会话过期时只有一个线程重新登录
+        self._auth_generation = 0  # 每次重新登录成功后加 1
+        self.max_relogins = 20  # 单次运行中因会话过期重新登录的最大次数
+        self._relogins = 0
 
         # --- 反爬与健壮性设置 ---
         self.delay_range = (1.5, 3.5)  # 导航延迟范围 (秒)
+        self.http_delay_range = (0.3, 1.0)  # Requests 模式下的页面请求延迟 (秒)
         self.timeout = 30  # 下载超时
         self.user_agents = [
             "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
@@ -57,9 +2679,35 @@ class ThermoMastoCrawler:
 
         # --- 共享会话和日志 ---
         self.session = self._setup_session()
+        self.download_session = self.session  # 文件下载使用的会话 (自适应并发时独立创建)
         self.log_file = "download_log_unified.csv"
         self.log_lock = threading.Lock()  # 线程锁，用于安全写入日志和控制台输出
+        self._scheduler = None  # 按优先级派发下载任务 (仅 run() 期间存在)
+        self._download_priorities = dict(DEFAULT_DOWNLOAD_PRIORITIES)
+        self._completion = None  # 患者完成进度跟踪 (仅爬取患者数据时创建)
+        self._rate_limiter = None  # 按主机的令牌桶限速器 (None 表示使用随机休眠)
+        self._concurrency = None  # 自适应并发控制器 (None 表示固定并发)
+        self.adaptive_retries = 4  # 自适应模式下单个文件的最大重试次数
+        self.download_chunk_size = 256 * 1024  # 下载时每次读取并写盘的字节数
+        self.preallocate_files = False  # 按 Content-Length 预分配 .part 文件
+        self._async_engine = None  # 异步下载引擎 (仅 download_engine="async" 时创建)
+        self._state = None  # 增量爬取状态库 (仅设置 state_db 时创建)
+        self.parser = Bs4PageParser()  # HTML 解析后端，可在 run() 中通过 parser_backend 切换
+        self.metrics = CrawlMetrics()  # 各阶段耗时与计数 (每次 run() 重新创建并返回)
+        self._metrics_file = None  # Prometheus 指标文件路径 (仅设置 metrics_file 时写入)
+        self._thermal_converter = None  # 热矩阵转换器 (仅设置 thermal_format 时创建)
+        self._dedup = None  # 内容去重 (仅设置 deduplicate 时创建)
+        self._file_index = None  # 启动时扫描的已有文件索引 (仅 preindex_existing 时创建)
+        self._skipped_existing = 0  # 提交前即判定已存在、未进入下载队列的文件数
+        self._shard = None  # (i, N): 只爬取属于第 i 个分片的图片库页面与患者
+        self._image_processor = None  # 图片校验与缩略图进程池 (仅 image_workers > 0 时创建)
+        self.image_index_file = "image_metadata.jsonl"  # 图片校验结果 (JSON Lines)
+        self._force_refresh = False  # 忽略状态库，强制重新访问所有页面
+        self._revalidate_existing = False  # 对已存在的文件做 HEAD/条件请求校验
         self._init_log_file()
+        self._log_writer = None  # 后台日志写入器 (运行期间创建)
+        self._write_patient_json = True  # 是否为每位患者单独保存格式化的 JSON
+        self._compact_metadata = True  # 任务结束后是否由 JSONL 生成总 JSON 数组文件
 
     ## ----------------------------------------------------------------
     ## 核心设置、初始化与日志
@@ -83,15 +2731,18 @@ class ThermoMastoCrawler:
         with self.log_lock:
             print(f"{timestamp} {prefix} {message}")
 
-    def _setup_session(self):
+    def _setup_session(self, retry_statuses=RETRYABLE_STATUSES):
         """配置带重试和User-Agent的Requests Session"""
         session = requests.Session()
         session.verify = False
-        retries = Retry(
+        retries = ThrottledRetry(
             total=3,
             backoff_factor=0.5,
-            status_forcelist=[500, 502, 503, 504],
+            status_forcelist=list(retry_statuses),
             allowed_methods={"HEAD", "GET", "OPTIONS"},
+            # 不指定可重试状态码时，也不要因 Retry-After 在内部重试
+            respect_retry_after_header=bool(retry_statuses),
+            throttle=self._throttle,
         )
         adapter = HTTPAdapter(max_retries=retries)
         session.mount("http://", adapter)
@@ -99,28 +2750,38 @@ class ThermoMastoCrawler:
         session.headers.update({"User-Agent": random.choice(self.user_agents)})
         return session
 
-    def _init_log_file(self):
+    def _setup_adaptive_download_session(self):
+        """
+        为自适应并发创建独立的下载会话: 不在 urllib3 内部重试 429/5xx，
+        让这些拥塞信号交给控制器处理。与主会话共享 Cookie 与请求头。
+        """
+        session = self._setup_session(retry_statuses=())
+        session.headers = self.session.headers
+        session.cookies = self.session.cookies
+        return session
+
+    def _init_log_file(self, path=None):
         """初始化CSV日志文件，如果不存在则写入表头"""
-        if not os.path.exists(self.log_file):
+        path = path or self.log_file
+        if not os.path.exists(path):
             with self.log_lock:
-                with open(self.log_file, "w", newline="", encoding="utf-8") as f:
+                with open(path, "w", newline="", encoding="utf-8") as f:
                     writer = csv.writer(f)
-                    writer.writerow(
-                        [
-                            "timestamp",
-                            "task_type",
-                            "identifier",
-                            "file_name",
-                            "status",
-                            "size_kb",
-                            "url",
-                            "elapsed_s",
-                            "error",
-                        ]
-                    )
+                    writer.writerow(LOG_COLUMNS)
+
+    def _output_path(self, path):
+        """本次运行实际写入的输出文件 (分片爬取时带分片后缀，见 shard_output_path)"""
+        return shard_output_path(path, self._shard)
+
+    def _in_shard(self, key):
+        """页码或患者 ID 是否属于本分片 (未分片时总是 True)"""
+        if self._shard is None:
+            return True
+        index, count = self._shard
+        return shard_key(key) % count == index
 
-    def setup_driver(self):
-        """设置Chrome驱动"""
+    def _create_driver(self):
+        """创建一个新的 Headless Chrome 驱动"""
         chrome_options = Options()
         chrome_options.add_argument("--headless=new")
         chrome_options.add_argument("--disable-gpu")
@@ -131,9 +2792,14 @@ class ThermoMastoCrawler:
         chrome_options.add_argument(f"--user-agent={random.choice(self.user_agents)}")
 
         service = Service(self.driver_path)
+        driver = webdriver.Chrome(service=service, options=chrome_options)
+        driver.implicitly_wait(10)
+        return driver
+
+    def setup_driver(self):
+        """设置Chrome驱动"""
         try:
-            self.driver = webdriver.Chrome(service=service, options=chrome_options)
-            self.driver.implicitly_wait(10)
+            self.driver = self._create_driver()
             self._log("SUCCESS", "Chrome驱动初始化成功 (Headless)")
             return True
         except Exception as e:
@@ -143,18 +2809,19 @@ class ThermoMastoCrawler:
 
     def login(self):
         """使用Selenium登录并将会话Cookie同步到Requests"""
+        driver = self._browser()
         try:
             self._log("INFO", "正在访问登录页面...")
-            self.driver.get(f"{self.base_url}/index.php")
+            driver.get(f"{self.base_url}/index.php")
             time.sleep(random.uniform(0.5, 1.5))
 
-            username_field = self.driver.find_element(
+            username_field = driver.find_element(
                 By.CSS_SELECTOR, "input[type='text']"
             )
-            password_field = self.driver.find_element(
+            password_field = driver.find_element(
                 By.CSS_SELECTOR, "input[type='password']"
             )
-            submit_button = self.driver.find_element(
+            submit_button = driver.find_element(
                 By.CSS_SELECTOR, "input[type='submit'], button[type='submit']"
             )
 
@@ -167,12 +2834,12 @@ class ThermoMastoCrawler:
             self._log("INFO", "正在等待登录...")
             time.sleep(random.uniform(3, 5))
 
-            current_url = self.driver.current_url
+            current_url = driver.current_url
             if "home.php" in current_url:
                 self._log("SUCCESS", "登录成功！已进入主界面")
 
                 # 关键一步：同步Cookie到Requests Session
-                cookies = self.driver.get_cookies()
+                cookies = driver.get_cookies()
                 for cookie in cookies:
                     self.session.cookies.set(cookie["name"], cookie["value"])
                 self._log("INFO", f"已同步 {len(cookies)} 个 Cookie 到下载会话")
@@ -185,6 +2852,163 @@ class ThermoMastoCrawler:
             self._log("ERROR", f"登录过程中出错: {e}")
             return False
 
+    def _share_login(self, driver):
+        """将登录后的会话 Cookie 注入另一个浏览器 (需先打开同域页面才能设置 Cookie)"""
+        login_url = urljoin(self.base_url, "index.php")
+        self._throttle(login_url)
+        driver.get(login_url)
+        for cookie in self.session.cookies:
+            driver.add_cookie(
+                {"name": cookie.name, "value": cookie.value, "path": cookie.path or "/"}
+            )
+
+    def _relogin(self):
+        """
+        用临时浏览器重新登录并将新的 Cookie 同步到 self.session。
+        主浏览器可能正被列表线程使用，因此不复用它。
+        """
+        try:
+            driver = self._create_driver()
+        except Exception as e:
+            self._log("ERROR", f"重新登录时无法启动浏览器: {e}")
+            return False
+        previous = getattr(self._local, "driver", None)
+        self._local.driver = driver
+        try:
+            return self.login()
+        finally:
+            self._local.driver = previous
+            driver.quit()
+
+    def _reauthenticate(self, generation):
+        """
+        [线程安全] 单飞重新登录: 多个线程同时发现会话过期时只有一个线程执行登录，
+        其余线程在锁上等待，随后直接重试。generation 为调用方发起请求前读取的
+        _auth_generation，若期间已有其他线程重新登录成功则不再重复登录。
+        返回会话是否已恢复。
+        """
+        with self._auth_lock:
+            if self._auth_generation != generation:
+                return True
+            if self._relogins >= self.max_relogins:
+                return False
+            self._relogins += 1
+            self._log("WARN", "检测到会话已过期，正在重新登录...")
+            # 旧 Cookie 已失效，避免与新 Cookie 同名冲突
+            self.session.cookies.clear()
+            with self.metrics.timer("relogin"):
+                logged_in = self._relogin()
+            if not logged_in:
+                self._log("ERROR", "重新登录失败")
+                return False
+            self._auth_generation += 1
+            self.metrics.inc("relogins")
+            if self._async_engine is not None:
+                self._async_engine.update_cookies(self.session.cookies.get_dict())
+            self._log("SUCCESS", "重新登录成功，已刷新会话 Cookie")
+            return True
+
+    def _call_with_reauth(self, func, *args):
+        """
+        调用 func，遇到 SessionExpiredError 时重新登录后重试。
+        重试次数受 max_relogins 限制 (请求排队期间会话可能再次过期)。
+        """
+        while True:
+            generation = self._auth_generation
+            try:
+                return func(*args)
+            except SessionExpiredError:
+                if not self._reauthenticate(generation):
+                    raise
+
+    async def _call_with_reauth_async(self, coro_func, *args):
+        """_call_with_reauth 的协程版本，登录在线程池中执行，不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        while True:
+            generation = self._auth_generation
+            try:
+                return await coro_func(*args)
+            except SessionExpiredError:
+                if not await loop.run_in_executor(
+                    None, self._reauthenticate, generation
+                ):
+                    raise
+
+    def _browser(self):
+        """当前线程使用的浏览器: 详情线程使用浏览器池中分配的实例，否则为主浏览器"""
+        return getattr(self._local, "driver", None) or self.driver
+
+    def _release_driver(self):
+        """关闭浏览器并释放内存 (Requests 模式下登录完成后即可调用)"""
+        if self.driver:
+            self.driver.quit()
+            self.driver = None
+            self._log("INFO", "浏览器已关闭，后续页面将通过 Requests 会话获取")
+
+    ## ----------------------------------------------------------------
+    ## 页面获取 (Requests 模式)
+    ## ----------------------------------------------------------------
+
+    def _fetch_page(self, url, stage="page_fetch"):
+        """
+        [Requests 驱动] 通过共享会话获取页面 HTML 文本，耗时记入 metrics 的 stage 阶段。
+        登录时同步的 Cookie 保证了会话与浏览器一致；会话过期时自动重新登录后重试。
+        """
+        return self._call_with_reauth(self._get_page, url, stage)
+
+    def _get_page(self, url, stage):
+        self._throttle(url)
+        with self.metrics.timer(stage):
+            response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        if _is_login_page(response.url, response.headers.get("Content-Type")):
+            raise SessionExpiredError(f"会话已过期，页面被重定向到登录页: {url}")
+        # 服务器未声明编码时，Requests 会默认 ISO-8859-1，这里改用内容探测
+        if "charset" not in response.headers.get("Content-Type", "").lower():
+            response.encoding = response.apparent_encoding
+        return response.text
+
+    def _navigate(self, url, stage="page_fetch"):
+        """[Selenium 驱动] 经限速器后用浏览器打开页面，耗时记入 metrics 的 stage 阶段"""
+        self._throttle(url)
+        with self.metrics.timer(stage):
+            self._browser().get(url)
+
+    ## ----------------------------------------------------------------
+    ## 请求限速
+    ## ----------------------------------------------------------------
+
+    def _legacy_sleep(self, delay_range):
+        """未启用限速器时的随机休眠；启用后由限速器统一控制请求速率"""
+        if self._rate_limiter is None:
+            time.sleep(random.uniform(*delay_range))
+
+    def _throttle(self, url, legacy_range=None):
+        """
+        [线程安全] 发起请求前调用: 启用限速器时获取 url 所在主机的令牌，
+        否则按 legacy_range 随机休眠 (None 表示不休眠)。
+        """
+        with self.metrics.timer("throttle_wait"):
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire(url)
+            elif legacy_range:
+                time.sleep(random.uniform(*legacy_range))
+
+    async def _throttle_async(self, url, legacy_range=None):
+        """_throttle 的协程版本"""
+        with self.metrics.timer("throttle_wait"):
+            if self._rate_limiter is not None:
+                await self._rate_limiter.acquire_async(url)
+            elif legacy_range:
+                await asyncio.sleep(random.uniform(*legacy_range))
+
+    def _page_delay(self):
+        """页面间的随机延迟，Requests 模式无需等待渲染，延迟更短"""
+        if self.page_fetch_mode == self.FETCH_REQUESTS:
+            self._legacy_sleep(self.http_delay_range)
+        else:
+            self._legacy_sleep(self.delay_range)
+
     ## ----------------------------------------------------------------
     ## 核心下载与CSV日志 (线程安全)
     ## ----------------------------------------------------------------
@@ -202,64 +3026,355 @@ class ThermoMastoCrawler:
     ):
         """
         线程安全地记录下载日志到CSV文件。
+        运行期间交给后台写入器批量写盘；未启动写入器时直接追加写入。
         """
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-        with self.log_lock:
-            try:
+        self.metrics.inc(f"files_{status}")
+        row = {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "task_type": task_type,
+            "identifier": identifier,
+            "file_name": file_name,
+            "status": status,
+            "size_kb": round(float(size_kb), 2),
+            "url": url,
+            "elapsed_s": round(float(elapsed_s), 3),
+            "error": error,
+        }
+        if self._log_writer is not None:
+            self._log_writer.write(row)
+            return
+
+        try:
+            with self.log_lock:
                 with open(self.log_file, "a", newline="", encoding="utf-8") as f:
                     writer = csv.writer(f)
                     writer.writerow(
                         [
-                            timestamp,
+                            row["timestamp"],
                             task_type,
                             identifier,
                             file_name,
                             status,
                             f"{size_kb:.2f}",
                             url,
-                            f"{elapsed_s:.2f}",
+                            f"{elapsed_s:.3f}",
                             error,
                         ]
                     )
-            except Exception as e:
-                # 记录到控制台，避免日志失败导致程序崩溃
-                self._log(f"CRITICAL: 写入CSV日志失败: {e}", "ERROR")
+        except Exception as e:
+            # 记录到控制台，避免日志失败导致程序崩溃
+            self._log("ERROR", f"CRITICAL: 写入CSV日志失败: {e}")
 
-    def _download_file(self, task_type, identifier, url, save_path):
+    def _download_file(self, task_type, identifier, url, save_path, queued_at=None):
         """
         [线程工作函数] 下载单个文件并记录日志。
         如果文件已存在，则跳过并记录。
+        下载先写入 .part 临时文件，完成后原子重命名；中断遗留的 .part 文件会被续传。
+        queued_at 为提交任务时的 perf_counter()，用于统计排队等待时间。
         """
+        if queued_at is not None:
+            self.metrics.observe("download_queue_wait", time.perf_counter() - queued_at)
         start_time = time.time()
         file_name = os.path.basename(save_path)
 
         try:
             # 1. 检查文件是否已存在
-            if os.path.exists(save_path):
-                size_kb = os.path.getsize(save_path) / 1024
-                self.log_result_to_csv(
-                    task_type, identifier, file_name, "exists", size_kb, url, 0
-                )
-                return True  # 已存在，视为成功
+            size = _file_size(save_path)
+            if size is not None:
+                if not self._revalidate_existing or self._check_existing_file(
+                    url, save_path, size
+                ):
+                    self._record_file_state(url, save_path, size, "exists")
+                    self.log_result_to_csv(
+                        task_type, identifier, file_name, "exists", size / 1024, url, 0
+                    )
+                    self._register_content(url, save_path, size)
+                    self._after_download(task_type, identifier, save_path, url)
+                    return True  # 已存在，视为成功
 
-            # 2. 随机休眠 (轻度反爬)
-            time.sleep(random.uniform(0.1, 0.5))
+            # 同一 URL 已在其他路径下载过 (如图片库与患者文件重复)，直接链接
+            if self._link_duplicate(task_type, identifier, url, save_path):
+                return True
+
+            # 2. 未启用限速器时随机休眠 (轻度反爬)；限速器的令牌在每次请求前获取
+            self._legacy_sleep((0.1, 0.5))
+
+            # 3. 下载到 .part 文件 (边下载边计算 SHA-256)，已有 .part 时用 Range 续传
+            #    会话过期 (收到登录页) 时重新登录后重试
+            transfer = (
+                self._transfer if self._concurrency is None else self._transfer_adaptive
+            )
+            with self.metrics.timer("download"):
+                headers, hasher, size = self._call_with_reauth(transfer, url, save_path)
+
+            # 4. 记录成功
+            self._record_file_state(
+                url,
+                save_path,
+                size,
+                "success",
+                etag=headers.get("ETag"),
+                last_modified=headers.get("Last-Modified"),
+                sha256=hasher.hexdigest(),
+            )
+            elapsed = time.time() - start_time
+            self.log_result_to_csv(
+                task_type, identifier, file_name, "success", size / 1024, url, elapsed
+            )
+            self._register_content(url, save_path, size, hasher.hexdigest())
+            self._after_download(task_type, identifier, save_path, url)
+            return True
+
+        except Exception as e:
+            # 5. 记录失败
+            elapsed = time.time() - start_time
+            self.log_result_to_csv(
+                task_type, identifier, file_name, "failed", 0, url, elapsed, str(e)
+            )
+            # 将异常抛出，以便tqdm循环可以捕获它
+            raise e
 
-            # 3. 下载
-            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+    def _transfer(self, url, save_path, throttled=False):
+        """
+        [线程工作函数] 下载到 .part 文件，完成后原子重命名为 save_path。
+        每次请求前获取限速令牌；throttled 为 True 表示调用方已为第一次请求获取过令牌。
+        返回 (响应头, SHA-256 对象, 文件大小)。
+        """
+        part_path = save_path + PART_SUFFIX
+        for _ in range(2):
+            offset, hasher = _resume_part_file(part_path)
+            request_headers = _range_request_headers(
+                offset, self._resume_validator(url)
+            )
+            # 每次请求 (含 416 后重新下载、自适应重试与重新登录后的重试) 都获取令牌
+            if throttled:
+                throttled = False
+            else:
+                self._throttle(url)
+            started = time.perf_counter()
+            with self.download_session.get(
+                url, headers=request_headers, stream=True, timeout=self.timeout
+            ) as response:
+                # stream=True 时 get() 在收到响应头后返回，即首字节时间
+                self.metrics.observe("download_ttfb", time.perf_counter() - started)
+                if _is_login_page(
+                    response.url,
+                    response.headers.get("Content-Type"),
+                    True,
+                    response.status_code,
+                ):
+                    # 不把登录页当作文件保存
+                    raise SessionExpiredError(f"会话已过期，服务器返回登录页: {url}")
+                if response.status_code == 416 and offset:
+                    os.remove(part_path)  # 续传位置无效，从头下载
+                    continue
                 response.raise_for_status()  # 如果状态码不是200，将触发重试或抛出异常
 
-                with open(save_path, "wb") as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
+                mode = _resume_write_mode(
+                    response.status_code, response.headers.get("Content-Range"), offset
+                )
+                if mode == "wb":
+                    hasher = hashlib.sha256()
+                received = write_time = 0
+                with _open_part_file(part_path, mode, offset) as f:
+                    content_length = response.headers.get("Content-Length")
+                    preallocated = self.preallocate_files and _preallocate(
+                        f, f.tell(), int(content_length or 0)
+                    )
+                    try:
+                        # 较大的块减少 Python 层的循环次数 (每块仍会分配新的 bytes)
+                        for chunk in response.iter_content(
+                            chunk_size=self.download_chunk_size
+                        ):
+                            write_started = time.perf_counter()
                             f.write(chunk)
+                            write_time += time.perf_counter() - write_started
+                            hasher.update(chunk)
+                            received += len(chunk)
+                    finally:
+                        if preallocated:
+                            f.truncate()  # 去掉未写入的预分配部分
+                    # 写入位置即文件大小，无需再 stat
+                    size = f.tell()
+                self.metrics.observe("disk_write", write_time)
+                self.metrics.inc("download_bytes", received)
+                headers = response.headers
+            break
+
+        # 下载完整后原子替换，中断的下载不会留下看似完整的文件
+        os.replace(part_path, save_path)
+        return headers, hasher, size
+
+    def _transfer_adaptive(self, url, save_path):
+        """
+        [线程工作函数] 在自适应并发控制下执行 _transfer。
+        429/5xx/超时会反馈给控制器并按 Retry-After (或指数退避) 重试，
+        重试时从 .part 文件续传。
+        """
+        for attempt in range(self.adaptive_retries + 1):
+            retry_after = None
+            self._concurrency.acquire()
+            try:
+                # 先获取令牌再计时，限速等待不计入反馈给控制器的延迟
+                self._throttle(url)
+                started = time.monotonic()
+                result = self._transfer(url, save_path, throttled=True)
+                self._concurrency.record_success(time.monotonic() - started)
+                return result
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code not in RETRYABLE_STATUSES:
+                    raise
+                retry_after = _parse_retry_after(e.response.headers.get("Retry-After"))
+                self._concurrency.record_congestion(retry_after)
+                if attempt >= self.adaptive_retries:
+                    raise
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ):
+                self._concurrency.record_congestion()
+                if attempt >= self.adaptive_retries:
+                    raise
+            finally:
+                self._concurrency.release()
+            time.sleep(retry_after or 0.5 * (2**attempt))
+
+    def _resume_validator(self, url):
+        """返回状态库中记录的 ETag (或 Last-Modified)，用作续传请求的 If-Range"""
+        if self._state is None:
+            return None
+        record = self._state.get_file(url)
+        if not record:
+            return None
+        return record["etag"] or record["last_modified"]
+
+    def _freshness_headers(self, url, size):
+        """
+        构造条件请求头。仅当本地文件大小与状态库记录一致时才使用 ETag/Last-Modified，
+        否则本地文件可能不完整，应改用 Content-Length 比较。
+        """
+        record = self._state.get_file(url) if self._state is not None else None
+        headers = {}
+        if record and record["size"] == size:
+            if record["etag"]:
+                headers["If-None-Match"] = record["etag"]
+            if record["last_modified"]:
+                headers["If-Modified-Since"] = record["last_modified"]
+        return headers
+
+    def _is_fresh_response(self, status, response_headers, conditional, size):
+        """
+        根据 HEAD 响应判断本地文件是否仍然有效:
+        - 304: 未修改
+        - 发送了条件头却返回 200: 除非 ETag/Last-Modified 与记录相同，否则服务器端已变化
+        - 无条件头时比较 Content-Length 与本地大小，不一致说明文件已变化或不完整
+        """
+        if status == 304:
+            return True
+        if status >= 400:
+            # 服务器不支持 HEAD 或暂时出错，保守地保留本地文件
+            return True
+        if conditional:
+            # 部分服务器忽略条件头直接返回 200，此时比较校验值本身
+            etag = response_headers.get("ETag")
+            last_modified = response_headers.get("Last-Modified")
+            if etag and etag == conditional.get("If-None-Match"):
+                return True
+            if last_modified and last_modified == conditional.get("If-Modified-Since"):
+                return True
+            return False
+        content_length = response_headers.get("Content-Length")
+        if content_length is None:
+            return True  # 无法判断，保留本地文件
+        return int(content_length) == size
+
+    def _check_existing_file(self, url, save_path, size):
+        """[线程工作函数] 对已存在的文件发送 HEAD (带条件头) 校验，返回是否仍然有效"""
+        headers = self._freshness_headers(url, size)
+        try:
+            self._throttle(url)
+            response = self.download_session.head(
+                url, headers=headers, timeout=self.timeout, allow_redirects=True
+            )
+        except Exception as e:
+            self._log("WARN", f"校验已存在文件失败，保留本地文件: {save_path} | {e}")
+            return True
+        fresh = self._is_fresh_response(
+            response.status_code, response.headers, headers, size
+        )
+        if not fresh:
+            self._log("INFO", f"文件已变化或不完整，重新下载: {save_path}")
+        return fresh
+
+    async def _check_existing_file_async(self, url, save_path, size):
+        """[协程工作函数] _check_existing_file 的异步引擎版本"""
+        headers = self._freshness_headers(url, size)
+        try:
+            await self._throttle_async(url)
+            status, response_headers = await self._async_engine.head(url, headers)
+        except Exception as e:
+            self._log("WARN", f"校验已存在文件失败，保留本地文件: {save_path} | {e}")
+            return True
+        fresh = self._is_fresh_response(status, response_headers, headers, size)
+        if not fresh:
+            self._log("INFO", f"文件已变化或不完整，重新下载: {save_path}")
+        return fresh
+
+    async def _download_file_async(
+        self, task_type, identifier, url, save_path, queued_at=None
+    ):
+        """
+        [协程工作函数] 异步引擎版本的 _download_file，
+        与线程版本有相同的 exists / success / failed 日志语义。
+        """
+        if queued_at is not None:
+            self.metrics.observe("download_queue_wait", time.perf_counter() - queued_at)
+        start_time = time.time()
+        file_name = os.path.basename(save_path)
+
+        try:
+            # 1. 检查文件是否已存在
+            size = _file_size(save_path)
+            if size is not None:
+                if (
+                    not self._revalidate_existing
+                    or await self._check_existing_file_async(url, save_path, size)
+                ):
+                    self._record_file_state(url, save_path, size, "exists")
+                    self.log_result_to_csv(
+                        task_type, identifier, file_name, "exists", size / 1024, url, 0
+                    )
+                    self._register_content(url, save_path, size)
+                    self._after_download(task_type, identifier, save_path, url)
+                    return True  # 已存在，视为成功
+
+            if self._link_duplicate(task_type, identifier, url, save_path):
+                return True
+
+            # 2. 未启用限速器时随机休眠，协程等待不占用线程；
+            #    限速器的令牌由下载引擎在每次请求前获取
+            if self._rate_limiter is None:
+                await asyncio.sleep(random.uniform(0.1, 0.5))
+
+            # 3. 下载 (.part 临时文件 + Range 续传)
+            with self.metrics.timer("download"):
+                info = await self._call_with_reauth_async(
+                    self._async_engine.fetch_to_file,
+                    url,
+                    save_path,
+                    self._resume_validator(url),
+                )
 
             # 4. 记录成功
-            size_kb = os.path.getsize(save_path) / 1024
+            size = info.pop("size")
+            self._record_file_state(url, save_path, size, "success", **info)
             elapsed = time.time() - start_time
             self.log_result_to_csv(
-                task_type, identifier, file_name, "success", size_kb, url, elapsed
+                task_type, identifier, file_name, "success", size / 1024, url, elapsed
             )
+            self._register_content(url, save_path, size, info.get("sha256"))
+            self._after_download(task_type, identifier, save_path, url)
             return True
 
         except Exception as e:
@@ -268,109 +3383,404 @@ class ThermoMastoCrawler:
             self.log_result_to_csv(
                 task_type, identifier, file_name, "failed", 0, url, elapsed, str(e)
             )
-            # 将异常抛出，以便tqdm循环可以捕获它
             raise e
 
+    def _after_download(self, task_type, identifier, save_path, url):
+        """
+        文件已就绪 (新下载或已存在) 后的处理: 按需将图片交给校验进程池，
+        将患者的热矩阵交给转换线程
+        """
+        if self._image_processor is not None and IMAGE_HREF_RE.search(save_path):
+            self._image_processor.submit(task_type, identifier, url, save_path)
+        if (
+            self._thermal_converter is None
+            or task_type != self.TASK_PATIENT
+            or not save_path.lower().endswith(".txt")
+        ):
+            return
+        patient_id = identifier.removeprefix("Patient_")
+        self._thermal_converter.submit(save_path, patient_id)
+
+    def _reject_invalid_image(self, task_type, identifier, url, save_path, error):
+        """
+        [图片校验回调] 无法解码的图片改名为 .invalid 保留以便排查，
+        在日志中记为 "invalid" 并更新状态库，下次运行会重新下载
+        """
+        self._log("WARN", f"图片无法解码，已标记为无效: {save_path} | {error}")
+        if self._file_index is not None:
+            self._file_index.discard(save_path)
+        try:
+            os.replace(save_path, save_path + INVALID_SUFFIX)
+        except OSError as e:
+            self._log("ERROR", f"移除无效图片失败: {save_path} | {e}")
+        self.log_result_to_csv(
+            task_type,
+            identifier,
+            os.path.basename(save_path),
+            "invalid",
+            0,
+            url,
+            0,
+            error or "",
+        )
+        self._record_file_state(url, save_path, 0, "invalid")
+
+    def _link_duplicate(self, task_type, identifier, url, save_path):
+        """
+        [去重] 同一 URL 在其他路径已有完整副本时，硬链接 (或复制) 到 save_path，
+        记为 "linked" 并返回 True；否则返回 False，由调用方正常下载
+        """
+        if self._dedup is None:
+            return False
+        try:
+            size = self._dedup.link_known_url(url, save_path)
+        except OSError as e:
+            self._log("WARN", f"链接已有副本失败，改为下载: {save_path} | {e}")
+            return False
+        if size is None:
+            return False
+        self.metrics.inc("dedup_skipped_bytes", size)
+        self.log_result_to_csv(
+            task_type,
+            identifier,
+            os.path.basename(save_path),
+            "linked",
+            size / 1024,
+            url,
+            0,
+        )
+        self._after_download(task_type, identifier, save_path, url)
+        return True
+
+    def _register_content(self, url, save_path, size, sha256=None):
+        """[去重] 登记已就绪的文件，内容与已有文件相同时替换为硬链接"""
+        if self._dedup is None:
+            return
+        try:
+            saved = self._dedup.add(url, save_path, size, sha256)
+        except Exception as e:
+            self._log("WARN", f"内容去重失败: {save_path} | {e}")
+            return
+        if saved:
+            self.metrics.inc("dedup_linked_bytes", saved)
+
+    def _record_file_state(self, url, save_path, size, status, **info):
+        """将文件下载结果写入状态库 (未启用状态库时不做任何事)"""
+        if self._state is None:
+            return
+        try:
+            self._state.record_file(url, save_path, size, status, **info)
+        except Exception as e:
+            self._log("WARN", f"写入状态库失败: {url} | {e}")
+
+    def _current_file_record(self, url):
+        """
+        [增量] 返回状态库中已完成且本地文件大小一致的文件记录，
+        这样的文件无需再次下载；否则返回 None。
+        """
+        if self._state is None or self._force_refresh or self._revalidate_existing:
+            return None
+        record = self._state.get_file(url)
+        if not record or record["status"] not in ("success", "exists"):
+            return None
+        if self._local_size(record["save_path"]) == record["size"]:
+            return record
+        return None
+
+    def _local_size(self, path):
+        """本地文件大小 (不存在时为 None)，已扫描的目录直接查索引，不访问文件系统"""
+        if self._file_index is not None:
+            size = self._file_index.size(path)
+            if size is not ExistingFileIndex.NOT_INDEXED:
+                return size
+        return _file_size(path)
+
+    def _skip_existing(self, task_type, identifier, url, save_path, size):
+        """记录提交前即判定已存在的文件 (日志由后台写入器批量写盘)"""
+        self.log_result_to_csv(
+            task_type, identifier, os.path.basename(save_path), "exists", size / 1024, url, 0
+        )
+        self._register_content(url, save_path, size)
+        self._after_download(task_type, identifier, save_path, url)
+        with self.log_lock:
+            self._skipped_existing += 1
+
+    def _submit_download(
+        self, executor, task_type, identifier, url, save_path, kind="gallery"
+    ):
+        """
+        提交单个下载任务到线程池 (或异步引擎的事件循环)，返回 Future。
+        run() 期间经由优先级调度器派发，kind ("thermal_matrix" / "patient_image" /
+        "gallery") 决定优先级；若设置了下载队列上限，积压已满时阻塞提交方。
+        状态库确认已完成、或已有文件索引中存在的文件直接记为 "exists"，
+        不进入下载队列，返回 None。
+        """
+        record = self._current_file_record(url)
+        # 同一 URL 可能被多个任务保存到不同路径，状态库只记录其中一个
+        if record is not None and (
+            record["save_path"] == save_path
+            or self._local_size(save_path) is not None
+        ):
+            self._skip_existing(task_type, identifier, url, save_path, record["size"])
+            return None
+        if self._file_index is not None and not self._revalidate_existing:
+            size = self._file_index.size(save_path)
+            if size is not None and size is not ExistingFileIndex.NOT_INDEXED:
+                self._skip_existing(task_type, identifier, url, save_path, size)
+                return None
+
+        queued_at = time.perf_counter()
+        args = (task_type, identifier, url, save_path, queued_at)
+        if self._scheduler is not None:
+            fn = (
+                self._download_file_async
+                if self._async_engine is not None
+                else self._download_file
+            )
+            return self._scheduler.submit(self._download_priority(kind), fn, *args)
+        if self._async_engine is not None:
+            return self._async_engine.run(self._download_file_async(*args))
+        return executor.submit(self._download_file, *args)
+
+    def _download_priority(self, kind):
+        """下载类别的优先级，未配置的类别排在所有已配置类别之后"""
+        priority = self._download_priorities.get(kind)
+        if priority is None:
+            priority = max(self._download_priorities.values(), default=0) + 1
+        return priority
+
+    def _launch_download(self, executor, fn, *args):
+        """[调度器回调] 启动一个下载任务，返回 concurrent.futures.Future"""
+        if self._async_engine is not None:
+            return self._async_engine.run(fn(*args))
+        return executor.submit(fn, *args)
+
+    def _patient_completed(self, record):
+        """[回调] 某位患者的全部文件已结束"""
+        self.metrics.inc("patients_completed")
+        if record["failed"]:
+            self._log(
+                "WARN",
+                f"患者 {record['id']} 的 {record['files']} 个文件已结束，"
+                f"其中 {record['failed']} 个失败",
+            )
+        else:
+            self._log("INFO", f"患者 {record['id']} 的 {record['files']} 个文件已全部完成")
+
     ## ----------------------------------------------------------------
     ## 任务1: 爬取图片库
     ## ----------------------------------------------------------------
 
-    def submit_gallery_tasks(self, executor, save_dir, max_pages=None):
+    def _gallery_page_is_current(self, page_num, previous_total):
         """
-        [Selenium 驱动] 遍历图片库页面，自动解析总页数，提交下载任务到线程池。
-        返回 Future 列表。
-
-        Args:
-            executor: 线程池执行器。
-            save_dir: 保存目录。
-            max_pages (int, optional): 最大爬取页数。None表示爬取所有页。
+        [增量] 判断图片库页面是否可跳过: 该页已记录且所有图片均已下载完成。
+        上次的最后一页及之后的页面可能出现新图片，始终重新访问。
         """
-        self._log("INFO", "--- 开始任务 1: 爬取图片库 ---")
-        os.makedirs(save_dir, exist_ok=True)
+        if self._state is None or self._force_refresh:
+            return False
+        if previous_total is None or page_num >= previous_total:
+            return False
+        image_urls = self._state.get_gallery_page(page_num)
+        if not image_urls:
+            return False
+        return all(self._current_file_record(url) for url in image_urls)
 
-        # 访问第一页
-        base_page_url = f"{self.base_url}images.php?p=1&pos=7&prot=4&race=0&pagina=1"
-        self.driver.get(base_page_url)
-        time.sleep(random.uniform(0.5, 1.5))
+    def _parse_gallery_page(self, page_source):
+        """解析图片库页面，一次解析同时返回 (分页中的最大页码, 图片 URL 列表)"""
+        with self.metrics.timer("parse_gallery"):
+            parsed = self.parser.gallery(page_source)
 
         # 解析总页数
-        soup = BeautifulSoup(self.driver.page_source, "html.parser")
-        pagination = soup.find("div", class_="pagination")
-        total_pages = 1
-        if pagination:
-            page_numbers = []
-            for li in pagination.find_all("li"):
-                a = li.find("a")
-                if a and "Next" not in a.get_text(strip=True):
-                    m = re.search(r"pagina=(\d+)", a.get("href", ""))
-                    if m:
-                        page_numbers.append(int(m.group(1)))
-            if page_numbers:
-                total_pages = max(page_numbers)
-        self._log("INFO", f"解析到图片库总页数: {total_pages}")
+        page_numbers = []
+        for text, href in parsed["pagination"]:
+            if "Next" not in text:
+                m = PAGINA_RE.search(href)
+                if m:
+                    page_numbers.append(int(m.group(1)))
+        total_pages = max(page_numbers) if page_numbers else 1
 
-        # 根据 max_pages 确定要爬取的页数
-        pages_to_scrape = total_pages
-        if max_pages is not None:
-            pages_to_scrape = min(total_pages, max_pages)
-            self._log(
-                "INFO",
-                f"计划爬取 {pages_to_scrape} / {total_pages} 页 (上限: {max_pages})",
+        # 解析图片链接
+        image_urls = [
+            urljoin(self.base_url, href.strip(" '\"\n"))
+            for href in parsed["images"]
+            if href
+        ]
+        return total_pages, image_urls
+
+    def _submit_gallery_page(self, executor, save_dir, page_num, page_url, image_urls):
+        """提交某一图片库页面中所有图片的下载任务，并记录到状态库"""
+        futures = []
+        for img_url in image_urls:
+            img_name = os.path.basename(urlparse(img_url).path)
+            save_path = os.path.join(save_dir, img_name)
+            future = self._submit_download(
+                executor,
+                self.TASK_GALLERY,
+                f"Page_{page_num}",
+                img_url,
+                save_path,
+                kind="gallery",
             )
-        else:
-            self._log("INFO", f"计划爬取 {pages_to_scrape} / {total_pages} 页 (无上限)")
+            if future is not None:
+                futures.append(future)
+        if self._state is not None:
+            self._state.record_gallery_page(page_num, page_url, image_urls)
+        return futures
 
+    def _scrape_gallery_pages_browser(self, executor, save_dir, base_page_url, pages):
+        """[Selenium 驱动] 逐页用浏览器加载图片库页面并提交下载任务"""
         futures = []
 
         # 遍历每一页，使用 tqdm 进度条
-        for page_num in tqdm(
-            range(1, pages_to_scrape + 1), desc="[任务1] 爬取图片库页面"
-        ):
-            page_url = re.sub(r"pagina=\d+", f"pagina={page_num}", base_page_url)
+        for page_num in tqdm(pages, desc="[任务1] 爬取图片库页面"):
+            page_url = PAGINA_RE.sub(f"pagina={page_num}", base_page_url)
             try:
-                self.driver.get(page_url)
-                time.sleep(random.uniform(0.5, 1.5))
-                soup = BeautifulSoup(self.driver.page_source, "html.parser")
-                imagem_divs = soup.find_all("div", class_="imagem")
+                self._navigate(page_url, "gallery_page")
+                self._legacy_sleep((0.5, 1.5))
+                _, image_urls = self._parse_gallery_page(self.driver.page_source)
 
-                if not imagem_divs:
+                if not image_urls:
                     self._log("WARN", f"第 {page_num} 页未找到任何图片")
                     continue
 
-                for div in imagem_divs:
-                    a_tag = div.find(
-                        "a",
-                        href=re.compile(
-                            r"\.(jpg|jpeg|png|bmp|gif|tif|tiff)$", re.IGNORECASE
-                        ),
+                futures.extend(
+                    self._submit_gallery_page(
+                        executor, save_dir, page_num, page_url, image_urls
                     )
-                    if not a_tag:
-                        continue
+                )
+
+            except Exception as e:
+                self._log("ERROR", f"分析第 {page_num} 页失败: {e}")
+
+            # 模拟翻页延迟
+            self._page_delay()
+
+        return futures
+
+    def _scrape_gallery_pages_http(
+        self, executor, save_dir, base_page_url, pages, first_page_images, page_workers
+    ):
+        """
+        [Requests 驱动] 用页面线程池并发获取并解析图片库页面。
+        每解析完一页就立即提交该页的下载任务，无需等待所有页面完成。
+        请求速率由限速器控制 (见 run() 的 rate_limit)。
+        """
+        futures = []
+
+        def fetch_page(page_num):
+            page_url = PAGINA_RE.sub(f"pagina={page_num}", base_page_url)
+            if page_num == 1:
+                return page_url, first_page_images  # 第一页已解析，无需重复请求
+            self._page_delay()
+            _, image_urls = self._parse_gallery_page(
+                self._fetch_page(page_url, "gallery_page")
+            )
+            return page_url, image_urls
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=page_workers, thread_name_prefix="gallery-page"
+        ) as page_pool:
+            page_futures = {
+                page_pool.submit(fetch_page, page_num): page_num for page_num in pages
+            }
+            for page_future in tqdm(
+                concurrent.futures.as_completed(page_futures),
+                total=len(page_futures),
+                desc="[任务1] 爬取图片库页面",
+            ):
+                page_num = page_futures[page_future]
+                try:
+                    page_url, image_urls = page_future.result()
+                except Exception as e:
+                    self._log("ERROR", f"分析第 {page_num} 页失败: {e}")
+                    continue
+
+                if not image_urls:
+                    self._log("WARN", f"第 {page_num} 页未找到任何图片")
+                    continue
+
+                futures.extend(
+                    self._submit_gallery_page(
+                        executor, save_dir, page_num, page_url, image_urls
+                    )
+                )
+
+        return futures
+
+    def submit_gallery_tasks(self, executor, save_dir, max_pages=None, page_workers=4):
+        """
+        [Selenium / Requests 驱动] 遍历图片库页面，自动解析总页数，提交下载任务到线程池。
+        返回 Future 列表。
+
+        Args:
+            executor: 线程池执行器。
+            save_dir: 保存目录。
+            max_pages (int, optional): 最大爬取页数。None表示爬取所有页。
+            page_workers (int): 并发获取页面的线程数，仅 Requests 模式下生效。
+        """
+        self._log("INFO", "--- 开始任务 1: 爬取图片库 ---")
+        os.makedirs(save_dir, exist_ok=True)
+
+        # 访问第一页
+        base_page_url = f"{self.base_url}images.php?p=1&pos=7&prot=4&race=0&pagina=1"
+        if self.page_fetch_mode == self.FETCH_REQUESTS:
+            first_page_source = self._fetch_page(base_page_url, "gallery_page")
+        else:
+            self._navigate(base_page_url, "gallery_page")
+            self._legacy_sleep((0.5, 1.5))
+            first_page_source = self.driver.page_source
 
-                    href = a_tag.get("href")
-                    if not href:
-                        continue
+        # 解析总页数
+        total_pages, first_page_images = self._parse_gallery_page(first_page_source)
+        self._log("INFO", f"解析到图片库总页数: {total_pages}")
 
-                    img_url = urljoin(self.base_url, href.strip(" '\"\n"))
-                    img_name = os.path.basename(urlparse(img_url).path)
-                    save_path = os.path.join(save_dir, img_name)
-
-                    # 提交下载任务
-                    f = executor.submit(
-                        self._download_file,
-                        self.TASK_GALLERY,
-                        f"Page_{page_num}",
-                        img_url,
-                        save_path,
-                    )
-                    futures.append(f)
+        # 根据 max_pages 确定要爬取的页数
+        pages_to_scrape = total_pages
+        if max_pages is not None:
+            pages_to_scrape = min(total_pages, max_pages)
+            self._log(
+                "INFO",
+                f"计划爬取 {pages_to_scrape} / {total_pages} 页 (上限: {max_pages})",
+            )
+        else:
+            self._log("INFO", f"计划爬取 {pages_to_scrape} / {total_pages} 页 (无上限)")
 
-            except Exception as e:
-                self._log("ERROR", f"分析第 {page_num} 页失败: {e}")
+        # [增量] 上次记录的总页数，用于判断哪些页面可以跳过
+        previous_total = None
+        if self._state is not None:
+            previous_total = self._state.get_meta("gallery_total_pages")
+            previous_total = int(previous_total) if previous_total else None
+            self._state.set_meta("gallery_total_pages", total_pages)
+        shard_pages = [p for p in range(1, pages_to_scrape + 1) if self._in_shard(p)]
+        if self._shard is not None:
+            self._log(
+                "INFO",
+                f"分片 {self._shard[0]}/{self._shard[1]}: "
+                f"负责 {len(shard_pages)} / {pages_to_scrape} 页",
+            )
+        pages = [
+            page_num
+            for page_num in shard_pages
+            if not self._gallery_page_is_current(page_num, previous_total)
+        ]
+        skipped_pages = len(shard_pages) - len(pages)
 
-            # 模拟翻页延迟
-            time.sleep(random.uniform(*self.delay_range))
+        if self.page_fetch_mode == self.FETCH_REQUESTS:
+            futures = self._scrape_gallery_pages_http(
+                executor,
+                save_dir,
+                base_page_url,
+                pages,
+                first_page_images,
+                max(1, page_workers),
+            )
+        else:
+            futures = self._scrape_gallery_pages_browser(
+                executor, save_dir, base_page_url, pages
+            )
 
+        if skipped_pages:
+            self._log("INFO", f"[增量] 跳过 {skipped_pages} 个已完整下载的图片库页面")
         self._log("SUCCESS", f"图片库任务提交完毕，共 {len(futures)} 个文件待下载。")
         return futures
 
@@ -389,14 +3799,15 @@ class ThermoMastoCrawler:
             )
 
             if patient_list_links:
+                self._throttle(self.base_url)
                 patient_list_links[0].click()
-                time.sleep(random.uniform(*self.delay_range))
+                self._page_delay()
                 return True
 
             # 如果点击失败，尝试直接访问
             self._log("WARN", "未找到'Patient List'链接，尝试直接访问 patients.php")
-            self.driver.get(f"{self.base_url}/patients.php")
-            time.sleep(random.uniform(*self.delay_range))
+            self._navigate(f"{self.base_url}/patients.php")
+            self._page_delay()
             if "patients.php" in self.driver.current_url:
                 return True
 
@@ -405,47 +3816,83 @@ class ThermoMastoCrawler:
             self._log("ERROR", f"导航到患者列表失败: {e}")
             return False
 
-    def _extract_patient_list(self):
-        """[Selenium 驱动] 提取所有页面的患者列表"""
-        patients_all = []
+    def _parse_patient_table(self, page_source, page):
+        """
+        解析患者列表页中的 id='mytable' 表格，返回 (DataFrame, 页面中的链接列表)。
+        未找到表格时 DataFrame 为 None。
+        """
+        with self.metrics.timer("parse_list"):
+            parsed = self.parser.patient_list(page_source)
+        if parsed is None:
+            return None, []
+
+        rows = [
+            cells + [urljoin(self.base_url, href) if href else None]
+            for cells, href in parsed["rows"]
+        ]
+        df = pd.DataFrame(rows, columns=parsed["headers"] + ["detail_url"])
+        df["page"] = page
+        return df, parsed["links"]
+
+    def _find_next_page_url(self, links, current_url):
+        """[Requests 驱动] 从页面的 (链接文本, href) 列表中查找“下一页”链接的绝对地址"""
+        for text, href in links:
+            if "Next" not in text and "»" not in text:
+                continue
+            href = href.strip()
+            if not href or href.startswith(("#", "javascript:")):
+                return None
+            next_url = urljoin(current_url, href)
+            return next_url if next_url != current_url else None
+        return None
+
+    def _iter_patient_list_pages(self):
+        """
+        [Selenium / Requests 驱动] 逐页解析患者列表，每解析完一页即 yield 该页的 DataFrame。
+        流水线模式下，下游阶段无需等待全部列表页解析完毕即可开始处理。
+        """
         page = 1
+        page_url = urljoin(self.base_url, "patients.php")
 
         while True:
             self._log("INFO", f"正在解析患者列表第 {page} 页...")
             try:
-                page_source = self.driver.page_source
-                soup = BeautifulSoup(page_source, "html.parser")
-                table = soup.find("table", id="mytable")
-                if table is None:
+                if self.page_fetch_mode == self.FETCH_REQUESTS:
+                    page_source = self._fetch_page(page_url, "list_page")
+                else:
+                    page_source = self.driver.page_source
+
+                df, links = self._parse_patient_table(page_source, page)
+                if df is None:
                     self._log("WARN", "未找到 id='mytable' 的表格，列表解析终止。")
                     break
 
-                headers = [th.get_text(strip=True) for th in table.find_all("th")]
-                rows = []
-
-                for tr in table.find_all("tr")[1:]:  # 跳过表头
-                    cols = tr.find_all("td")
-                    if not cols:
-                        continue
-                    row = [col.get_text(strip=True) for col in cols]
-                    link = tr.find("a", href=re.compile(r"details\.php\?id="))
-                    row.append(urljoin(self.base_url, link["href"]) if link else None)
-                    rows.append(row)
-
-                df = pd.DataFrame(rows, columns=headers + ["detail_url"])
-                df["page"] = page
-                patients_all.append(df)
                 self._log("INFO", f"第 {page} 页提取到 {len(df)} 个患者记录")
+                yield df
 
                 # --- 查找“下一页”按钮 ---
+                if self.page_fetch_mode == self.FETCH_REQUESTS:
+                    next_url = self._find_next_page_url(links, page_url)
+                    if next_url:
+                        self._log("INFO", "进入下一页...")
+                        page_url = next_url
+                        self._page_delay()
+                        page += 1
+                    else:
+                        self._log("INFO", "没有更多页面，患者列表解析结束。")
+                        break
+                    continue
+
                 next_link_elem = self.driver.find_elements(
                     By.XPATH, "//a[contains(text(), 'Next') or contains(text(), '»')]"
                 )
 
                 if next_link_elem:
                     self._log("INFO", "进入下一页...")
-                    next_link_elem[0].click()
-                    time.sleep(random.uniform(*self.delay_range))
+                    self._throttle(self.base_url)
+                    with self.metrics.timer("list_page"):
+                        next_link_elem[0].click()
+                    self._page_delay()
                     page += 1
                 else:
                     self._log("INFO", "没有更多页面，患者列表解析结束。")
@@ -454,17 +3901,29 @@ class ThermoMastoCrawler:
                 self._log("ERROR", f"解析患者列表第 {page} 页失败: {e}")
                 break
 
+    def _extract_patient_list(self):
+        """[Selenium / Requests 驱动] 提取所有页面的患者列表"""
+        patients_all = list(self._iter_patient_list_pages())
         if not patients_all:
             return pd.DataFrame()
 
         result = pd.concat(patients_all, ignore_index=True)
-        self._log("SUCCESS", f"共提取到 {len(result)} 个患者信息（共 {page - 1} 页）")
+        self._log(
+            "SUCCESS",
+            f"共提取到 {len(result)} 个患者信息（共 {len(patients_all)} 页）",
+        )
         return result
 
-    def _extract_patient_details(self, current_url):
-        """[Selenium 驱动] 提取患者详情页面的结构化信息"""
+    def _extract_patient_details(self, current_url, page_source=None):
+        """
+        [Selenium / Requests 驱动] 提取患者详情页面的结构化信息。
+        page_source 为 None 时从当前浏览器页面读取。
+        """
         try:
-            soup = BeautifulSoup(self.driver.page_source, "html.parser")
+            if page_source is None:
+                page_source = self._browser().page_source
+            with self.metrics.timer("parse_detail"):
+                parsed = self.parser.patient_details(page_source)
             details = {
                 "page_url": current_url,
                 "scraped_at": time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -474,77 +3933,38 @@ class ThermoMastoCrawler:
                 "register_date": None,
                 "marital_status": None,
                 "race": None,
-                "diagnosis": None,
+                "diagnosis": parsed["diagnosis"],
                 "personal_history": None,
-                "medical_history": None,
-                "protocol_recommendations": None,
+                "medical_history": parsed["history"],
+                "protocol_recommendations": parsed["protocol"],
                 "temperature": None,
                 "files": [],
             }
 
-            # 信息块
-            info_div = soup.find("div", class_="descripcion1")
-            if info_div:
-                text = info_div.get_text(" ", strip=True)
-                id_match = re.search(r"ID:\s*(\d+)", text)
-                if id_match:
-                    details["id"] = id_match.group(1)
-                p_tags = info_div.find_all("p")
-                if len(p_tags) >= 2:
-                    details["name"] = p_tags[1].get_text(strip=True)
-                age_match = re.search(r"(\d+)\s*years", text)
-                if age_match:
-                    details["age"] = int(age_match.group(1))
-                reg_match = re.search(r"Registered at\s*([\d-]+)", text)
-                if reg_match:
-                    details["register_date"] = reg_match.group(1)
-                mar_match = re.search(r"Marital status:\s*([\w\s]+)", text)
-                if mar_match:
-                    details["marital_status"] = mar_match.group(1).strip(". ")
-                race_match = re.search(r"Race:\s*([\w\s]+)", text)
-                if race_match:
-                    details["race"] = race_match.group(1).strip(". ")
-
-            # 诊断
-            diag_p = soup.find("p", class_="view-diagnostico")
-            if diag_p:
-                span = diag_p.find("span")
-                if span:
-                    details["diagnosis"] = span.get_text(strip=True)
-
-            # 其他描述
-            mh_div = soup.find("div", class_="descripcion2")
-            if mh_div:
-                details["medical_history"] = mh_div.get_text(" ", strip=True)
-            pr_div = soup.find("div", class_="descripcion3")
-            if pr_div:
-                details["protocol_recommendations"] = pr_div.get_text(" ", strip=True)
-                temp_match = re.search(
-                    r"Body temperature:\s*([\d.]+)", details["protocol_recommendations"]
-                )
-                if temp_match:
-                    details["temperature"] = float(temp_match.group(1))
+            # 信息块与体温 (位于推荐方案描述中) 按规则表提取
+            details.update(extract_detail_fields(parsed))
+            if parsed["info_text"] is not None and len(parsed["info_paragraphs"]) >= 2:
+                details["name"] = parsed["info_paragraphs"][1]
 
             # 文件链接
-            for file_div in soup.find_all("div", class_="imagenspaciente"):
-                for a in file_div.find_all("a", href=True):
-                    file_name = os.path.basename(urlparse(a["href"]).path)
-                    url = urljoin(self.base_url, a["href"])
-                    file_type = (
-                        "image"
-                        if file_name.lower().endswith((".jpg", ".png"))
-                        else "thermal_matrix"
-                        if file_name.lower().endswith(".txt")
-                        else "other"
-                    )
-                    details["files"].append(
-                        {
-                            "file_name": file_name,
-                            "title": a.get("title", ""),
-                            "url": url,
-                            "type": file_type,
-                        }
-                    )
+            for href, title in parsed["files"]:
+                file_name = os.path.basename(urlparse(href).path)
+                url = urljoin(self.base_url, href)
+                file_type = (
+                    "image"
+                    if file_name.lower().endswith((".jpg", ".png"))
+                    else "thermal_matrix"
+                    if file_name.lower().endswith(".txt")
+                    else "other"
+                )
+                details["files"].append(
+                    {
+                        "file_name": file_name,
+                        "title": title,
+                        "url": url,
+                        "type": file_type,
+                    }
+                )
             return details
         except Exception as e:
             self._log("ERROR", f"提取患者详情失败 ({current_url}): {e}")
@@ -554,106 +3974,438 @@ class ThermoMastoCrawler:
         """清理文件名，移除不安全字符"""
         return re.sub(r'[<>:"/\\|?*]', "_", filename)[:150]
 
-    def submit_patient_tasks(self, executor, save_dir):
+    def _patient_row_hash(self, row):
+        """患者列表行的内容哈希 (不含所在页码)，用于判断患者记录是否变化"""
+        data = {k: v for k, v in row._asdict().items() if k != "page"}
+        payload = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def _process_patient(self, executor, row, folders, label):
         """
-        [Selenium 驱动] 遍历患者列表，[提交]下载任务到线程池。
-        返回 Future 列表。
+        处理单个患者: 访问详情页、提取详情、保存JSON并提交文件下载任务。
+        返回 (patient_data, futures)，失败时 patient_data 为 None。
         """
-        self._log("INFO", "--- 开始任务 2: 爬取患者数据 ---")
-
-        # 创建子文件夹
-        images_folder = os.path.join(save_dir, "images")
-        thermal_folder = os.path.join(save_dir, "thermal_matrix")
-        metadata_folder = os.path.join(save_dir, "metadata")
-        os.makedirs(images_folder, exist_ok=True)
-        os.makedirs(thermal_folder, exist_ok=True)
-        os.makedirs(metadata_folder, exist_ok=True)
+        self._log(
+            "INFO",
+            f"--- [患者 {label}] 正在处理: {row.Records} (ID: {row.ID}) ---",
+        )
 
-        futures = []
-        all_patients_metadata = []  # 存储所有患者的JSON数据
+        if not row.detail_url:
+            self._log("WARN", f"患者 {row.ID} 没有详情URL，跳过。")
+            return None, []
 
-        try:
-            if not self._navigate_to_patient_list():
-                self._log("ERROR", "无法导航到患者列表，任务2终止。")
-                return []
+        # 0. [增量] 列表行未变化且已有详情记录的患者，直接复用状态库中的详情
+        row_hash = self._patient_row_hash(row)
+        patient_details = None
+        if self._state is not None and not self._force_refresh:
+            cached = self._state.get_patient(row.ID)
+            if cached and cached["row_hash"] == row_hash and cached["details"]:
+                patient_details = cached["details"]
+                self._log("INFO", f"患者 {row.ID} 未变化，复用状态库中的详情")
 
-            patients_df = self._extract_patient_list()
-            if patients_df.empty:
-                self._log("WARN", "未提取到任何患者信息，任务2终止。")
-                return []
+        if patient_details is None:
+            # 1. 访问详情页
+            page_source = None
+            try:
+                if self.page_fetch_mode == self.FETCH_REQUESTS:
+                    page_source = self._fetch_page(row.detail_url, "detail_fetch")
+                else:
+                    self._navigate(row.detail_url, "detail_fetch")
+            except Exception as e:
+                self._log("ERROR", f"访问患者 {row.ID} 详情页失败: {e}")
+                return None, []
+            finally:
+                self._page_delay()
 
-            total_patients = len(patients_df)
-            for i, row in enumerate(patients_df.itertuples(index=False), 1):
-                self._log(
-                    "INFO",
-                    f"--- [患者 {i}/{total_patients}] 正在处理: {row.Records} (ID: {row.ID}) ---",
+            # 2. 提取详情
+            patient_details = self._extract_patient_details(
+                row.detail_url, page_source
+            )
+            if not patient_details:
+                self._log("ERROR", f"无法提取患者 {row.ID} 的详情，跳过。")
+                return None, []
+            if self._state is not None:
+                self._state.record_patient(
+                    row.ID, row.detail_url, row_hash, patient_details
                 )
 
-                if not row.detail_url:
-                    self._log("WARN", f"患者 {row.ID} 没有详情URL，跳过。")
-                    continue
+        # 3. 合并信息 (将 DataFrame 的行转为 dict)
+        patient_data = row._asdict()
+        patient_data.update(patient_details)
 
-                # 1. 访问详情页
-                self.driver.get(row.detail_url)
-                time.sleep(random.uniform(*self.delay_range))
+        # 4. 保存元数据 (JSON)
+        if self._write_patient_json:
+            json_filename = self._sanitize_filename(
+                f"Patient_{row.ID}_{row.Records}.json"
+            )
+            json_path = os.path.join(folders["metadata"], json_filename)
+            try:
+                with self.metrics.timer("json_write"), open(
+                    json_path, "w", encoding="utf-8"
+                ) as f:
+                    json.dump(patient_data, f, ensure_ascii=False, indent=2)
+            except Exception as e:
+                self._log("ERROR", f"保存JSON失败: {json_path} | {e}")
 
-                # 2. 提取详情
-                patient_details = self._extract_patient_details(row.detail_url)
-                if not patient_details:
-                    self._log("ERROR", f"无法提取患者 {row.ID} 的详情，跳过。")
-                    continue
+        # 5. 提交文件下载任务
+        futures = []
+        patient_id = patient_details.get("id", row.ID)
+        for file_info in patient_details.get("files", []):
+            if file_info["type"] == "thermal_matrix":
+                save_path = os.path.join(folders["thermal"], file_info["file_name"])
+                kind = "thermal_matrix"
+            elif file_info["type"] == "image":
+                save_path = os.path.join(folders["images"], file_info["file_name"])
+                kind = "patient_image"
+            else:
+                continue  # 跳过 'other' 类型
 
-                # 3. 合并信息 (将 DataFrame 的行转为 dict)
-                patient_data = row._asdict()
-                patient_data.update(patient_details)
-                all_patients_metadata.append(patient_data)
+            future = self._submit_download(
+                executor,
+                self.TASK_PATIENT,
+                f"Patient_{patient_id}",
+                file_info["url"],
+                save_path,
+                kind=kind,
+            )
+            if self._completion is not None:
+                self._completion.track(patient_id, future)
+            if future is not None:
+                futures.append(future)
+        if self._completion is not None:
+            self._completion.seal(patient_id)
+        return patient_data, futures
 
-                # 4. 保存元数据 (JSON)
-                json_filename = self._sanitize_filename(
-                    f"Patient_{row.ID}_{row.Records}.json"
-                )
-                json_path = os.path.join(metadata_folder, json_filename)
-                try:
-                    with open(json_path, "w", encoding="utf-8") as f:
-                        json.dump(patient_data, f, ensure_ascii=False, indent=2)
-                except Exception as e:
-                    self._log("ERROR", f"保存JSON失败: {json_path} | {e}")
+    def _run_patient_pipeline(
+        self, executor, folders, metadata_stream, detail_workers, detail_queue_size
+    ):
+        """
+        [Requests / 浏览器池驱动] 流水线方式处理患者数据:
+        列表翻页 (1 个线程) -> 有界队列 -> 详情抓取与解析 (detail_workers 个线程)
+        -> 下载线程池。各阶段相互重叠，某个患者的详情解析不必等待上一个患者的文件下载。
+        Selenium 模式下列表页由主浏览器翻页，每个详情线程从浏览器池中独占一个浏览器，
+        从共享队列领取患者 (空闲的浏览器自动多领，相当于动态分区)。
+        患者元数据按列表顺序写入 metadata_stream，返回 Future 列表。
+        """
+        detail_queue = queue.Queue(maxsize=detail_queue_size)
+        results_lock = threading.Lock()
+        futures = []
+
+        def list_stage():
+            index = listed = 0
+            try:
+                for df in self._iter_patient_list_pages():
+                    for row in df.itertuples(index=False):
+                        listed += 1
+                        if not self._in_shard(row.ID):
+                            continue
+                        index += 1
+                        # 队列满时阻塞，形成背压
+                        detail_queue.put((index, listed, row, time.perf_counter()))
+                if self._shard is not None:
+                    self._log(
+                        "INFO",
+                        f"分片 {self._shard[0]}/{self._shard[1]}: "
+                        f"负责 {index} / {listed} 位患者",
+                    )
+            finally:
+                # 每个详情线程一个结束标记
+                for _ in range(detail_workers):
+                    detail_queue.put(None)
 
-                # 5. 提交文件下载任务
-                patient_id = patient_details.get("id", row.ID)
-                for file_info in patient_details.get("files", []):
-                    url = file_info["url"]
-                    file_name = file_info["file_name"]
+        def process(index, row):
+            try:
+                return self._process_patient(executor, row, folders, f"#{index}")
+            except Exception as e:
+                self._log("ERROR", f"处理患者 {row.ID} 时出错: {e}")
+                return None, []
 
-                    if file_info["type"] == "thermal_matrix":
-                        save_path = os.path.join(thermal_folder, file_name)
-                    elif file_info["type"] == "image":
-                        save_path = os.path.join(images_folder, file_name)
+        def detail_stage():
+            pool = self._browser_pool
+            driver = pool.acquire() if pool is not None else None
+            self._local.driver = driver
+            try:
+                while True:
+                    item = detail_queue.get()
+                    if item is None:
+                        break
+                    index, position, row, queued_at = item
+                    self.metrics.observe(
+                        "detail_queue_wait", time.perf_counter() - queued_at
+                    )
+                    if pool is not None and driver is None:
+                        # 浏览器已无法重启，继续消费队列以免阻塞列表阶段
+                        self._log("ERROR", f"没有可用的浏览器，跳过患者 {row.ID}")
+                        patient_data, patient_futures = None, []
                     else:
-                        continue  # 跳过 'other' 类型
-
-                    f = executor.submit(
-                        self._download_file,
-                        self.TASK_PATIENT,
-                        f"Patient_{patient_id}",
-                        url,
-                        save_path,
+                        patient_data, patient_futures = process(index, row)
+                    if (
+                        pool is not None
+                        and driver is not None
+                        and patient_data is None
+                        and not pool.is_alive(driver)
+                    ):
+                        # 浏览器崩溃: 替换为新实例后重试该患者一次
+                        self._log("WARN", f"浏览器已失效，正在重启 (患者 {row.ID})")
+                        try:
+                            driver = pool.replace(driver)
+                        except Exception as e:
+                            self._log("ERROR", f"浏览器重启失败: {e}")
+                            driver = None
+                        self._local.driver = driver
+                        if driver is not None:
+                            patient_data, patient_futures = process(index, row)
+                    with self.metrics.timer("jsonl_write"):
+                        metadata_stream.write(
+                            index, self._shard_record(patient_data, position)
+                        )
+                    with results_lock:
+                        futures.extend(patient_futures)
+            finally:
+                self._local.driver = None
+                if pool is not None:
+                    pool.release(driver)
+
+        threads = [threading.Thread(target=list_stage, name="patient-list")]
+        threads += [
+            threading.Thread(target=detail_stage, name=f"patient-detail-{n}")
+            for n in range(detail_workers)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return futures
+
+    def _shard_record(self, patient_data, position):
+        """分片模式下为患者元数据附加其在完整列表中的位置 (从 1 开始)，供合并时恢复原顺序"""
+        if self._shard is None or not patient_data:
+            return patient_data or None
+        return {**patient_data, SHARD_POSITION_FIELD: position}
+
+    def submit_patient_tasks(
+        self, executor, save_dir, detail_workers=1, detail_queue_size=100
+    ):
+        """
+        [Selenium / Requests 驱动] 遍历患者列表，[提交]下载任务到线程池。
+        返回 Future 列表。
+
+        Args:
+            executor: 线程池执行器。
+            save_dir: 保存目录。
+            detail_workers (int): 详情页抓取线程数，仅 Requests 模式下生效。
+            detail_queue_size (int): 列表阶段与详情阶段之间的队列容量。
+        """
+        self._log("INFO", "--- 开始任务 2: 爬取患者数据 ---")
+
+        # 创建子文件夹
+        folders = {
+            "images": os.path.join(save_dir, "images"),
+            "thermal": os.path.join(save_dir, "thermal_matrix"),
+            "metadata": os.path.join(save_dir, "metadata"),
+        }
+        for folder in folders.values():
+            os.makedirs(folder, exist_ok=True)
+
+        futures = []
+        # 患者元数据边爬边写入 JSON Lines，崩溃时已爬取的部分不会丢失
+        jsonl_path = self._output_path(
+            os.path.join(save_dir, "all_patients_metadata.jsonl")
+        )
+        metadata_stream = PatientMetadataStream(jsonl_path)
+
+        try:
+            if self.page_fetch_mode == self.FETCH_REQUESTS:
+                futures = self._run_patient_pipeline(
+                    executor,
+                    folders,
+                    metadata_stream,
+                    max(1, detail_workers),
+                    detail_queue_size,
+                )
+            elif self._browser_pool is not None:
+                # Selenium 模式 + 浏览器池: 主浏览器翻页，池中的浏览器并行访问详情页
+                if not self._navigate_to_patient_list():
+                    self._log("ERROR", "无法导航到患者列表，任务2终止。")
+                    return []
+                futures = self._run_patient_pipeline(
+                    executor,
+                    folders,
+                    metadata_stream,
+                    self._browser_pool.size,
+                    detail_queue_size,
+                )
+            else:
+                # Selenium 模式下只有一个浏览器，详情页只能串行访问
+                if detail_workers > 1:
+                    self._log(
+                        "WARN",
+                        "Selenium 模式需设置 browser_workers 才能并行抓取详情页，"
+                        "已按单线程处理",
                     )
-                    futures.append(f)
 
-            # 循环结束后，保存一个包含所有患者信息的总JSON文件
-            all_json_path = os.path.join(save_dir, "all_patients_metadata.json")
-            with open(all_json_path, "w", encoding="utf-8") as f:
-                json.dump(all_patients_metadata, f, ensure_ascii=False, indent=2)
-            self._log("SUCCESS", f"所有患者元数据已保存到: {all_json_path}")
+                if not self._navigate_to_patient_list():
+                    self._log("ERROR", "无法导航到患者列表，任务2终止。")
+                    return []
+
+                patients_df = self._extract_patient_list().reset_index(drop=True)
+                if self._shard is not None and not patients_df.empty:
+                    patients_df = patients_df[patients_df["ID"].map(self._in_shard)]
+                if patients_df.empty:
+                    self._log("WARN", "未提取到任何患者信息，任务2终止。")
+                    return []
+
+                total_patients = len(patients_df)
+                rows = zip(patients_df.index, patients_df.itertuples(index=False))
+                for i, (position, row) in enumerate(rows, 1):
+                    patient_data, patient_futures = self._process_patient(
+                        executor, row, folders, f"{i}/{total_patients}"
+                    )
+                    futures.extend(patient_futures)
+                    with self.metrics.timer("jsonl_write"):
+                        metadata_stream.write(
+                            i, self._shard_record(patient_data, position + 1)
+                        )
 
         except Exception as e:
             self._log("ERROR", f"爬取患者数据时发生严重错误: {e}")
             self._log("ERROR", traceback.format_exc())
+        finally:
+            metadata_stream.close()
+
+        if not metadata_stream.count:
+            self._log("WARN", "未提取到任何患者信息，任务2终止。")
+            return futures
+        self._log(
+            "SUCCESS",
+            f"{metadata_stream.count} 位患者的元数据已保存到: {jsonl_path}",
+        )
+
+        # 可选: 将 JSON Lines 压缩为包含所有患者信息的总JSON文件
+        if self._compact_metadata:
+            all_json_path = self._output_path(
+                os.path.join(save_dir, "all_patients_metadata.json")
+            )
+            try:
+                compact_metadata_jsonl(jsonl_path, all_json_path)
+                self._log("SUCCESS", f"所有患者元数据已保存到: {all_json_path}")
+            except Exception as e:
+                self._log("ERROR", f"压缩患者元数据失败: {all_json_path} | {e}")
 
         self._log("SUCCESS", f"患者数据任务提交完毕，共 {len(futures)} 个文件待下载。")
         return futures
 
+    def _export_metrics(self):
+        """将当前指标写入 metrics_file (未设置时不做任何事)"""
+        if not self._metrics_file:
+            return
+        try:
+            self.metrics.write_prometheus(self._metrics_file)
+        except OSError as e:
+            self._log("WARN", f"写入指标文件失败: {self._metrics_file} | {e}")
+
+    def _finish_metrics(self):
+        """结束计时，输出各阶段统计，写入指标文件并关闭指标端点"""
+        self.metrics.finished_at = time.time()
+        self._log("INFO", "--- 运行指标 ---")
+        for line in self.metrics.summary_lines():
+            self._log("INFO", line)
+        self._export_metrics()
+        self.metrics.stop_serving()
+
+    def _start_browser_pool(self, size):
+        """启动详情页浏览器池，全部启动失败时退回单浏览器串行处理"""
+        pool = BrowserPool(self._create_driver, size, prepare=self._share_login)
+        try:
+            with self.metrics.timer("browser_setup"):
+                started = pool.start()
+        except Exception as e:
+            self._log("WARN", f"浏览器池启动失败，详情页将串行处理: {e}")
+            pool.close()
+            return
+        self._browser_pool = pool
+        self._log("INFO", f"浏览器池已启动: {started} 个浏览器并行访问详情页")
+
+    def _close_image_processor(self):
+        """等待剩余的图片校验完成并关闭进程池"""
+        if self._image_processor is None:
+            return
+        processor = self._image_processor
+        processor.close()
+        self._image_processor = None
+        for error in processor.errors:
+            self._log("ERROR", error)
+        self._log(
+            "INFO",
+            f"图片校验: 有效 {processor.valid} 张，无效 {processor.invalid} 张 "
+            f"-> {processor.index_path}",
+        )
+
+    def _close_completion_tracker(self):
+        """输出患者完成进度的统计并关闭记录文件"""
+        if self._completion is None:
+            return
+        tracker = self._completion
+        tracker.close()
+        self._completion = None
+        incomplete = f"，未完成 {tracker.incomplete} 位" if tracker.incomplete else ""
+        self._log(
+            "INFO",
+            f"文件已全部结束的患者: {tracker.completed} 位{incomplete} -> {tracker.path}",
+        )
+
+    def _close_deduplicator(self):
+        """输出内容去重的统计并释放索引"""
+        if self._dedup is None:
+            return
+        dedup = self._dedup
+        self._log(
+            "INFO",
+            f"内容去重: 免下载 {dedup.skipped_downloads} 个文件 "
+            f"({dedup.skipped_bytes / 1024 / 1024:.2f} MB)，硬链接 {dedup.linked} 个 "
+            f"(节省磁盘 {dedup.linked_bytes / 1024 / 1024:.2f} MB)",
+        )
+        self._dedup = None
+
+    def _abort_startup(self):
+        """爬取开始前失败时，释放 run() 已经打开的资源"""
+        if self.driver:
+            self.driver.quit()
+        if self._state is not None:
+            self._state.close()
+            self._state = None
+        self._close_image_processor()
+        self._close_log_writer()
+        self._close_thermal_converter()
+        self._dedup = None
+        self._file_index = None
+        self._finish_metrics()
+
+    def _close_thermal_converter(self):
+        """等待剩余的热矩阵转换完成并关闭转换器"""
+        if self._thermal_converter is None:
+            return
+        converter = self._thermal_converter
+        converter.close()
+        for error in converter.errors:
+            self._log("ERROR", error)
+        self._log(
+            "INFO",
+            f"热矩阵转换 ({converter.fmt}): 新转换 {converter.converted} 个，"
+            f"已是最新 {converter.skipped} 个 -> {converter.output_path}",
+        )
+        self._thermal_converter = None
+
+    def _close_log_writer(self):
+        """写入剩余的下载日志并关闭写入器"""
+        if self._log_writer is None:
+            return
+        self._log_writer.close()
+        for error in self._log_writer.errors:
+            self._log("ERROR", error)
+        self._log_writer = None
+
     ## ----------------------------------------------------------------
     ## 主运行方法
     ## ----------------------------------------------------------------
@@ -666,13 +4418,59 @@ class ThermoMastoCrawler:
         # --- 任务1 (Gallery) 配置 ---
         gallery_max_pages=None,
         gallery_save_dir="Thermography_imgs",
+        gallery_page_workers=4,
         # --- 任务2 (Patient) 配置 ---
         patient_save_dir="Patient_Data",
+        write_patient_json=True,
+        compact_metadata=True,
+        thermal_format=None,
+        thermal_output=None,
+        # --- 图片后处理配置 ---
+        image_workers=0,
+        thumbnail_size=256,
+        # --- 页面获取配置 ---
+        page_fetch_mode=FETCH_SELENIUM,
+        parser_backend="bs4",
+        browser_workers=1,
         # --- 并发配置 ---
         max_workers=10,
+        detail_workers=4,
+        detail_queue_size=100,
+        download_queue_size=0,
+        download_priorities=None,
+        adaptive_concurrency=False,
+        adaptive_min_workers=1,
+        # --- 限速配置 ---
+        rate_limit=None,
+        rate_burst=1,
+        host_rate_limits=None,
+        # --- 下载引擎配置 ---
+        download_engine=ENGINE_THREAD,
+        async_max_connections=100,
+        async_limit_per_host=16,
+        download_chunk_size=256 * 1024,
+        preallocate_files=False,
+        # --- 增量爬取配置 ---
+        state_db=None,
+        force_refresh=False,
+        revalidate_existing=False,
+        preindex_existing=True,
+        # --- 下载日志配置 ---
+        log_batch_size=200,
+        log_flush_interval=1.0,
+        log_extra_sink=None,
+        # --- 去重配置 ---
+        deduplicate=False,
+        # --- 分片配置 ---
+        shard=None,
+        # --- 指标配置 ---
+        metrics_file=None,
+        metrics_port=None,
     ):
         """
-        运行爬虫主流程
+        运行爬虫主流程，返回本次运行的 CrawlMetrics。
+        参数校验失败、初始化或登录失败、或发生未捕获的严重错误时返回 None
+        (后两种情况下仍可通过 crawler.metrics 查看已记录的指标)
 
         Args:
             scrape_gallery_images (bool): 是否执行任务1
@@ -680,44 +4478,369 @@ class ThermoMastoCrawler:
             gallery_max_pages (int, optional): 任务1要爬取的最大页数。
                                             None (默认) 表示爬取所有自动检测到的页面。
             gallery_save_dir (str): 任务1的保存目录
+            gallery_page_workers (int): 并发获取图片库页面的线程数 (仅 "requests" 模式下生效)
             patient_save_dir (str): 任务2的保存目录
+            write_patient_json (bool): 是否在 metadata/ 下为每位患者保存格式化的 JSON 文件。
+                                       所有患者的元数据总会逐条写入 all_patients_metadata.jsonl。
+            compact_metadata (bool): 任务2结束后是否将 JSONL 压缩为 all_patients_metadata.json (JSON 数组)
+            thermal_format (str, optional): 下载后将 .txt 热矩阵转换为 float32 数组:
+                                            "npy" (每个矩阵一个 .npy，可内存映射)、
+                                            "hdf5" (需要 h5py) 或 "zarr" (需要 zarr)，
+                                            后两者按患者ID分组、按块存储。None (默认) 不转换。
+            thermal_output (str, optional): 转换结果的位置，默认为 patient_save_dir 下的
+                                            thermal_npy/、thermal_matrices.h5 或 thermal_matrices.zarr
+            image_workers (int): 图片校验进程数。大于 0 时，每张图片下载完成 (或已存在) 后
+                                 在进程池中完整解码校验，提取格式与尺寸写入 image_metadata.jsonl，
+                                 并生成缩略图 (需要 Pillow)。无法解码的图片改名为 .invalid，
+                                 日志记为 "invalid"，下次运行重新下载。0 (默认) 表示不处理。
+            thumbnail_size (int): 缩略图长边像素数，保存在图片目录下的 thumbnails/ 中；0 表示不生成
+            page_fetch_mode (str): 页面获取模式。
+                                   "selenium" (默认) 所有页面由浏览器加载；
+                                   "requests" 仅登录使用浏览器，图片库、患者列表与详情页
+                                   通过共享的 Requests 会话获取并直接解析 HTML。
+            parser_backend (str): HTML 解析后端。"bs4" (默认) 使用 BeautifulSoup；
+                                  "lxml" 或 "selectolax" 只定位所需节点，解析更快 (需安装对应库)。
+                                  各后端提取的结果完全相同。
+            browser_workers (int): Selenium 模式下并行访问患者详情页的浏览器数量。
+                                   大于 1 时额外启动一组 Headless 浏览器并共享登录 Cookie，
+                                   主浏览器负责列表翻页；崩溃的浏览器会自动重启。
+                                   (网站变化导致 "requests" 模式不可用时的备选方案)
             max_workers (int): 下载线程池的最大线程数
+            detail_workers (int): 详情页抓取线程数 (仅 "requests" 模式下生效)
+            detail_queue_size (int): 患者列表阶段到详情阶段的队列容量
+            download_queue_size (int): 尚未开始的下载任务的最大积压数量，0 表示不限。
+                                       积压已满时只阻塞优先级不高于积压中任何任务的提交方
+            download_priorities (dict, optional): 下载类别的优先级 (数值越小越先下载)，
+                                                  覆盖 DEFAULT_DOWNLOAD_PRIORITIES 中的对应项:
+                                                  thermal_matrix 0 > patient_image 1 > gallery 2。
+                                                  各类别设为相同的值即按发现顺序下载
+            adaptive_concurrency (bool): 启用 AIMD 自适应下载并发。根据延迟、429/5xx 与超时
+                                         自动在 adaptive_min_workers 与 max_workers
+                                         (异步引擎为 async_max_connections) 之间调整，并遵守 Retry-After。
+            adaptive_min_workers (int): 自适应并发的下限
+            rate_limit (float, optional): 每个主机每秒最多发起的请求数 (页面与文件下载共用)。
+                                          None (默认) 表示沿用各处的随机休眠。
+            rate_burst (int): 令牌桶容量，即允许的瞬时突发请求数
+            host_rate_limits (dict, optional): 为个别主机单独指定 {host: (rate, burst)}
+            download_engine (str): 下载引擎。"thread" (默认) 使用线程池；
+                                   "async" 使用 asyncio + aiohttp 单事件循环 (需安装 aiohttp)
+            async_max_connections (int): 异步引擎连接池的总连接数上限
+            async_limit_per_host (int): 异步引擎对单个主机的连接数上限
+            download_chunk_size (int): 下载时每次读取并写盘的字节数。较大的块可减少
+                                       Python 层的循环次数与写盘调用
+            preallocate_files (bool): 按 Content-Length 用 posix_fallocate 预分配文件空间
+                                      (仅支持的平台与文件系统生效)。预分配的 .part 在进程崩溃后
+                                      无法续传，会整体重新下载
+            state_db (str, optional): SQLite 状态库路径。设置后启用增量爬取:
+                                      未变化的患者、已完整下载的图片库页面和文件不再重复访问。
+            force_refresh (bool): 忽略状态库中的记录，重新访问所有页面 (仍会更新状态库)
+            revalidate_existing (bool): 对本地已存在的文件发送 HEAD 请求校验。
+                                        有状态库记录时使用 If-None-Match/If-Modified-Since，
+                                        否则比较 Content-Length；仅在文件变化或不完整时重新下载。
+            preindex_existing (bool): 启动时一次性扫描各下载目录，已存在的文件在提交前即被过滤
+                                      并记为 "exists"，不进入下载队列 (revalidate_existing 时不生效)
+            log_batch_size (int): 下载日志每批写盘的最大行数
+            log_flush_interval (float): 下载日志最长写盘间隔 (秒)
+            log_extra_sink (str, optional): 额外的日志输出格式，"jsonl" 或 "parquet" (需要 pyarrow)
+            deduplicate (bool): 启用按内容去重。同一 URL 被多个任务引用时只下载一次，
+                                其余路径记为 "linked" 并硬链接到已有副本；
+                                内容 (SHA-256) 相同的不同文件也替换为硬链接。
+                                启用状态库时跨运行生效。
+            shard (tuple | str, optional): 分片编号 (i, N) 或 "i/N" (i 从 0 开始)。设置后只爬取
+                                           页码/患者 ID 对 N 取模等于 i 的图片库页面与患者，
+                                           多台机器各运行一个分片即可分担一次完整爬取。
+                                           文件写入共享的下载目录；下载日志、患者元数据、
+                                           图片索引、状态库、指标文件与 hdf5/zarr 热矩阵
+                                           写入带 .shard-i-of-N 后缀的文件，
+                                           全部分片完成后用 merge_shard_outputs() 合并。
+            metrics_file (str, optional): Prometheus 文本格式的指标文件路径，运行中定期更新，
+                                          结束时写入最终结果 (可供 node_exporter textfile collector 采集)
+            metrics_port (int, optional): 运行期间在 127.0.0.1 的该端口提供 /metrics HTTP 端点
         """
+        if page_fetch_mode not in (self.FETCH_SELENIUM, self.FETCH_REQUESTS):
+            self._log("ERROR", f"未知的页面获取模式: {page_fetch_mode}")
+            return
+        if download_engine not in (self.ENGINE_THREAD, self.ENGINE_ASYNC):
+            self._log("ERROR", f"未知的下载引擎: {download_engine}")
+            return
+        if download_engine == self.ENGINE_ASYNC and aiohttp is None:
+            self._log("ERROR", "异步下载引擎需要 aiohttp，请先执行 pip install aiohttp")
+            return
+        try:
+            self.parser = create_page_parser(parser_backend)
+        except (ValueError, ImportError) as e:
+            self._log("ERROR", str(e))
+            return
+        if isinstance(shard, str):
+            try:
+                shard = parse_shard(shard)
+            except ValueError as e:
+                self._log("ERROR", str(e))
+                return
+        elif shard is not None:
+            shard = tuple(shard)
+            if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+                self._log("ERROR", f"分片编号超出范围 (0 <= i < N): {shard}")
+                return
+        if thermal_format not in (None,) + ThermalMatrixConverter.FORMATS:
+            self._log("ERROR", f"未知的热矩阵格式: {thermal_format}")
+            return
+        if thermal_format in ("hdf5", "zarr"):
+            module = "h5py" if thermal_format == "hdf5" else "zarr"
+            try:
+                __import__(module)
+            except ImportError:
+                self._log(
+                    "ERROR",
+                    f"{thermal_format} 格式需要 {module}，请先执行 pip install {module}",
+                )
+                return
+        if image_workers > 0:
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                self._log("ERROR", "图片校验需要 Pillow，请先执行 pip install pillow")
+                return
+        if log_extra_sink not in (None, "jsonl", "parquet"):
+            self._log("ERROR", f"未知的日志输出格式: {log_extra_sink}")
+            return
+        if log_extra_sink == "parquet":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                self._log("ERROR", "Parquet 日志需要 pyarrow，请先执行 pip install pyarrow")
+                return
+        self.page_fetch_mode = page_fetch_mode
+        self.download_chunk_size = download_chunk_size
+        self.preallocate_files = preallocate_files
+        self._rate_limiter = (
+            RateLimiter(rate_limit, rate_burst, host_rate_limits)
+            if rate_limit
+            else None
+        )
+        self._download_priorities = {
+            **DEFAULT_DOWNLOAD_PRIORITIES,
+            **(download_priorities or {}),
+        }
 
         start_time = time.time()
         self._log("INFO", "--- 爬虫启动 ---")
+        self._shard = shard
+        if shard is not None:
+            self._log("INFO", f"分片爬取: 第 {shard[0]} 个分片，共 {shard[1]} 个")
+            state_db = state_db and self._output_path(state_db)
+            metrics_file = metrics_file and self._output_path(metrics_file)
+        self.metrics = CrawlMetrics()
+        self._metrics_file = metrics_file
+        if metrics_port is not None:
+            try:
+                port = self.metrics.serve(metrics_port)
+                self._log("INFO", f"指标端点: http://127.0.0.1:{port}/metrics")
+            except OSError as e:
+                self._log("WARN", f"无法开启指标端点 (端口 {metrics_port}): {e}")
+
+        self._force_refresh = force_refresh
+        self._revalidate_existing = revalidate_existing
+        self._write_patient_json = write_patient_json
+        self._compact_metadata = compact_metadata
+        log_file = self._output_path(self.log_file)
+        self._init_log_file(log_file)
+        self._log_writer = DownloadLogWriter(
+            log_file,
+            batch_size=log_batch_size,
+            flush_interval=log_flush_interval,
+            extra_sink=log_extra_sink,
+        )
+        self._log_writer.start()
+        if state_db:
+            self._state = CrawlStateStore(state_db)
+            self._log("INFO", f"已加载增量爬取状态库: {state_db}")
+        if deduplicate:
+            self._dedup = ContentDeduplicator(self._state)
+        self._skipped_existing = 0
+        if preindex_existing and not revalidate_existing:
+            self._file_index = ExistingFileIndex()
+            with self.metrics.timer("preindex"):
+                indexed = 0
+                if scrape_gallery_images:
+                    indexed += self._file_index.scan(gallery_save_dir)
+                if scrape_patient_details:
+                    for folder in ("images", "thermal_matrix"):
+                        indexed += self._file_index.scan(
+                            os.path.join(patient_save_dir, folder)
+                        )
+            self._log("INFO", f"已扫描下载目录，发现 {indexed} 个已有文件")
+        if thermal_format and scrape_patient_details:
+            default_output = {
+                "npy": "thermal_npy",
+                "hdf5": "thermal_matrices.h5",
+                "zarr": "thermal_matrices.zarr",
+            }[thermal_format]
+            os.makedirs(patient_save_dir, exist_ok=True)
+            thermal_output = thermal_output or os.path.join(
+                patient_save_dir, default_output
+            )
+            if thermal_format != "npy":
+                # 单个 hdf5/zarr 存储不支持多个进程同时写入
+                thermal_output = self._output_path(thermal_output)
+            converter = ThermalMatrixConverter(
+                thermal_format,
+                thermal_output,
+                metrics=self.metrics,
+            )
+            try:
+                converter.start()
+            except Exception as e:
+                converter.close()
+                self._log("ERROR", f"无法打开热矩阵存储 {thermal_output}: {e}")
+                self._abort_startup()
+                return None
+            self._thermal_converter = converter
+
+        if image_workers > 0:
+            # 尽早启动，工作进程的导入与浏览器启动、登录重叠
+            self._image_processor = ImagePostProcessor(
+                image_workers,
+                self._output_path(self.image_index_file),
+                thumbnail_size=thumbnail_size,
+                metrics=self.metrics,
+                on_invalid=self._reject_invalid_image,
+            )
+            self._image_processor.start()
+            self._log("INFO", f"图片校验进程池已启动 ({image_workers} 个进程)")
 
-        if not self.setup_driver() or not self.login():
+        with self.metrics.timer("browser_setup"):
+            driver_ready = self.setup_driver()
+        logged_in = False
+        if driver_ready:
+            with self.metrics.timer("login"):
+                logged_in = self.login()
+        if not logged_in:
             self._log("ERROR", "初始化或登录失败，程序退出。")
-            if self.driver:
-                self.driver.quit()
-            return
+            self._abort_startup()
+            return None
 
         all_futures = []
+        fatal_error = False
 
         try:
+            if (
+                browser_workers > 1
+                and self.page_fetch_mode == self.FETCH_SELENIUM
+                and scrape_patient_details
+            ):
+                self._start_browser_pool(browser_workers)
+
+            if adaptive_concurrency:
+                max_limit = (
+                    async_max_connections
+                    if download_engine == self.ENGINE_ASYNC
+                    else max_workers
+                )
+                self._concurrency = AdaptiveConcurrencyController(
+                    min_limit=max(1, adaptive_min_workers), max_limit=max_limit
+                )
+                self.download_session = self._setup_adaptive_download_session()
+                self._log(
+                    "INFO",
+                    f"已启用自适应并发 (范围 {self._concurrency.min_limit}-{max_limit}，"
+                    f"初始 {self._concurrency.current_limit})",
+                )
+
+            if download_engine == self.ENGINE_ASYNC:
+                self._async_engine = AsyncDownloadEngine(
+                    max_connections=async_max_connections,
+                    limit_per_host=async_limit_per_host,
+                    timeout=self.timeout,
+                    chunk_size=download_chunk_size,
+                )
+                self._async_engine.preallocate = preallocate_files
+                self._async_engine.controller = self._concurrency
+                self._async_engine.metrics = self.metrics
+                self._async_engine.throttle = self._throttle_async
+                self._async_engine.start(
+                    headers=dict(self.session.headers),
+                    cookies=self.session.cookies.get_dict(),
+                )
+                self._log(
+                    "INFO",
+                    f"异步下载引擎已启动 (总连接数 {async_max_connections}, "
+                    f"单主机 {async_limit_per_host})",
+                )
+
             # --- 1. 任务提交阶段 ---
-            # Selenium 在主线程中按顺序执行，将下载任务提交到线程池
+            # 下载任务经由优先级调度器派发到线程池 (或异步引擎)，
+            # 患者的热矩阵与图片不必排在先发现的大量图片库图片之后
             with concurrent.futures.ThreadPoolExecutor(
                 max_workers=max_workers
-            ) as executor:
-                if scrape_gallery_images:
-                    gallery_futures = self.submit_gallery_tasks(
-                        executor, gallery_save_dir, max_pages=gallery_max_pages
+            ) as executor, PriorityDownloadScheduler(
+                lambda fn, *args: self._launch_download(executor, fn, *args),
+                window=(
+                    async_max_connections
+                    if download_engine == self.ENGINE_ASYNC
+                    else max_workers
+                ),
+                max_pending=download_queue_size,
+                metrics=self.metrics,
+            ) as scheduler:
+                self._scheduler = scheduler
+                if scrape_patient_details:
+                    self._completion = PatientCompletionTracker(
+                        self._output_path(
+                            os.path.join(patient_save_dir, "patients_complete.jsonl")
+                        ),
+                        on_complete=self._patient_completed,
+                    )
+                    self._completion.start()
+
+                # Requests 模式下，登录后不再需要浏览器，尽早释放内存
+                if self.page_fetch_mode == self.FETCH_REQUESTS:
+                    self._release_driver()
+
+                def submit_gallery():
+                    return self.submit_gallery_tasks(
+                        executor,
+                        gallery_save_dir,
+                        max_pages=gallery_max_pages,
+                        page_workers=gallery_page_workers,
+                    )
+
+                # Requests 模式下图片库与患者两个任务同时提交 (各自只用 HTTP 请求)；
+                # Selenium 模式下两者共用主浏览器，先提交优先级更高的患者任务
+                gallery_job = None
+                if scrape_gallery_images and self.page_fetch_mode == self.FETCH_REQUESTS:
+                    gallery_job = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="gallery-submit"
                     )
-                    all_futures.extend(gallery_futures)
+                    gallery_futures = gallery_job.submit(submit_gallery)
 
                 if scrape_patient_details:
                     patient_futures = self.submit_patient_tasks(
-                        executor, patient_save_dir
+                        executor,
+                        patient_save_dir,
+                        detail_workers=detail_workers,
+                        detail_queue_size=detail_queue_size,
                     )
                     all_futures.extend(patient_futures)
 
-                if not all_futures:
+                if gallery_job is not None:
+                    try:
+                        all_futures.extend(gallery_futures.result())
+                    finally:
+                        gallery_job.shutdown()
+                elif scrape_gallery_images:
+                    all_futures.extend(submit_gallery())
+
+                if self._skipped_existing:
+                    self._log(
+                        "INFO",
+                        f"{self._skipped_existing} 个文件已存在，未进入下载队列",
+                    )
+                if not all_futures and not self._skipped_existing:
                     self._log(
                         "WARN", "没有选择任何任务，或者未发现任何可下载文件。程序退出。"
                     )
-                    return
+                    return self.metrics
 
                 # --- 2. 任务监控阶段 ---
                 # 使用tqdm监控已提交任务的完成进度
@@ -725,8 +4848,9 @@ class ThermoMastoCrawler:
                     "INFO", f"--- 开始多线程下载，共 {len(all_futures)} 个任务 ---"
                 )
 
-                success_count = 0
+                success_count = self._skipped_existing
                 failed_count = 0
+                last_export = time.monotonic()
 
                 for future in tqdm(
                     concurrent.futures.as_completed(all_futures),
@@ -743,61 +4867,296 @@ class ThermoMastoCrawler:
                         # (CSV日志已在 _download_file 中记录)
                         self._log("ERROR", f"一个下载任务失败: {e}")
                         # self._log("DEBUG", traceback.format_exc()) # 取消注释以获取详细堆栈
+                    if time.monotonic() - last_export >= self.METRICS_EXPORT_INTERVAL:
+                        self._export_metrics()
+                        last_export = time.monotonic()
 
             self._log("SUCCESS", "--- 所有任务执行完毕 ---")
             self._log("INFO", f"总计成功 (含已存在): {success_count}")
             self._log("INFO", f"总计失败: {failed_count}")
+            if self._concurrency is not None:
+                self._log(
+                    "INFO",
+                    f"自适应并发: 最终上限 {self._concurrency.current_limit}，"
+                    f"拥塞信号 {self._concurrency.congestion_events} 次",
+                )
 
         except Exception as e:
+            fatal_error = True
             self._log("ERROR", f"发生未捕获的严重错误: {e}")
             self._log("ERROR", traceback.format_exc())
 
         finally:
             # --- 3. 清理阶段 ---
+            if self._scheduler is not None and self._scheduler.cancelled:
+                self._log(
+                    "WARN",
+                    f"运行中断，{self._scheduler.cancelled} 个未开始的下载任务已取消",
+                )
+            self._scheduler = None
+            self._close_completion_tracker()
+            self._concurrency = None
+            self.download_session = self.session
+            if self._browser_pool is not None:
+                self._browser_pool.close()
+                self._browser_pool = None
+            if self._async_engine is not None:
+                self._async_engine.close()
+                self._async_engine = None
+            self._close_image_processor()
+            self._close_thermal_converter()
+            self._close_deduplicator()
+            self._file_index = None
+            if self._state is not None:
+                self._state.close()
+                self._state = None
+            self._close_log_writer()
             if self.driver:
                 self.driver.quit()
                 self._log("INFO", "浏览器已关闭")
+            self._finish_metrics()
 
         end_time = time.time()
         self._log("INFO", f"总耗时: {end_time - start_time:.2f} 秒")
+        return None if fatal_error else self.metrics
 
 
 # ----------------------
-# 使用示例
+# 命令行入口
 # ----------------------
-if __name__ == "__main__":
-    # ---------------------------------
-    # 请在此处填写您的凭据
-    # ---------------------------------
+CLI_COMMANDS = ("crawl", "merge", "export")
 
-    load_dotenv()
-    USERNAME = os.getenv("USERNAME")
-    PASSWORD = os.getenv("PASSWORD")
 
-    # ---------------------------------
-    # [可选] 请在此处填写您的chromedriver路径
-    # ---------------------------------
-    # 如果 chromedriver 已在您的系统 PATH 中, 可以忽略 driver_path 参数
-    # 否则，请指定完整路径
-    DRIVER_PATH = "/usr/local/bin/chromedriver"
+def build_arg_parser():
+    """
+    命令行参数: crawl (默认) 爬取、merge 合并分片输出、export 导出数据集。
+    crawl 各选项的默认值取自 run() 的默认参数，命令行与 Python 调用的行为一致。
+    """
+    import argparse
+    import inspect
+
+    defaults = {
+        name: param.default
+        for name, param in inspect.signature(ThermoMastoCrawler.run).parameters.items()
+    }
+
+    parser = argparse.ArgumentParser(
+        description="DMI 乳腺热成像数据库爬虫。凭据从环境变量或 .env 中的 USERNAME/PASSWORD 读取。"
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    def shard_arg(text):
+        try:
+            return parse_shard(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+
+    crawl = commands.add_parser("crawl", help="爬取图片库与患者数据 (默认命令)")
+    tasks = crawl.add_argument_group("任务")
+    tasks.add_argument("--no-gallery", action="store_true", help="不爬取图片库")
+    tasks.add_argument("--no-patients", action="store_true", help="不爬取患者数据")
+    tasks.add_argument(
+        "--gallery-max-pages", type=int, default=None, help="图片库最大页数 (默认全部)"
+    )
+    tasks.add_argument(
+        "--shard",
+        type=shard_arg,
+        default=None,
+        metavar="i/N",
+        help="只爬取第 i 个分片 (i 从 0 开始，共 N 个)，多台机器分担一次完整爬取",
+    )
+    dirs = crawl.add_argument_group("目录")
+    dirs.add_argument("--gallery-dir", default=defaults["gallery_save_dir"])
+    dirs.add_argument("--patient-dir", default=defaults["patient_save_dir"])
+    dirs.add_argument(
+        "--state-db",
+        default=defaults["state_db"],
+        help="增量爬取状态库路径 (默认不启用)",
+    )
+    dirs.add_argument("--driver-path", default="/usr/local/bin/chromedriver")
+    workers = crawl.add_argument_group("并发")
+    workers.add_argument(
+        "--max-workers", type=int, default=defaults["max_workers"], help="下载线程数"
+    )
+    workers.add_argument(
+        "--detail-workers",
+        type=int,
+        default=defaults["detail_workers"],
+        help="详情页抓取线程数",
+    )
+    workers.add_argument(
+        "--gallery-page-workers", type=int, default=defaults["gallery_page_workers"]
+    )
+    workers.add_argument(
+        "--browser-workers",
+        type=int,
+        default=defaults["browser_workers"],
+        help="selenium 模式下的浏览器数量",
+    )
+    workers.add_argument(
+        "--image-workers",
+        type=int,
+        default=defaults["image_workers"],
+        help="图片校验与缩略图进程数 (需要 Pillow)",
+    )
+    workers.add_argument(
+        "--rate-limit",
+        type=float,
+        default=defaults["rate_limit"],
+        help="每个主机每秒最多请求数 (默认不限速，沿用随机休眠)",
+    )
+    engines = crawl.add_argument_group("引擎")
+    engines.add_argument(
+        "--engine",
+        choices=[ThermoMastoCrawler.ENGINE_THREAD, ThermoMastoCrawler.ENGINE_ASYNC],
+        default=defaults["download_engine"],
+        help="下载引擎",
+    )
+    engines.add_argument(
+        "--fetch-mode",
+        choices=[ThermoMastoCrawler.FETCH_REQUESTS, ThermoMastoCrawler.FETCH_SELENIUM],
+        default=defaults["page_fetch_mode"],
+        help="页面获取模式",
+    )
+    engines.add_argument(
+        "--parser", choices=list(PAGE_PARSERS), default=defaults["parser_backend"]
+    )
+    engines.add_argument(
+        "--thermal-format",
+        choices=ThermalMatrixConverter.FORMATS,
+        default=defaults["thermal_format"],
+    )
+    other = crawl.add_argument_group("其他")
+    other.add_argument("--force-refresh", action="store_true")
+    other.add_argument("--revalidate-existing", action="store_true")
+    other.add_argument(
+        "--deduplicate", action="store_true", help="按内容去重，重复文件以硬链接保存"
+    )
+    other.add_argument("--metrics-file", default=None)
+    other.add_argument("--metrics-port", type=int, default=None)
+    other.add_argument(
+        "--run-kwargs", default="{}", help="传给 run() 的其他参数 (JSON 对象)"
+    )
+
+    merge = commands.add_parser("merge", help="合并各分片的下载日志、患者元数据与图片索引")
+    merge.add_argument("--shards", type=int, required=True, help="分片总数 N")
+    merge.add_argument("--patient-dir", default=defaults["patient_save_dir"])
+    merge.add_argument("--log-file", default="download_log_unified.csv")
+    merge.add_argument("--image-index", default="image_metadata.jsonl")
+    merge.add_argument(
+        "--no-compact", action="store_true", help="不生成 all_patients_metadata.json"
+    )
+    merge.add_argument(
+        "--allow-missing",
+        action="store_true",
+        help="缺少部分分片输出时仍然合并已有的分片 (默认报错且不写入任何文件)",
+    )
+
+    export = commands.add_parser("export", help="将爬取结果导出为 tar 分片数据集")
+    export.add_argument("--output", required=True, help="数据集输出目录")
+    export.add_argument("--patient-dir", default=defaults["patient_save_dir"])
+    export.add_argument("--gallery-dir", default=None)
+    export.add_argument("--shard-max-mb", type=int, default=1024, help="单个分片的最大体积")
+    export.add_argument("--shard-max-samples", type=int, default=None)
+    export.add_argument(
+        "--no-text-matrices", action="store_true", help="不打包 .txt 热矩阵"
+    )
+    return parser
+
+
+def main(argv=None):
+    """命令行入口，返回进程退出码"""
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or argv[0] not in CLI_COMMANDS + ("-h", "--help"):
+        argv.insert(0, "crawl")
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == "merge":
+        try:
+            summary = merge_shard_outputs(
+                args.shards,
+                args.patient_dir,
+                log_file=args.log_file,
+                image_index_file=args.image_index,
+                compact=not args.no_compact,
+                allow_missing=args.allow_missing,
+            )
+        except FileNotFoundError as e:
+            print(f"[ERROR] {e}")
+            print("[ERROR] 请等待全部分片完成，或使用 --allow-missing 只合并已有的分片")
+            return 1
+        for path in summary.pop("missing"):
+            print(f"[WARN] 缺少分片输出: {path}")
+        for path, count in summary.items():
+            print(f"[SUCCESS] {path}: {count} 条记录")
+        return 0
+
+    if args.command == "export":
+        manifest = export_dataset(
+            args.patient_dir,
+            args.output,
+            gallery_dir=args.gallery_dir,
+            shard_max_bytes=args.shard_max_mb << 20,
+            shard_max_samples=args.shard_max_samples,
+            include_text_matrices=not args.no_text_matrices,
+        )
+        print(f"[SUCCESS] 数据集已导出到 {args.output}: {json.dumps(manifest, ensure_ascii=False)}")
+        return 0
+
+    load_dotenv()
+    username = os.getenv("USERNAME")
+    password = os.getenv("PASSWORD")
 
     print("--- 爬虫配置 ---")
-    print(f"用户名: {USERNAME}")
-    print(f"驱动路径: {DRIVER_PATH}")
+    print(f"用户名: {username}")
+    print(f"驱动路径: {args.driver_path}")
+    if args.shard is not None:
+        print(f"分片: {args.shard[0]}/{args.shard[1]}")
     print("-----------------")
 
-    spider = ThermoMastoCrawler(USERNAME, PASSWORD, driver_path=DRIVER_PATH)
-
-    # --- 灵活选择要运行的任务 ---
-    spider.run(
-        # --- 任务开关 ---
-        scrape_gallery_images=True,  # 设置为 True 来爬取图片库
-        scrape_patient_details=True,  # 设置为 True 来爬取患者数据
-        # --- 任务1配置 ---
-        gallery_max_pages=2,  # 爬取图片库的最大页数 (例如 2 用于测试, None 表示全部)
-        gallery_save_dir="downloads/Thermography_imgs",  # 图片库保存位置
-        # --- 任务2配置 ---
-        patient_save_dir="downloads/Patient_Data",  # 患者数据保存位置
-        # --- 性能配置 ---
-        max_workers=8,  # 下载线程数 (根据您的网络调整)
+    run_kwargs = dict(
+        scrape_gallery_images=not args.no_gallery,
+        scrape_patient_details=not args.no_patients,
+        gallery_max_pages=args.gallery_max_pages,
+        gallery_save_dir=args.gallery_dir,
+        gallery_page_workers=args.gallery_page_workers,
+        patient_save_dir=args.patient_dir,
+        thermal_format=args.thermal_format,
+        image_workers=args.image_workers,
+        page_fetch_mode=args.fetch_mode,
+        parser_backend=args.parser,
+        browser_workers=args.browser_workers,
+        max_workers=args.max_workers,
+        detail_workers=args.detail_workers,
+        rate_limit=args.rate_limit,
+        download_engine=args.engine,
+        state_db=args.state_db,
+        force_refresh=args.force_refresh,
+        revalidate_existing=args.revalidate_existing,
+        deduplicate=args.deduplicate,
+        shard=args.shard,
+        metrics_file=args.metrics_file,
+        metrics_port=args.metrics_port,
     )
+    try:
+        extra_kwargs = json.loads(args.run_kwargs)
+    except ValueError as e:
+        parser.error(f"--run-kwargs 不是有效的 JSON: {e}")
+    if not isinstance(extra_kwargs, dict):
+        parser.error("--run-kwargs 必须是 JSON 对象")
+    duplicated = sorted(set(extra_kwargs) & set(run_kwargs))
+    if duplicated:
+        parser.error(
+            f"--run-kwargs 中的参数已有对应的命令行选项，请改用选项设置: {', '.join(duplicated)}"
+        )
+    run_kwargs.update(extra_kwargs)
+
+    spider = ThermoMastoCrawler(username, password, driver_path=args.driver_path)
+    metrics = spider.run(**run_kwargs)
+    # 登录失败或严重错误时 run() 返回 None，以非零退出码结束，便于分片调度方发现失败
+    return 0 if metrics is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,367 @@
+"""
+基于本地模拟站点 (benchmarks/mock_site.py) 的回归测试。
+
+运行:
+    python -m pytest -q tests
+"""
+
+import asyncio
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import main  # noqa: E402
+from bench_crawl import BenchmarkCrawler  # noqa: E402
+from mock_site import MockDMISite  # noqa: E402
+
+
+@pytest.fixture
+def make_site():
+    sites = []
+
+    def factory(**kwargs):
+        options = dict(
+            gallery_pages=2,
+            images_per_page=5,
+            patients=6,
+            patients_per_page=3,
+            files_per_patient=2,
+            file_size=4096,
+        )
+        options.update(kwargs)
+        site = MockDMISite(**options)
+        sites.append(site)
+        return site, site.start()
+
+    yield factory
+    for site in sites:
+        site.stop()
+
+
+def crawl(base_url, work_dir, **kwargs):
+    """在 work_dir 中完整运行一次爬虫，返回 (爬虫, run() 的返回值)"""
+    crawler = BenchmarkCrawler(base_url)
+    crawler.log_file = str(work_dir / "download_log.csv")
+    crawler.image_index_file = str(work_dir / "image_metadata.jsonl")
+    crawler._init_log_file()
+    metrics = crawler.run(
+        gallery_save_dir=str(work_dir / "gallery"),
+        patient_save_dir=str(work_dir / "patients"),
+        page_fetch_mode=main.ThermoMastoCrawler.FETCH_REQUESTS,
+        **kwargs,
+    )
+    return crawler, metrics
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+@pytest.mark.parametrize("status", [429, 503])
+def test_html_error_pages_do_not_trigger_relogin(make_site, tmp_path, engine, status):
+    # 错误页的 Content-Type 为 text/html，会话永不过期
+    site, base_url = make_site(error_rate=0.4, error_status=status, seed=1)
+    crawler, metrics = crawl(
+        base_url, tmp_path, download_engine=engine, max_workers=4, detail_workers=2
+    )
+
+    assert metrics is not None
+    assert site.error_count > 0
+    assert metrics.counter("relogins") == 0
+    assert site.login_count == 1
+    with open(crawler.log_file, encoding="utf-8") as f:
+        assert "会话已过期" not in f.read()
+
+
+def test_acquire_async_wakes_on_release_from_another_thread():
+    async def scenario():
+        controller = main.AdaptiveConcurrencyController(
+            min_limit=1, max_limit=1, initial_limit=1
+        )
+        controller.acquire()
+        task = asyncio.ensure_future(controller.acquire_async())
+        await asyncio.sleep(0)
+        # 协程挂起等待唤醒，而不是轮询
+        assert not task.done()
+        assert len(controller._async_waiters) == 1
+        threading.Thread(target=controller.release).start()
+        await asyncio.wait_for(task, timeout=1)
+        assert controller.in_flight == 1
+        assert controller._async_waiters == []
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+def test_html_429_shrinks_adaptive_limit(make_site, tmp_path, monkeypatch, engine):
+    limits = []
+
+    class RecordingController(main.AdaptiveConcurrencyController):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            limits.append(self.current_limit)
+
+        def record_congestion(self, retry_after=None):
+            super().record_congestion(retry_after)
+            limits.append(self.current_limit)
+
+    monkeypatch.setattr(main, "AdaptiveConcurrencyController", RecordingController)
+    site, base_url = make_site(
+        patients=10, files_per_patient=4, error_rate=0.3, error_status=429, seed=2
+    )
+    _, metrics = crawl(
+        base_url,
+        tmp_path,
+        download_engine=engine,
+        max_workers=8,
+        async_max_connections=8,
+        adaptive_concurrency=True,
+    )
+
+    assert metrics is not None
+    assert metrics.counter("relogins") == 0
+    assert len(limits) > 1, "控制器没有收到 429 拥塞信号"
+    assert min(limits[1:]) < limits[0]
+
+
+def test_thermal_store_failure_releases_resources(make_site, tmp_path, capsys):
+    site, base_url = make_site()
+    # 目录无法作为 hdf5 文件打开
+    crawler, metrics = crawl(
+        base_url,
+        tmp_path,
+        state_db=str(tmp_path / "state.sqlite"),
+        thermal_format="hdf5",
+        thermal_output=str(tmp_path),
+        image_workers=1,
+    )
+
+    assert metrics is None
+    assert crawler._log_writer is None
+    assert crawler._state is None
+    assert crawler._image_processor is None
+    assert crawler._thermal_converter is None
+    assert site.login_count == 0
+    assert "无法打开热矩阵存储" in capsys.readouterr().out
+
+
+def test_default_size_thermal_files_convert(make_site, tmp_path, capsys):
+    h5py = pytest.importorskip("h5py")
+    site, base_url = make_site(file_size=256 * 1024)
+    output = tmp_path / "thermal.h5"
+    _, metrics = crawl(
+        base_url, tmp_path, thermal_format="hdf5", thermal_output=str(output)
+    )
+
+    assert metrics is not None
+    assert "[ERROR]" not in capsys.readouterr().out
+    with h5py.File(output, "r") as store:
+        assert len(store) == site.patients
+
+
+def test_merge_restores_list_order(tmp_path):
+    # 列表顺序与患者 ID 的顺序不同
+    shards = {
+        0: [(1, "9", 1), (1, "4", 3)],
+        1: [(1, "7", 2), (2, "1", 4)],
+    }
+    jsonl_path = str(tmp_path / "all_patients_metadata.jsonl")
+    log_file = str(tmp_path / "download_log.csv")
+    for index, rows in shards.items():
+        with open(main.shard_output_path(log_file, (index, 2)), "w", encoding="utf-8") as f:
+            f.write(",".join(main.LOG_COLUMNS) + "\n")
+        with open(main.shard_output_path(jsonl_path, (index, 2)), "w", encoding="utf-8") as f:
+            for page, pid, position in rows:
+                record = {"ID": pid, "page": page, main.SHARD_POSITION_FIELD: position}
+                f.write(json.dumps(record) + "\n")
+
+    summary = main.merge_shard_outputs(
+        2,
+        str(tmp_path),
+        log_file=log_file,
+        image_index_file=str(tmp_path / "image_metadata.jsonl"),
+    )
+
+    assert summary[jsonl_path] == 4
+    with open(jsonl_path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [r["ID"] for r in records] == ["9", "7", "4", "1"]
+    assert all(main.SHARD_POSITION_FIELD not in r for r in records)
+
+
+def test_merge_refuses_missing_shards(tmp_path, capsys):
+    log_file = tmp_path / "download_log.csv"
+    jsonl_path = tmp_path / "all_patients_metadata.jsonl"
+    log_file.write_text("已有的汇总日志\n", encoding="utf-8")
+    jsonl_path.write_text('{"ID": "1"}\n', encoding="utf-8")
+    # 3 个分片中只有分片 0 完成
+    shard_log = main.shard_output_path(str(log_file), (0, 3))
+    with open(shard_log, "w", encoding="utf-8") as f:
+        f.write(",".join(main.LOG_COLUMNS) + "\n")
+    argv = [
+        "merge",
+        "--shards",
+        "3",
+        "--patient-dir",
+        str(tmp_path),
+        "--log-file",
+        str(log_file),
+        "--image-index",
+        str(tmp_path / "image_metadata.jsonl"),
+    ]
+
+    assert main.main(argv) == 1
+    assert "缺少分片输出" in capsys.readouterr().out
+    assert log_file.read_text(encoding="utf-8") == "已有的汇总日志\n"
+    assert jsonl_path.read_text(encoding="utf-8") == '{"ID": "1"}\n'
+    assert not (tmp_path / "all_patients_metadata.json").exists()
+
+    assert main.main(argv + ["--allow-missing"]) == 0
+    assert log_file.read_text(encoding="utf-8").splitlines() == [",".join(main.LOG_COLUMNS)]
+    # 没有任何分片写出元数据，已有的元数据保持不变
+    assert jsonl_path.read_text(encoding="utf-8") == '{"ID": "1"}\n'
+
+
+def test_sharded_crawl_merges_to_unsharded_metadata(make_site, tmp_path):
+    _, base_url = make_site(patients=7)
+    (tmp_path / "full").mkdir()
+    (tmp_path / "sharded").mkdir()
+    _, metrics = crawl(base_url, tmp_path / "full")
+    assert metrics is not None
+    for index in range(2):
+        _, metrics = crawl(base_url, tmp_path / "sharded", shard=f"{index}/2")
+        assert metrics is not None
+    main.merge_shard_outputs(
+        2,
+        str(tmp_path / "sharded" / "patients"),
+        log_file=str(tmp_path / "sharded" / "download_log.csv"),
+        image_index_file=str(tmp_path / "sharded" / "image_metadata.jsonl"),
+    )
+
+    def load(work_dir):
+        path = work_dir / "patients" / "all_patients_metadata.jsonl"
+        with open(path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        for record in records:
+            record.pop("scraped_at")
+        return records
+
+    assert load(tmp_path / "sharded") == load(tmp_path / "full")
+
+
+def test_parquet_log_keeps_rows_after_int_first_batch(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    writer = main.DownloadLogWriter(
+        str(tmp_path / "download_log.csv"), batch_size=2, extra_sink="parquet"
+    )
+    writer.start()
+
+    def row(status, size_kb, elapsed_s):
+        return dict(
+            timestamp="2026-01-01 00:00:00",
+            task_type="patient",
+            identifier=7,
+            file_name="P0007_01.txt",
+            status=status,
+            size_kb=size_kb,
+            url="http://example/P0007_01.txt",
+            elapsed_s=elapsed_s,
+            error=None,
+        )
+
+    # 续传时首批全是已存在的文件，数值列为整数 0
+    for _ in range(2):
+        writer.write(row("exists", 0, 0))
+    for _ in range(3):
+        writer.write(row("success", 12.5, 0.125))
+    writer.close()
+
+    assert writer.errors == []
+    table = pq.read_table(writer._parquet_path)
+    assert table.num_rows == 5
+    assert str(table.schema.field("elapsed_s").type) == "double"
+
+
+@pytest.mark.parametrize("engine", ["thread", "async"])
+@pytest.mark.parametrize("adaptive", [False, True])
+def test_every_request_takes_a_rate_limit_token(
+    make_site, tmp_path, monkeypatch, engine, adaptive
+):
+    reserved = []
+
+    class CountingRateLimiter(main.RateLimiter):
+        def _reserve(self, url):
+            reserved.append(url)
+            return super()._reserve(url)
+
+    monkeypatch.setattr(main, "RateLimiter", CountingRateLimiter)
+    site, base_url = make_site(error_rate=0.3, error_status=503, seed=3)
+    _, metrics = crawl(
+        base_url,
+        tmp_path,
+        download_engine=engine,
+        adaptive_concurrency=adaptive,
+        rate_limit=1000,
+        rate_burst=50,
+    )
+
+    assert metrics is not None
+    assert site.error_count > 0
+    # 模拟登录 (BenchmarkCrawler.login) 的 POST 重定向到首页，不经过限速器
+    assert len(reserved) >= site.request_count - site.login_count
+
+
+def test_rejected_and_partial_files_are_not_finished_artifacts(tmp_path):
+    patient_dir = tmp_path / "patients"
+    gallery_dir = tmp_path / "gallery"
+    patient_dir.mkdir()
+    gallery_dir.mkdir()
+    (patient_dir / "all_patients_metadata.jsonl").write_text("", encoding="utf-8")
+    for name in ("G0001_000.jpg", "G0001_001.jpg.invalid", "G0001_002.jpg.part"):
+        (gallery_dir / name).write_bytes(b"\xff\xd8data")
+
+    manifest = main.export_dataset(
+        str(patient_dir), str(tmp_path / "export"), gallery_dir=str(gallery_dir)
+    )
+    index = main.ExistingFileIndex()
+
+    assert manifest["samples"]["gallery"] == 1
+    assert index.scan(str(gallery_dir)) == 1
+    assert index.size(str(gallery_dir / "G0001_000.jpg")) == 6
+
+
+@pytest.mark.parametrize("fmt, output", [("hdf5", "thermal.h5"), ("zarr", "thermal.zarr")])
+def test_same_size_redownload_is_reconverted(tmp_path, fmt, output):
+    pytest.importorskip("h5py" if fmt == "hdf5" else "zarr")
+    txt_path = tmp_path / "T0001_1.txt"
+    output_path = str(tmp_path / output)
+
+    def convert():
+        converter = main.ThermalMatrixConverter(fmt, output_path)
+        converter.start()
+        converter.submit(str(txt_path), "1")
+        converter.close()
+        assert converter.errors == []
+        return converter.converted
+
+    txt_path.write_text("34.10 34.20\n34.30 34.40\n", encoding="ascii")
+    assert convert() == 1
+    assert convert() == 0
+    # 重新下载: 大小相同、内容与修改时间不同
+    txt_path.write_text("35.10 35.20\n35.30 35.40\n", encoding="ascii")
+    stat = os.stat(txt_path)
+    os.utime(txt_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert convert() == 1
+
+    store = main.open_thermal_store(output_path)
+    try:
+        assert float(store["1"]["T0001_1"][0, 0]) == pytest.approx(35.1)
+    finally:
+        if fmt == "hdf5":
+            store.close()